@@ -18,37 +18,132 @@
 # this software.
 
 """Address Cache (store addresses assigned to interfaces)"""
+from threading import RLock
 from Routing import Addressing
 from address import Address
+import global_variables as gv
+
+# lifetime value that represents infinity
+INFINITE_LIFETIME = 0xffffffff
 
 class AddressCache(object):
-    def __init__(self):
+    def __init__(self, writer=None):
+        """Address cache:
+        - writer: a NetlinkWriter that performs the kernel operations
+          asynchronously (if None, they are performed right away)"""
         self.__address_obj = Addressing()
         self.__address_obj.set_family("inet6")
         self.__address_cache = []  # store addresses that are added by the node
+        self.__assigned = set()  # addresses that are added by the node (printable format)
+        self.__lifetimes = {}  # (address, pref_len, interface) -> (valid_lft, preferred_lft)
+        self.__expiry = {}  # (address, pref_len, interface) -> timing wheel entry (for finite valid lifetimes)
+        self.__lock = RLock()  # the Addressing object is shared with the writer thread
+        self.writer = writer
+        # addresses assigned in the kernel (address -> set of interfaces), as
+        # reported by the netlink monitor (None when there is no monitor and
+        # the kernel must be queried instead)
+        self.__kernel_view = None
+
+    def __kernel_addresses(self):
+        with self.__lock:
+            return str(self.__address_obj)
+
+    def kernel_view_reset(self):
+        """Start following the kernel addresses through netlink notifications"""
+        self.__kernel_view = {}
+
+    def kernel_address_added(self, address, interface):
+        """An address has been assigned on an interface (netlink notification)"""
+        self.__kernel_view.setdefault(repr(Address(address)), set()).add(interface)
+
+    def kernel_address_removed(self, address, interface):
+        """An address has been removed from an interface (netlink notification)"""
+        address = repr(Address(address))
+        interfaces = self.__kernel_view.get(address, set())
+        interfaces.discard(interface)
+        if not interfaces:
+            self.__kernel_view.pop(address, None)
 
     def is_assigned(self, address):
         """Indicates if the address is assigned on the node"""
-        return repr(Address(address)) in str(self.__address_obj)
+        address = repr(Address(address))
+        # addresses added by the node might not have reached the kernel yet
+        if address in self.__assigned:
+            return True
+        if self.__kernel_view is not None:
+            return address in self.__kernel_view
+        return address in self.__kernel_addresses()
 
     def is_assigned_if(self, address, interface):
         """Indicates if the address is assigned on the interface"""
+        if self.__kernel_view is not None:
+            return interface in self.__kernel_view.get(repr(Address(address)), ())
         iface_address = [address for address \
-                         in str(self.__address_obj).splitlines() \
+                         in self.__kernel_addresses().splitlines() \
                          if "dev %s" % interface in address]
         return address in iface_address
 
+    def __update_kernel(self, key, before, after):
+        """Bring an address from the before state to the after state (None
+        meaning that the address is not assigned)"""
+        if self.writer:
+            self.writer.submit(("address",) + key, before, after, self.__apply)
+        else:
+            self.__apply(before, after)
+
+    def __apply(self, before, after):
+        """Perform the netlink operation (in the writer thread, if any)"""
+        with self.__lock:
+            if after is None:
+                if before is not None:
+                    (addr, pref_len, iface, valid_lft, preferred_lft) = before
+                    self.__address_obj.remove(addr + "/" + str(pref_len), iface)
+            else:
+                (addr, pref_len, iface, valid_lft, preferred_lft) = after
+                self.__address_obj.add(addr + "/" + str(pref_len), iface, str(valid_lft), str(preferred_lft),
+                                       replace=before is not None)
+
     def add(self, address, interface, pref_len=64, valid_lft=None, preferred_lft=None):
         """Add an address to an interface"""
-        if (address, pref_len, interface) not in self.__address_cache:
-            self.__address_obj.add(address + "/" + str(pref_len), interface, str(valid_lft), str(preferred_lft))
-            self.__address_cache.append((address, pref_len, interface))
+        key = (address, pref_len, interface)
+        if key not in self.__lifetimes:
+            before = None
+            self.__address_cache.append(key)
+            self.__assigned.add(repr(Address(address)))
         else:
-            self.__address_obj.add(address + "/" + str(pref_len), interface, str(valid_lft), str(preferred_lft), replace=True)
+            before = key + self.__lifetimes[key]
+        self.__lifetimes[key] = (valid_lft, preferred_lft)
+        self.__update_kernel(key, before, key + (valid_lft, preferred_lft))
+
+        # the kernel removes the address when its valid lifetime expires,
+        # the cache must forget it at the same time
+        entry = self.__expiry.pop(key, None)
+        if valid_lft is None or valid_lft == INFINITE_LIFETIME:
+            if entry:
+                entry.cancel()
+        elif entry:
+            entry.reschedule(valid_lft)
+            self.__expiry[key] = entry
+        else:
+            self.__expiry[key] = gv.timing_wheel.schedule(valid_lft, self.__addresses_expired, key)
+
+    def __addresses_expired(self, keys):
+        """The valid lifetime of some addresses has expired (called by the timing wheel)"""
+        for key in keys:
+            self.__expiry.pop(key, None)
+            self.__address_cache.remove(key)
+            del self.__lifetimes[key]
+        self.__assigned = set([repr(Address(address)) for (address, pref_len, iface) in self.__address_cache])
 
     def emptyCache(self):
-        for (addr, pref_len, iface) in self.__address_cache:
-            self.__address_obj.remove(addr + "/" + str(pref_len), iface)
+        for entry in self.__expiry.itervalues():
+            entry.cancel()
+        self.__expiry = {}
+        for key in self.__address_cache:
+            self.__update_kernel(key, key + self.__lifetimes[key], None)
+        self.__address_cache = []
+        self.__assigned = set()
+        self.__lifetimes = {}
 
     def __iter__(self):
         return iter(self.__address_cache)
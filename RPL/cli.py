@@ -24,14 +24,17 @@ Command line interfaces
 import logging
 import global_variables as gv
 from address import Address
+from snapshot import state_changed
 
 logger = logging.getLogger("RPL")
 
 COMMANDS = \
         {"show-current-dodag": "Show the currently active DODAG",
          "list-dodag-cache": "List the content of the DODAG cache",
+         "list-instances": "List the RPL instances the node participates in",
          "list-neighbors": "List the neighbors",
          "list-neighbors-verbose": "List the neighbors and their corresponding DODAG",
+         "show-neighbor-stats": "Show the size of the neighbor cache and how many neighbors were evicted or rejected",
          "show-preferred-parent": "List the currently preferred (DIO) parent",
          "list-parents": "List the (DIO) parents",
          "list-parents-verbose": "List the (DIO) parents and their corresponding DODAG",
@@ -40,6 +43,11 @@ COMMANDS = \
          "local-repair": "Trigger a local repair on the DODAG",
          "subdodag-dao-update" : "Trigger the DODAG to increase its DTSN so that the sub-dodag will send a DAO message",
          "list-routes" : "List the routes assigned by the RPL implementation",
+         "show-route-stats" : "Show how often routes changed next hop and how long the default route was missing",
+         "show-netlink-stats" : "Show the statistics of the netlink writer (kernel route and address updates)",
+         "show-trickle-stats" : "Show the DIO trickle timer statistics (transmissions, suppressions, interval sizes) of each DODAG",
+         "show-dao-stats" : "Show the statistics of the DAO scheduler (coalesced, delayed and retransmitted DAO, round trip times)",
+         "show-snapshot-stats" : "Show the version and age of the state snapshot the other commands read",
          "list-downward-routes": "List the downward routes for the currently active DODAG",
          "help": "List this help",
          }
@@ -55,62 +63,77 @@ def parse(cli_sock, command):
     if command == "help":
         resp = "\n".join(["%s: %s" % (command, desc) for (command, desc) in COMMANDS.iteritems()])
     elif command == "show-current-dodag":
-        dodag = gv.dodag_cache.get_active_dodag()
-        if dodag:
-            resp = str(dodag)
+        active_dodags = gv.snapshots.get().active_dodags
+        if active_dodags:
+            resp = "\n".join(active_dodags)
         else:
             resp = "This node has not joined any DODAG yet"
     elif command == "list-dodag-cache":
-        dodags = gv.dodag_cache.get_dodag()
-        resp = "\n".join([str(dodag) for dodag in dodags])
+        resp = "\n".join(gv.snapshots.get().dodags)
     elif command =="list-neighbors":
-        neighbors = gv.neigh_cache.get_neighbor_list()
-        resp = "\n".join([str(neigh) for neigh in neighbors])
+        neighbors = gv.snapshots.get().neighbors
+        resp = "\n".join([neigh for (neigh, dodag) in neighbors])
     elif command == "list-neighbors-verbose":
-        neighbors = gv.neigh_cache.get_neighbor_list()
-        resp = "\n".join([str(neigh)+'\n'+str(neigh.dodag) for neigh in neighbors])
+        neighbors = gv.snapshots.get().neighbors
+        resp = "\n".join([neigh+'\n'+dodag for (neigh, dodag) in neighbors])
+    elif command == "show-neighbor-stats":
+        resp = gv.snapshots.get().neighbor_stats
     elif command == "show-preferred-parent":
-        resp = str(gv.neigh_cache.get_preferred())
+        resp = "\n".join(gv.snapshots.get().preferred) or str(None)
     elif command == "show-dao-parent":
-        dodag = gv.dodag_cache.get_active_dodag()
-        if dodag:
-            resp = str(dodag.preferred_parent)
+        dao_parents = gv.snapshots.get().dao_parents
+        if dao_parents:
+            resp = "\n".join(dao_parents)
         else:
             resp = "This node has not joined any DODAG yet"
     elif command == "list-parents":
-        parents = gv.neigh_cache.get_parent_list()
-        resp = "\n".join([str(parent) for parent in parents])
+        parents = gv.snapshots.get().parents
+        resp = "\n".join([parent for (parent, dodag) in parents])
     elif command == "list-parents-verbose":
-        parents = gv.neigh_cache.get_parent_list()
-        resp = "\n".join([str(parent)+'\n'+str(parent.dodag) for parent in parents])
+        parents = gv.snapshots.get().parents
+        resp = "\n".join([parent+'\n'+dodag for (parent, dodag) in parents])
     elif command == "global-repair":
-        dodags = gv.dodag_cache.get_dodag(is_root=True)
+        dodags = gv.instances.get_dodag(is_root=True)
         resp = "global repair triggered, bumping new version for DODAG:\n"
         for dodag in dodags:
             dodag.version += 1
             dodag.DIOtimer.hear_inconsistent()
             resp += "DODAGID: %s; new version: %d" % (repr(Address(dodag.dodagID)), dodag.version.get_val())
+        state_changed()
     elif command == "local-repair":
-        dodags = gv.dodag_cache.get_dodag()
+        dodags = gv.instances.get_dodag()
         resp = "local repair triggers on the following DODAG:\n"
         for dodag in dodags:
             dodag.DIOtimer.hear_inconsistent()
             resp += "DODAGID: %s; version: %d" % (repr(Address(dodag.dodagID)), dodag.version.get_val())
     elif command == "subdodag-dao-update":
-        dodags = gv.dodag_cache.get_dodag()
+        dodags = gv.instances.get_dodag()
         resp = "incrementing DTSN field for the following DODAG:\n"
         for dodag in dodags:
             dodag.DTSN += 1
             dodag.DIOtimer.hear_inconsistent()
             resp += "DODAGID: %s; version: %d; new DTSN: %d\n" % (repr(Address(dodag.dodagID)), dodag.version.get_val(), dodag.DTSN.get_val())
+        state_changed()
     elif command == "list-routes":
         resp = "list of routes assigned on the node:\n"
-        resp += "\n".join([str(route) for route in gv.route_cache.route_cache])
+        resp += "\n".join(gv.snapshots.get().routes)
+    elif command == "show-route-stats":
+        resp = gv.snapshots.get().route_stats
+    elif command == "show-netlink-stats":
+        resp = gv.snapshots.get().netlink_stats
+    elif command == "show-trickle-stats":
+        resp = gv.snapshots.get().trickle_stats
+    elif command == "list-instances":
+        resp = "\n".join(gv.snapshots.get().instances)
+    elif command == "show-snapshot-stats":
+        resp = gv.snapshots.get_stats()
+    elif command == "show-dao-stats":
+        resp = gv.snapshots.get().dao_stats
     elif command == "list-downward-routes":
-        dodag = gv.dodag_cache.get_active_dodag()
-        if dodag:
-            resp = "list of downward routes on the current DODAG %s" % dodag.dodagID
-            resp += "\n".join([str(route) for route in dodag.downward_routes_get()])
+        downward_routes = gv.snapshots.get().downward_routes
+        if downward_routes:
+            resp = "\n".join(["list of downward routes on the current DODAG %s" % dodagID + "\n".join(routes)
+                              for (dodagID, routes) in downward_routes])
         else:
             resp = "This node has not joined any DODAG yet"
 
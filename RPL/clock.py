@@ -0,0 +1,55 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Clocks the timers are driven by.
+
+SystemClock follows the wall clock. VirtualClock only moves when it is told
+to, so that a Scheduler can jump straight from one deadline to the next and
+run long protocol scenarios (trickle convergence, DAO retransmissions) much
+faster than real time."""
+
+import time
+
+
+class SystemClock(object):
+    """Wall clock"""
+
+    def time(self):
+        return time.time()
+
+    def __str__(self):
+        return "system clock"
+
+
+class VirtualClock(object):
+    """Clock that only moves forward when advance_to() is called"""
+
+    def __init__(self, start=0.0):
+        self.now = float(start)
+
+    def time(self):
+        return self.now
+
+    def advance_to(self, when):
+        """Move the clock forward (it never goes back)"""
+        if when > self.now:
+            self.now = float(when)
+
+    def __str__(self):
+        return "virtual clock (%f)" % self.now
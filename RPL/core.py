@@ -19,12 +19,14 @@
 
 from tools import list_valid_interfaces, broadcast
 from RplIcmp import RplSocket
-from cPickle import dumps, loads
+from cPickle import dumps, loads, HIGHEST_PROTOCOL
 from copy import deepcopy
 from message import Message
+from lollipop import Lollipop
 from address import Address, derive_address
 from dodag import DODAG
 from route_cache import Route
+from snapshot import state_changed
 from icmp import ICMPv6, RPL_Header_map, DIS, DIO, \
                  DAO, DAO_ACK, \
                  RPL_Option_Solicited_Information, \
@@ -34,25 +36,17 @@ from icmp import ICMPv6, RPL_Header_map, DIS, DIO, \
                  RPL_Option_RPL_Target, \
                  RPL_Option_Transit_Information, \
                  findOption, getAllOption
-from rpl_constants import INFINITE_RANK, \
-                          DEFAULT_INTERVAL_BETWEEN_DIS
-from threading import Timer
-from time import time
+from rpl_constants import INFINITE_RANK
 import cli
 import global_variables as gv
 import zmq
 import sys
+from math import ceil
 
 # logging facility
 import logging
 logger = logging.getLogger("RPL")
 
-#
-# Global variables for this module
-#
-
-dis_timer = None
-
 #
 # Functions
 #
@@ -67,16 +61,22 @@ def process_loop(interfaces):
     poller = zmq.Poller()
     poller.register(receiver, zmq.POLLIN)
     poller.register(cli_sock, zmq.POLLIN)
+    if gv.netlink_monitor:
+        poller.register(gv.netlink_monitor.fileno(), zmq.POLLIN)
     try:
         logger.info("starting message processing loop")
 
         # no need to send DIS message when the node is a DODAG Root
         # Note that it might not always make sense
-        if gv.dodag_cache.is_empty():
-            broadcast_dis(interfaces)
+        if gv.instances.is_empty():
+            gv.dis_scheduler.start()
 
         while True:
-            socks = dict(poller.poll())
+            # wake up in time for the next protocol timer
+            timeout = gv.scheduler.next_timeout()
+            if timeout is not None:
+                timeout = int(ceil(timeout * 1000))
+            socks = dict(poller.poll(timeout))
 
             if receiver in socks and socks[receiver] == zmq.POLLIN:
                 message = receiver.recv()
@@ -94,13 +94,13 @@ def process_loop(interfaces):
 
                 del command
 
-    except KeyboardInterrupt:
-        global dis_timer
+            if gv.netlink_monitor and gv.netlink_monitor.fileno() in socks:
+                gv.netlink_monitor.process()
 
-        try:
-            dis_timer.cancel()
-        except AttributeError:
-            pass
+            gv.scheduler.run_pending()
+
+    except KeyboardInterrupt:
+        gv.dis_scheduler.stop()
 
 def stop_processing():
     global handleMessage
@@ -108,17 +108,14 @@ def stop_processing():
 
 
 def broadcast_dis(interfaces, options=""):
-    """Broadcast a DIS message on all interfaces"""
-    global dis_timer
+    """Broadcast a DIS message on all interfaces
+    (called by the DIS scheduler)"""
     logger.debug("checking if a DIS broadcast is required")
-    if gv.dodag_cache.is_empty():
+    if gv.instances.is_empty():
         logger.debug("broadcasting DIS")
         broadcast(interfaces, str(DIS()) + str(options))
     else:
         logger.debug("no DIS is required")
-    dis_timer = Timer(DEFAULT_INTERVAL_BETWEEN_DIS, broadcast_dis, kwargs= {'interfaces':interfaces})
-    dis_timer.daemon = True
-    dis_timer.start()
 
 def handleMessage(interfaces, message):
     """Dispatch a message to the correct handler"""
@@ -150,18 +147,19 @@ def handleDIO(interfaces, message):
     payload = dio.parse(message.msg)
     consistent = True
 
-    # attach to the very first RPL Instance we see
-    if gv.global_instanceID == 0:
-        gv.global_instanceID = dio.instanceID
-
-    if dio.instanceID != gv.global_instanceID:
-        logger.debug("ignoring DIO message address targeting a different RPL instance")
-        return (None, None)
+    # the DIO is processed within its RPL Instance (an instance is created
+    # along with its first DODAG)
+    instance = gv.instances.get(dio.instanceID)
+    if instance is None and not gv.instances.can_join(dio.instanceID):
+        logger.debug("RPL instance %d has no routing table of its own, dropping DIO" % dio.instanceID)
+        return
 
-    try:
-        dodag = gv.dodag_cache.get_dodag(dio.DODAGID, dio.version, dio.instanceID)[0]
-    except IndexError:
-        dodag = None
+    dodag = None
+    if instance:
+        try:
+            dodag = instance.dodag_cache.get_dodag(dio.DODAGID, dio.version)[0]
+        except IndexError:
+            pass
 
     if dodag and dodag.is_dodagRoot:
         logger.debug("This node is the DODAG Root for this DODAG, dropping DIO")
@@ -169,7 +167,7 @@ def handleDIO(interfaces, message):
     elif dodag:  # this is a DIO, from the same RPL Instance, DODAG ID, Version
         logger.debug("Updating information on an existing DODAG")
 
-        dodag.last_dio = time()
+        dodag.last_dio = dodag.scheduler.time()
 
         if dio.MOP != dodag.MOP:
             raise NotImplementedError("Change MOP on an existing DODAG is not implemented")
@@ -180,17 +178,18 @@ def handleDIO(interfaces, message):
 
         # if the rank is INFINITE_RANK, remove the source node from the parent
         # list (and from the neighbor set)
-        node = gv.neigh_cache.get_node(message.iface, message.src, dodag)
+        node = instance.neigh_cache.get_node(message.iface, message.src, dodag)
         if dio.rank == INFINITE_RANK and node:
             logger.debug("Node %s advertises a DIO message with infinite rank" % repr(Address(message.src)))
-            updated = gv.neigh_cache.remove_node_by_address(dodag, message.src)
+            updated = instance.neigh_cache.remove_node_by_address(dodag, message.src)
             if updated: consistent = False
             node = None
 
         # check if the node is a DIO parent and request its sub-DODAG to send DAO messages
-        if node and node.dtsn < dio.DTSN and node in gv.neigh_cache.get_parent_list():
+        if node and Lollipop(node.dtsn) < dio.DTSN and instance.neigh_cache.is_parent(node):
             logger.info("Parent %s has increased its DTSN field, scheduling a DAO message" % repr(Address(message.src)))
             dodag.downward_routes_reset()
+            dodag.resync_DAO()
             dodag.setDAOtimer()
             consistent = False
 
@@ -198,7 +197,7 @@ def handleDIO(interfaces, message):
     else:
         # we might have multiple older or newer versions of this DODAG still in
         # our cache
-        old_dodags = gv.dodag_cache.get_dodag(dio.DODAGID, instanceID=dio.instanceID)
+        old_dodags = gv.instances.get_dodag(dio.DODAGID, instanceID=dio.instanceID)
 
         try:
             if old_dodags[0].is_dodagRoot:
@@ -247,7 +246,7 @@ def handleDIO(interfaces, message):
                 dodag.last_PathSequence = deepcopy(most_recent_dodag.last_PathSequence)
             except NameError:
                 pass
-            gv.dodag_cache.add(dodag)
+            dodag.instance.dodag_cache.add(dodag)
             consistent = False
         else:
             logger.debug("DIO dropped")
@@ -260,6 +259,12 @@ def handleDIO(interfaces, message):
             return
 
 
+    instance = dodag.instance
+
+    # the DIO parent is only selected again when something changed
+    reselect = not consistent
+    refresh_candidates = False
+
     options = getAllOption(payload)
 
     logger.debug("DIO message contains the following options:")
@@ -267,6 +272,16 @@ def handleDIO(interfaces, message):
         logger.debug("- " + opt.__class__.__name__)
 
         if isinstance(opt, RPL_Option_DODAG_Configuration):
+            if opt.OCP != instance.of.OCP and not instance.set_objective_function(opt.OCP):
+                logger.debug("objective function %d is not supported, RPL instance %d keeps using objective function %d" % \
+                             (opt.OCP, instance.instanceID, instance.of.OCP))
+
+            # the sort keys of the neighbors depend on these parameters
+            if (opt.MinHopRankIncrease, opt.MaxRankIncrease, opt.OCP) != \
+               (dodag.MinHopRankIncrease, dodag.MaxRankIncrease, dodag.OCP):
+                reselect = True
+                refresh_candidates = opt.MinHopRankIncrease != dodag.MinHopRankIncrease
+
             dodag.authenticated = opt.A
             dodag.PCS = opt.PCS
             dodag.DIOIntDoublings = opt.DIOIntDoubl
@@ -324,12 +339,18 @@ def handleDIO(interfaces, message):
             # TODO
             pass
 
+    if refresh_candidates:
+        instance.neigh_cache.refresh_candidates(dodag)
+
     if dio.rank != INFINITE_RANK:
-        gv.neigh_cache.register_node(message.iface, message.src, dodag, dio.rank, dio.DTSN)
+        reselect |= instance.neigh_cache.register_node(message.iface, message.src, dodag, dio.rank, dio.DTSN)
 
     # update the DIO parent (the new parent could be from a different DODAG)
-    updated = gv.neigh_cache.update_DIO_parent()
-    if updated: consistent = False
+    if reselect:
+        # the DODAG parameters shown by the CLI might have changed as well
+        state_changed()
+        updated = instance.neigh_cache.update_DIO_parent()
+        if updated: consistent = False
 
     # if there is no DIO parent for this node, it must advertises an
     # INFINITE_RANK, so that it is not selected by its children
@@ -341,10 +362,10 @@ def handleDIO(interfaces, message):
 
     # if we moved to a new DODAG version, now is a good time to clean up old
     # versions
-    gv.dodag_cache.purge_old_versions()
+    instance.dodag_cache.purge_old_versions()
 
     # happen when all neighboring nodes send a poison DIO message
-    if gv.dodag_cache.is_empty():
+    if instance.dodag_cache.is_empty():
         return
 
     if dodag.rank < dodag.lowest_rank_advertized:
@@ -368,7 +389,7 @@ def handleDIS(interfaces, message):
     dis = DIS()
     payload = dis.parse(message.msg)
 
-    if gv.dodag_cache.is_empty():
+    if gv.instances.is_empty():
         logger.debug("Dropping DIS message: the node does not belong to any DODAG")
         return
 
@@ -400,23 +421,23 @@ def handleDIS(interfaces, message):
         logger.debug("DIS request is a multicast, "\
                       "sending DIO on all registered interfaces")
 
-        dodags = gv.dodag_cache.get_dodag(dodagID, version, instanceID)
+        dodags = gv.instances.get_dodag(dodagID, version, instanceID)
 
         for dodag in dodags:
             dodag.DIOtimer.hear_inconsistent()
 
     else:  # this is a unicast DIS
         if solicited_information:
-            dodags = gv.dodag_cache.get_dodag(dodagID, version, instanceID)
+            dodags = gv.instances.get_dodag(dodagID, version, instanceID)
             logger.debug("DIS request is unicast, with solicited information, "\
                           "sending unicast DIO(s)")
             for dodag in dodags:
                 dodag.sendDIO(message.iface, message.src)
-        else:  # this might not be in the RFC, but it makes sense to only send DIO from the active DODAG
+        else:  # this might not be in the RFC, but it makes sense to only send DIO from the active DODAGs
             logger.debug("DIS request is unicast, with no solicited information, "\
                           "sending unicast DIO")
-            dodag = gv.dodag_cache.get_active_dodag()
-            if dodag:
+            # (one DIO for each RPL Instance)
+            for dodag in gv.instances.get_active_dodags():
                 dodag.sendDIO(message.iface, message.src)
 
 
@@ -431,7 +452,8 @@ def handleDAO(interfaces, message):
     dao = DAO()
     payload = dao.parse(message.msg)
 
-    if gv.dodag_cache.is_empty() or dao.instanceID != gv.global_instanceID:
+    instance = gv.instances.get(dao.instanceID)
+    if instance is None or instance.dodag_cache.get_active_dodag() is None:
         logger.debug("Currently not participating in any DODAG for this instanceID, cannot process the DAO message")
         return
 
@@ -439,7 +461,7 @@ def handleDAO(interfaces, message):
         logger.debug("Multicast DAO message can not request an acknowledgment (K=1)")
         return
 
-    dodag = gv.dodag_cache.get_active_dodag()
+    dodag = instance.dodag_cache.get_active_dodag()
 
     # when D flag is set in the DAO, check that the DODAGID matches the current DODAG
     if dao.D and dodag.dodagID != dao.DODAGID:
@@ -475,8 +497,11 @@ def handleDAO(interfaces, message):
                 logger.debug("Path control different than 0 is not supported, dropping DAO message")
                 return
 
+            withdrawn_routes = []
             if opt.path_lifetime == 0:  # this is a No-Path DAO
-                route_updated += gv.route_cache.remove_routes(targets)
+                # the routes are withdrawn along with the filtered routes, so
+                # that an alternative route can replace them
+                withdrawn_routes = targets
                 for target in targets:
                     try:
                         dodag.downward_route_del(target)
@@ -484,16 +509,15 @@ def handleDAO(interfaces, message):
             elif opt.path_lifetime == 0xff:  # infinite lifetime
                 for target in targets: dodag.downward_route_add(target)
 
-            else:
-                logger.debug("Path lifetime that is not null or infinite is not supported")
-                return
+            else:  # lifetime is expressed in Lifetime Units
+                for target in targets:
+                    dodag.downward_route_add(target, opt.path_lifetime * dodag.LftUnit)
 
-            (removed_routes, new_routes) = dodag.get_filtered_downward_routes()
+            (removed_routes, new_routes) = dodag.take_route_changes()
             logger.debug("routes to be removed (%d):\n" % len(removed_routes) + repr(removed_routes))
             logger.debug("routes to be added (%d):\n" % len(new_routes) + repr(new_routes))
 
-            route_updated += gv.route_cache.remove_routes(removed_routes)
-            route_updated += gv.route_cache.add_routes(new_routes)
+            route_updated += instance.route_cache.update_routes(withdrawn_routes + removed_routes, new_routes)
 
     if dao.K:
         dodag.sendDAO_ACK(message.iface, message.src, dao.DAOsequence, dao.DODAGID)
@@ -510,7 +534,8 @@ def handleDAO_ACK(interfaces, message):
     dao_ack = DAO_ACK()
     payload = dao_ack.parse(message.msg)
 
-    if gv.dodag_cache.is_empty() or dao_ack.instanceID != gv.global_instanceID:
+    instance = gv.instances.get(dao_ack.instanceID)
+    if instance is None or instance.dodag_cache.is_empty():
         logger.debug("Currently not participating in any DODAG for this instanceID, cannot process the DAO-ACK message")
         return
 
@@ -519,21 +544,19 @@ def handleDAO_ACK(interfaces, message):
         return
 
     if dao_ack.D:
-        try:
-            dodag = gv.dodag_cache.get_dodag(dodagID=dao_ack.DODAGID, instanceID=dao_ack.instanceID)[-1]
-        except TypeError:
-            logger.debug("DAO-ACK message indicates a DODAG ID(%s) that does not match any recorded DODAG %(s), dropping it" % \
-                         (repr(Address(dao_ack.DODAGID)), repr(Address(dodag.dodagID))))
+        # the DAO was sent for the most recent version of the DODAG (older
+        # versions stay in the cache until they are purged)
+        dodag = instance.dodag_cache.get_latest_dodag(dao_ack.DODAGID, dao_ack.instanceID)
+        if dodag is None:
+            logger.debug("DAO-ACK message indicates a DODAG ID (%s) that does not match any recorded DODAG, dropping it" % \
+                         repr(Address(dao_ack.DODAGID)))
             return
     else:
-        dodag = gv.dodag_cache.get_active_dodag()
-
-    if dodag.DAO_ACK_source == message.src and \
-       dodag.last_DAOSequence == dao_ack.DAOSequence and \
-       dao_ack.Status == 0:
-        logger.debug("DAO-ACK message received from %s, disabling the DAO retransmission timer" % message.src)
-        dodag.DAO_trans_retry = 0
-        dodag.cancelDAO_ACKtimer()
+        dodag = instance.dodag_cache.get_active_dodag()
+
+    if dao_ack.Status == 0 and \
+       gv.pending_daos.acknowledge(message.src, dao_ack.DAOSequence, owner=dodag):
+        logger.debug("DAO-ACK message received from %s, disabling the DAO retransmission timer" % repr(Address(message.src)))
     else:
         logger.debug("DAO-ACK message does not match a previously sent DAO message")
 
@@ -547,7 +570,7 @@ def iface_listener(iface, RPL_socket):
     while True:
         (msg, source, destination, iface) = RPL_socket.receive()
         m = Message(msg, source, destination, iface)
-        sender.send(dumps(m))
+        sender.send(dumps(m, HIGHEST_PROTOCOL))
         del m
 
     print "shutting down listener on %s" % iface
@@ -582,3 +605,34 @@ def register_interfaces(iface_list):
     # RplSocket.dropCapabilities()
 
     return registered_iface
+
+
+def test_handleDAO_ACK_latest_version():
+    import socket
+    from instance import simulated_node
+
+    interfaces = simulated_node()
+    dodagID = socket.inet_pton(socket.AF_INET6, "2001:db8::1")
+    parent = socket.inet_pton(socket.AF_INET6, "fe80::1")
+
+    # during a global repair, the previous version stays in the cache until
+    # it is purged
+    old = DODAG(1, 240, 1, 2, 0, 240, dodagID, interfaces)
+    new = DODAG(1, 241, 1, 2, 0, 240, dodagID, interfaces)
+    dodag_cache = gv.instances.get(1).dodag_cache
+    dodag_cache.add(old)
+    dodag_cache.add(new)
+    assert len(dodag_cache.get_dodag(dodagID)) == 2
+
+    # a DAO-ACK that names the DODAG acknowledges the DAO of its latest version
+    acknowledged = []
+    gv.pending_daos.add(new, parent, "eth0", 7, lambda: None, lambda entry: None,
+                        acknowledged=acknowledged.append)
+    dao_ack = DAO_ACK(instanceID=1, D=1, DAOSequence=7, Status=0, DODAGID=dodagID)
+    handleDAO_ACK(interfaces, Message(str(dao_ack), parent, "fe80::2", "eth0"))
+    assert len(acknowledged) == 1 and len(gv.pending_daos) == 0
+
+    # and a DAO-ACK for an unknown DODAG is dropped
+    dao_ack = DAO_ACK(instanceID=1, D=1, DAOSequence=8, Status=0,
+                      DODAGID=socket.inet_pton(socket.AF_INET6, "2001:db8::2"))
+    handleDAO_ACK(interfaces, Message(str(dao_ack), parent, "fe80::2", "eth0"))
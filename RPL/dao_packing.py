@@ -0,0 +1,108 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+"""Packing of the DAO options into messages that fit in the MTU.
+
+A DAO is made of groups of RPL Target options, each group being followed by
+the Transit Information option that applies to it. When all the targets of a
+node do not fit in a single message, they are split over several DAO
+messages (segments). Each segment is a valid DAO on its own: a group that is
+cut in two gets a copy of its Transit Information option in both segments.
+Each segment has its own DAOSequence, hence it is acknowledged (and
+retransmitted) on its own."""
+
+# size of the IPv6 header that precedes the ICMPv6 message
+IPV6_HEADER_LENGTH = 40
+
+
+def pack_options(groups, budget):
+    """Split groups of options over as few segments as possible
+    - groups: list of (options, trailer), where options is a list of
+      serialized options and trailer the serialized option that follows them
+      (groups without any option are skipped)
+    - budget: size available for the options in a segment
+    Returns the list of segments, a segment being a list of (group, options)
+    where group is the index of a group and options the part of its options
+    the segment carries (see serialize_segment()).
+    An option that does not fit in an empty segment is sent alone."""
+    segments = []
+    current = []
+    used = 0
+
+    for (group, (options, trailer)) in enumerate(groups):
+        pending = []
+        length = used + len(trailer)
+        for option in options:
+            if length + len(option) > budget and (pending or current):
+                if pending:
+                    current.append((group, pending))
+                segments.append(current)
+                current = []
+                pending = []
+                length = len(trailer)
+            pending.append(option)
+            length += len(option)
+        if pending:
+            current.append((group, pending))
+            used = length
+
+    if current:
+        segments.append(current)
+    return segments
+
+
+def serialize_segment(segment, groups):
+    """Options of a segment returned by pack_options(), each part of a group
+    being followed by the trailer of the group"""
+    return "".join(["".join(options) + groups[group][1] for (group, options) in segment])
+
+
+def segment_budget(mtu, header_length):
+    """Size available for the options of a DAO whose (ICMPv6) header is
+    header_length bytes long"""
+    return mtu - IPV6_HEADER_LENGTH - header_length
+
+
+def test_pack_options():
+    targets = ["T%02d" % i for i in range(10)]  # 3 bytes per option
+    no_path = ["N%02d" % i for i in range(4)]
+    groups = [(targets, "tt"), (no_path, "nn")]
+
+    # everything fits in a single segment
+    segments = pack_options(groups, 100)
+    assert segments == [[(0, targets), (1, no_path)]]
+    assert serialize_segment(segments[0], groups) == "".join(targets) + "tt" + "".join(no_path) + "nn"
+
+    # empty groups are skipped
+    assert pack_options([([], "tt"), ([], "nn")], 100) == []
+    assert pack_options([([], "tt"), (no_path, "nn")], 100) == [[(1, no_path)]]
+
+    # each segment fits in the budget and repeats the trailer of its groups
+    segments = [serialize_segment(segment, groups) for segment in pack_options(groups, 11)]
+    assert all(len(segment) <= 11 for segment in segments)
+    assert segments[0] == "T00T01T02tt"
+    assert segments[3] == "T09ttN00nn"
+    assert segments[4] == "N01N02N03nn"
+    assert "".join(segments).replace("tt", "").replace("nn", "") == "".join(targets + no_path)
+    assert len(segments) == 5
+
+    # an option larger than the budget is sent alone
+    groups = [(["A", "BBBBBBBB", "C"], "t")]
+    assert [serialize_segment(segment, groups) for segment in pack_options(groups, 4)] == ["At", "BBBBBBBBt", "Ct"]
+
+    assert segment_budget(1280, 8) == 1232
@@ -0,0 +1,470 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""DAO scheduler: spreads the DAO messages of a (sub-)DODAG over time.
+
+After a global repair or a DTSN increase, all the nodes of a sub-DODAG want to
+send their DAO at about the same time. The DelayDAO timer is therefore made
+of a fixed part, a part that grows with the DAGRank of the node and a random
+jitter. Triggers that arrive while a DAO is already scheduled are coalesced
+into it, and no more than max_outstanding DAO messages per interface may wait
+for a DAO-ACK at any time (the others are delayed).
+
+DAO messages that wait for a DAO-ACK are recorded in a pending table, keyed by
+(parent, DAOSequence). They are retransmitted with an exponential backoff
+whose initial timeout is derived from the round trip times measured with the
+parent (as in RFC 6298), until the give-up policy decides what to do with the
+parent. The segments of a DAO that is split over several messages are
+acknowledged and retransmitted one by one, but they count as a single DAO
+against max_outstanding, and the DAO is given up once, as a whole."""
+
+from random import uniform
+import socket
+
+from rpl_constants import DEFAULT_DAO_DELAY, \
+                          DEFAULT_DAO_RANK_DELAY, \
+                          DEFAULT_DAO_JITTER, \
+                          DEFAULT_DAO_MAX_OUTSTANDING, \
+                          DEFAULT_DAO_ACK_DELAY, \
+                          DEFAULT_DAO_ACK_MIN_DELAY, \
+                          DEFAULT_DAO_ACK_MAX_DELAY, \
+                          DEFAULT_DAO_ACK_JITTER, \
+                          DEFAULT_DAO_MAX_TRANS_RETRY
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+class DAOScheduler(object):
+    def __init__(self, scheduler, delay=DEFAULT_DAO_DELAY, rank_delay=DEFAULT_DAO_RANK_DELAY,
+                 jitter=DEFAULT_DAO_JITTER, max_outstanding=DEFAULT_DAO_MAX_OUTSTANDING):
+        """DAO scheduler:
+        - scheduler: the Scheduler the DAO timers are armed on
+        - delay: fixed part of the DelayDAO timer (in seconds)
+        - rank_delay: additional delay per DAGRank unit (in seconds)
+        - jitter: upper bound of the random delay added to the timer (in seconds)
+        - max_outstanding: maximum number of DAO per interface waiting for a DAO-ACK"""
+        self.scheduler = scheduler
+        self.delay = delay
+        self.rank_delay = rank_delay
+        self.jitter = jitter
+        self.max_outstanding = max_outstanding
+        self.pending = {}  # key -> [timer, DAGRank, interface, function]
+        self.outstanding = {}  # interface -> number of DAO waiting for a DAO-ACK
+
+        # statistics
+        self.triggers = 0
+        self.coalesced = 0
+        self.deferred = 0
+        self.sent = 0
+
+
+    def compute_delay(self, rank):
+        """Delay before a node of the given DAGRank sends its DAO"""
+        return self.delay + self.rank_delay * rank + uniform(0, self.jitter)
+
+
+    def trigger(self, key, rank, function, iface=None):
+        """Schedule function (that sends the DAO messages for key) to be called
+        after the DelayDAO timer. If a DAO is already scheduled for key, the
+        trigger is coalesced into it.
+        - rank: DAGRank of the node
+        - iface: interface the DAO will be sent on (if known)
+        Returns True if a new DAO is scheduled"""
+        self.triggers += 1
+        try:
+            entry = self.pending[key]
+        except KeyError:
+            pass
+        else:
+            if entry[0].is_alive():
+                self.coalesced += 1
+                entry[1:] = [rank, iface, function]
+                return False
+
+        timer = self.scheduler.schedule(self.compute_delay(rank), self.__expired, key)
+        self.pending[key] = [timer, rank, iface, function]
+        return True
+
+
+    def cancel(self, key):
+        """Cancel the DAO scheduled for key (if any)"""
+        try:
+            entry = self.pending.pop(key)
+        except KeyError:
+            return
+        entry[0].cancel()
+
+
+    def is_pending(self, key):
+        try:
+            return self.pending[key][0].is_alive()
+        except KeyError:
+            return False
+
+
+    def __expired(self, key):
+        try:
+            (timer, rank, iface, function) = self.pending[key]
+        except KeyError:
+            return
+
+        if iface is not None and self.outstanding.get(iface, 0) >= self.max_outstanding:
+            logger.debug("too many DAO waiting for a DAO-ACK on %s, delaying the DAO" % iface)
+            self.deferred += 1
+            timer.reschedule(self.compute_delay(rank))
+            return
+
+        del self.pending[key]
+        self.sent += 1
+        function()
+
+
+    def acquire(self, iface):
+        """A DAO sent on iface now waits for a DAO-ACK"""
+        self.outstanding[iface] = self.outstanding.get(iface, 0) + 1
+
+
+    def release(self, iface):
+        """A DAO sent on iface no longer waits for a DAO-ACK"""
+        count = self.outstanding.get(iface, 0) - 1
+        if count > 0:
+            self.outstanding[iface] = count
+        else:
+            self.outstanding.pop(iface, None)
+
+
+    def get_stats(self):
+        """Return a text presentation of the DAO scheduling statistics"""
+        stats = "DAO triggers: %d\n" % self.triggers
+        stats += "triggers coalesced into a scheduled DAO: %d\n" % self.coalesced
+        stats += "DAO delayed because too many DAO-ACK were pending: %d\n" % self.deferred
+        stats += "DAO sent: %d\n" % self.sent
+        stats += "DAO waiting for a DAO-ACK: %s" % \
+                 (", ".join(["%s: %d" % (iface, count) for (iface, count) in sorted(self.outstanding.items())]) or "none")
+        return stats
+
+
+def printable_address(address):
+    """Printable form of a (binary) IPv6 address"""
+    try:
+        return socket.inet_ntop(socket.AF_INET6, address)
+    except (ValueError, socket.error):
+        return str(address)
+
+
+class PendingDAO(object):
+    """A DAO message that waits for a DAO-ACK"""
+
+    def __init__(self, owner, parent, iface, sequence, retransmit, give_up, sent, acknowledged=None):
+        self.owner = owner  # object that sent the DAO (the DODAG)
+        self.parent = parent
+        self.iface = iface
+        self.sequence = sequence
+        self.retransmit = retransmit  # function that sends the DAO again
+        self.give_up = give_up  # function called with the entry when the DAO is never acknowledged
+        self.acknowledged = acknowledged  # function called with the entry when the DAO is acknowledged
+        self.first_sent = sent
+        self.last_sent = sent
+        self.transmissions = 1
+        self.timer = None
+        self.segments = [self]  # pending entries of the DAO this entry is a segment of (shared)
+
+
+class PendingDAOTable(object):
+    def __init__(self, scheduler, dao_scheduler=None, initial_timeout=DEFAULT_DAO_ACK_DELAY,
+                 min_timeout=DEFAULT_DAO_ACK_MIN_DELAY, max_timeout=DEFAULT_DAO_ACK_MAX_DELAY,
+                 jitter=DEFAULT_DAO_ACK_JITTER, max_transmissions=DEFAULT_DAO_MAX_TRANS_RETRY):
+        """Pending DAO table:
+        - scheduler: the Scheduler the retransmission timers are armed on
+        - dao_scheduler: DAOScheduler that is told how many DAO wait for a
+          DAO-ACK on each interface (optional)
+        - initial_timeout: retransmission timeout used until a round trip time
+          has been measured with the parent (in seconds)
+        - min_timeout, max_timeout: bounds of the retransmission timeout
+        - jitter: relative jitter applied to the retransmission timeout
+        - max_transmissions: number of transmissions before giving up"""
+        self.scheduler = scheduler
+        self.dao_scheduler = dao_scheduler
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.jitter = jitter
+        self.max_transmissions = max_transmissions
+        self.pending = {}  # (parent, DAOSequence) -> PendingDAO
+        self.rtt = {}  # parent -> [SRTT, RTTVAR]
+
+        # statistics
+        self.acknowledged = 0
+        self.retransmissions = 0
+        self.give_ups = 0
+
+
+    def timeout(self, parent):
+        """Retransmission timeout (before backoff) for a parent"""
+        try:
+            (srtt, rttvar) = self.rtt[parent]
+        except KeyError:
+            return self.initial_timeout
+        return max(self.min_timeout, min(self.max_timeout, srtt + 4 * rttvar))
+
+
+    def __backoff(self, entry):
+        """Timeout before the next retransmission of the entry"""
+        timeout = min(self.max_timeout, self.timeout(entry.parent) * 2 ** (entry.transmissions - 1))
+        return timeout * uniform(1 - self.jitter, 1 + self.jitter)
+
+
+    def add(self, owner, parent, iface, sequence, retransmit, give_up, supersede=True, acknowledged=None,
+            segment_of=None):
+        """Record a DAO that has just been sent to parent and waits for a DAO-ACK
+        - owner: object that sent the DAO
+        - retransmit: function called to send the DAO again
+        - give_up: function called with the entry once the DAO has been sent
+          max_transmissions times without being acknowledged
+        - supersede: the DAO replaces the DAO of the same owner that are still pending
+        - acknowledged: function called with the entry when a DAO-ACK is
+          received for the DAO (optional)
+        - segment_of: pending entry of the first segment, when the DAO is a
+          further segment of the same DAO (optional)"""
+        if supersede:
+            self.cancel_owner(owner)
+        else:
+            self.cancel(parent, sequence)
+
+        entry = PendingDAO(owner, parent, iface, sequence, retransmit, give_up, self.scheduler.time(), acknowledged)
+        entry.timer = self.scheduler.schedule(self.__backoff(entry), self.__expired, entry)
+        self.pending[(parent, sequence)] = entry
+        if segment_of is not None and segment_of.segments:
+            # the segments of a DAO wait for their DAO-ACK together
+            assert segment_of.iface == iface
+            entry.segments = segment_of.segments
+            entry.segments.append(entry)
+        elif self.dao_scheduler:
+            self.dao_scheduler.acquire(iface)
+        return entry
+
+
+    def __remove(self, entry):
+        del self.pending[(entry.parent, entry.sequence)]
+        entry.timer.cancel()
+        entry.segments.remove(entry)
+        # the DAO stops waiting for a DAO-ACK with its last segment
+        if self.dao_scheduler and not entry.segments:
+            self.dao_scheduler.release(entry.iface)
+
+
+    def cancel(self, parent, sequence):
+        """Forget about a pending DAO"""
+        try:
+            entry = self.pending[(parent, sequence)]
+        except KeyError:
+            return
+        self.__remove(entry)
+
+
+    def cancel_owner(self, owner):
+        """Forget about all the pending DAO of an owner"""
+        for entry in [entry for entry in self.pending.values() if entry.owner is owner]:
+            self.__remove(entry)
+
+
+    def get_owner(self, owner):
+        """Return the pending DAO of an owner"""
+        return [entry for entry in self.pending.values() if entry.owner is owner]
+
+
+    def acknowledge(self, parent, sequence, owner=None):
+        """Process a DAO-ACK received from parent.
+        Returns True if it matches a pending DAO (of owner, if specified)"""
+        try:
+            entry = self.pending[(parent, sequence)]
+        except KeyError:
+            return False
+        if owner is not None and entry.owner is not owner:
+            return False
+
+        # round trip times are only measured on DAO that were sent once
+        # (Karn's algorithm)
+        if entry.transmissions == 1:
+            self.__sample(parent, self.scheduler.time() - entry.first_sent)
+
+        self.acknowledged += 1
+        self.__remove(entry)
+        if entry.acknowledged:
+            entry.acknowledged(entry)
+        return True
+
+
+    def __sample(self, parent, rtt):
+        """Update the round trip time estimation of a parent (RFC 6298)"""
+        try:
+            (srtt, rttvar) = self.rtt[parent]
+        except KeyError:
+            self.rtt[parent] = [rtt, rtt / 2]
+            return
+        rttvar = 0.75 * rttvar + 0.25 * abs(srtt - rtt)
+        srtt = 0.875 * srtt + 0.125 * rtt
+        self.rtt[parent] = [srtt, rttvar]
+
+
+    def forget_parent(self, parent):
+        """Drop the round trip time estimation of a parent"""
+        self.rtt.pop(parent, None)
+
+
+    def __expired(self, entry):
+        if self.pending.get((entry.parent, entry.sequence)) is not entry:
+            return
+
+        if entry.transmissions >= self.max_transmissions:
+            logger.info("DAO %d has not been acknowledged after %d transmissions, giving up" % (entry.sequence, entry.transmissions))
+            self.give_ups += 1
+            # the other segments of the DAO are given up along with it
+            for segment in list(entry.segments):
+                self.__remove(segment)
+            entry.give_up(entry)
+            return
+
+        entry.transmissions += 1
+        entry.last_sent = self.scheduler.time()
+        self.retransmissions += 1
+        entry.timer.reschedule(self.__backoff(entry))
+        entry.retransmit()
+
+
+    def __len__(self):
+        return len(self.pending)
+
+
+    def get_stats(self):
+        """Return a text presentation of the DAO-ACK statistics"""
+        stats = "DAO acknowledged: %d\n" % self.acknowledged
+        stats += "DAO retransmissions: %d\n" % self.retransmissions
+        stats += "DAO given up: %d\n" % self.give_ups
+        stats += "pending DAO: %d" % len(self.pending)
+        for entry in sorted(self.pending.values(), key=lambda entry: entry.first_sent):
+            stats += "\n  parent %s on %s, DAOSequence %d, %d transmission(s)" % \
+                     (printable_address(entry.parent), entry.iface, entry.sequence, entry.transmissions)
+        for (parent, (srtt, rttvar)) in self.rtt.items():
+            stats += "\nparent %s: SRTT %f, RTTVAR %f, timeout %f" % \
+                     (printable_address(parent), srtt, rttvar, self.timeout(parent))
+        return stats
+
+
+def test_dao_scheduler():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(VirtualClock())
+    dao = DAOScheduler(scheduler, delay=1, rank_delay=1, jitter=0.5, max_outstanding=1)
+    sent = []
+
+    # triggers within the window are coalesced
+    assert dao.trigger("a", 2, lambda: sent.append(("a", scheduler.time())), "eth0")
+    assert not dao.trigger("a", 2, lambda: sent.append(("a", scheduler.time())), "eth0")
+    assert dao.trigger("b", 0, lambda: sent.append(("b", scheduler.time())), "eth1")
+    scheduler.run_for(10)
+    assert [key for (key, when) in sent] == ["b", "a"]
+    assert 1 <= sent[0][1] <= 1.5
+    assert 3 <= sent[1][1] <= 3.5
+    assert dao.coalesced == 1
+
+    # a DAO is delayed while the interface has too many DAO-ACK pending
+    del sent[:]
+    dao.acquire("eth0")
+    dao.trigger("a", 0, lambda: sent.append("a"), "eth0")
+    scheduler.run_for(2)
+    assert sent == [] and dao.deferred >= 1
+    dao.release("eth0")
+    scheduler.run_for(2)
+    assert sent == ["a"]
+
+    dao.trigger("a", 0, lambda: sent.append("a"), "eth0")
+    dao.cancel("a")
+    scheduler.run_for(10)
+    assert sent == ["a"]
+
+
+def test_pending_dao_table():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(VirtualClock())
+    dao = DAOScheduler(scheduler)
+    table = PendingDAOTable(scheduler, dao, initial_timeout=1, min_timeout=0.1,
+                            max_timeout=8, jitter=0, max_transmissions=4)
+    sent = []
+    given_up = []
+    owner = object()
+
+    # retransmissions back off exponentially, then the table gives up
+    table.add(owner, "p1", "eth0", 10, lambda: sent.append(scheduler.time()), given_up.append)
+    assert dao.outstanding == {"eth0": 1}
+    scheduler.run_for(100)
+    assert sent == [1, 3, 7]
+    assert len(given_up) == 1 and given_up[0].sequence == 10
+    assert dao.outstanding == {}
+
+    # the round trip time is measured on DAO sent only once
+    table.add(owner, "p1", "eth0", 11, lambda: None, given_up.append)
+    scheduler.run_for(0.2)
+    assert not table.acknowledge("p1", 11, owner=object())
+    assert table.acknowledge("p1", 11, owner=owner)
+    assert not table.acknowledge("p1", 11)
+    assert abs(table.rtt["p1"][0] - 0.2) < 1e-9
+    assert abs(table.timeout("p1") - 0.6) < 1e-9
+
+    table.add(owner, "p1", "eth0", 12, lambda: None, given_up.append)
+    scheduler.run_for(0.7)
+    assert table.acknowledge("p1", 12)
+    assert abs(table.rtt["p1"][0] - 0.2) < 1e-9
+
+    # a new DAO supersedes the pending DAO of the same owner
+    table.add(owner, "p1", "eth0", 13, lambda: None, given_up.append)
+    table.add(owner, "p2", "eth0", 14, lambda: None, given_up.append)
+    assert len(table) == 1
+    assert dao.outstanding == {"eth0": 1}
+    table.cancel_owner(owner)
+    assert len(table) == 0 and dao.outstanding == {}
+
+    # the segments of a DAO are acknowledged on their own, but count as a
+    # single DAO waiting for a DAO-ACK
+    acknowledged = []
+    first = table.add(owner, "p1", "eth0", 15, lambda: None, given_up.append, acknowledged=acknowledged.append)
+    table.add(owner, "p1", "eth0", 16, lambda: None, given_up.append, supersede=False,
+              acknowledged=acknowledged.append, segment_of=first)
+    assert len(table) == 2 and dao.outstanding == {"eth0": 1}
+    assert table.acknowledge("p1", 16)
+    assert [entry.sequence for entry in acknowledged] == [16]
+    assert len(table) == 1 and dao.outstanding == {"eth0": 1}
+    assert table.acknowledge("p1", 15)
+    assert len(table) == 0 and dao.outstanding == {}
+
+    # and the DAO is given up once, along with all its segments
+    del given_up[:]
+    give_ups = table.give_ups
+    first = table.add(owner, "p1", "eth0", 17, lambda: None, given_up.append)
+    scheduler.run_for(0.1)
+    for sequence in (18, 19):
+        table.add(owner, "p1", "eth0", sequence, lambda: None, given_up.append, supersede=False, segment_of=first)
+    scheduler.run_for(100)
+    assert [entry.sequence for entry in given_up] == [17]
+    assert table.give_ups == give_ups + 1
+    assert len(table) == 0 and dao.outstanding == {}
@@ -0,0 +1,116 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""DIS scheduler: solicits DIO messages while the node has not joined any DODAG.
+
+The first DIS messages are sent quickly (within DEFAULT_DIS_INITIAL_INTERVAL,
+with some jitter so that nodes that boot together do not send them at the
+same time), then the interval doubles up to DEFAULT_INTERVAL_BETWEEN_DIS. The
+solicitation stops once a DODAG is known and starts again (quickly) when the
+DODAG cache becomes empty."""
+
+from random import uniform
+
+from rpl_constants import DEFAULT_DIS_INITIAL_INTERVAL, \
+                          DEFAULT_INTERVAL_BETWEEN_DIS
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+class DISScheduler(object):
+    def __init__(self, scheduler, send, initial_interval=DEFAULT_DIS_INITIAL_INTERVAL,
+                 max_interval=DEFAULT_INTERVAL_BETWEEN_DIS):
+        """DIS scheduler:
+        - scheduler: the Scheduler the timer is armed on
+        - send: function that broadcasts a DIS message
+        - initial_interval: interval before the first DIS message (in seconds)
+        - max_interval: maximum interval between two DIS messages (in seconds)"""
+        self.scheduler = scheduler
+        self.send = send
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.interval = initial_interval
+        self.timer = None
+        self.sent = 0
+
+
+    def is_running(self):
+        return self.timer is not None and self.timer.is_alive()
+
+
+    def start(self):
+        """Start soliciting DIO messages (does nothing if it is already the case)"""
+        if self.is_running():
+            return
+        logger.debug("starting DIS solicitation")
+        self.interval = self.initial_interval
+        self.__arm()
+
+
+    def stop(self):
+        """Stop soliciting DIO messages"""
+        if self.is_running():
+            logger.debug("stopping DIS solicitation")
+            self.timer.cancel()
+
+
+    def __arm(self):
+        delay = uniform(self.interval / 2, self.interval)
+        if self.timer:
+            self.timer.reschedule(delay)
+        else:
+            self.timer = self.scheduler.schedule(delay, self.__expired)
+
+
+    def __expired(self):
+        self.sent += 1
+        self.send()
+        self.interval = min(self.interval * 2, self.max_interval)
+        self.__arm()
+
+
+def test_dis_scheduler():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(VirtualClock())
+    sent = []
+    dis = DISScheduler(scheduler, lambda: sent.append(scheduler.time()),
+                       initial_interval=0.5, max_interval=8)
+    dis.start()
+    dis.start()
+    scheduler.run_for(0.5)
+    assert len(sent) == 1 and 0.25 <= sent[0] <= 0.5
+
+    # the interval doubles up to max_interval
+    scheduler.run_for(100)
+    gaps = [b - a for (a, b) in zip(sent, sent[1:])]
+    assert max(gaps) <= 8 + 4
+    assert len(sent) >= 100 / 8
+
+    dis.stop()
+    count = len(sent)
+    scheduler.run_for(100)
+    assert len(sent) == count
+
+    # a restart solicits DIO messages quickly again
+    dis.start()
+    scheduler.run_for(0.5)
+    assert len(sent) == count + 1
@@ -22,7 +22,7 @@ Defines a DODAG object that represent a single DODAG version.
 Also defines a DODAG cache that stores multiple DODAGs belonging to a same RPL instance.
 """
 
-from trickle import trickleTimer
+from trickle import trickleTimer, adapt_redundancy_constant
 from rpl_constants import INFINITE_RANK, \
                           ROOT_RANK, \
                           DEFAULT_PATH_CONTROL_SIZE, \
@@ -31,26 +31,28 @@ from rpl_constants import INFINITE_RANK, \
                           DEFAULT_DIO_REDUNDANCY_CONSTANT, \
                           DEFAULT_MIN_HOP_RANK_INCREASE, \
                           DEFAULT_MAX_RANK_INCREASE, \
-                          DEFAULT_DAO_DELAY, \
-                          DEFAULT_DAO_ACK_DELAY, \
-                          DEFAULT_DAO_MAX_TRANS_RETRY, \
-                          DEFAULT_DAO_NO_PATH_TRANS
+                          DEFAULT_DAO_NO_PATH_TRANS, \
+                          DEFAULT_DAO_REFRESH_INTERVAL, \
+                          DEFAULT_NEIGHBOR_LIFETIME_INTERVALS
 
 from tools import broadcast, ALL_RPL_NODES
+from dao_packing import pack_options, serialize_segment, segment_budget
+from prefix_trie import aggregate_targets
+from route_index import DownwardRouteIndex
 from icmp import DAO, DAO_ACK, DIO, RPL_Option_DODAG_Configuration, RPL_Option_Prefix_Information, \
                  RPL_Option_Transit_Information, RPL_Option_RPL_Target
 import global_variables as gv
 from address import Address
 from lollipop import Lollipop
 from route_cache import Route
+from snapshot import state_changed
 
 from threading import RLock
+from collections import OrderedDict
 from functools import partial
-import of_zero as of
 from math import floor
 import time
 import socket
-from threading import Timer
 
 import logging
 logger = logging.getLogger("RPL")
@@ -87,33 +89,47 @@ class DODAG(object):
     def __init__(self, instanceID, version, \
                  G, MOP, Prf, DTSN, \
                  dodagID, \
-                 interfaces, advertised_prefixes=[], active=False, is_root=False):
+                 interfaces, advertised_prefixes=[], active=False, is_root=False,
+                 scheduler=None):
         # TODO:
         # - remove timer (not sure what it actually does)
         #   (expiry may trigger No-Path advertisements or immediately deallocate
         #   the DAO entry if no DAO parents exists)
         self.__lock               = RLock()
+        # timers (and the clock) of this DODAG
+        # (an idle Scheduler has a length of 0, hence the explicit test)
+        self.scheduler            = scheduler if scheduler is not None else gv.scheduler
         self.instanceID           = instanceID
-        self.version              = Lollipop(version)
+        # state of the RPL Instance (neighbors, routes, objective function)
+        self.instance             = gv.instances.get_or_create(instanceID)
+        self.__version            = Lollipop(version)
         self.dodagID              = dodagID
         self.G                    = G
         self.MOP                  = MOP
         self.Prf                  = Prf
         self.DTSN                 = Lollipop(DTSN)
-        self.active               = active
+        self.__active             = active
         self.advertised_prefixes  = advertised_prefixes
         self.last_DAOSequence     = Lollipop()  # used during DAO - DAO_ACK exchanges
         self.last_PathSequence    = Lollipop()
-        self.DAO_ACK_source       = None
-        self.DAO_ACK_source_iface = None
-        self.DAO_trans_retry      = 0
         self.downward_routes      = set()  # set of tuple in the form of (destination, prefix_len, prefix)
+        self.route_lifetimes      = {}  # downward routes with a finite path lifetime -> timing wheel entry
+        # the downward routes are indexed so that the best route to a target
+        # is selected again only when the candidate routes to this target change
+        self.__route_index        = self.__new_route_index()
         self.preferred_parent     = None
+        self.heard_dio_average    = None  # moving average of the consistent DIOs heard per interval
 
         # cleanup purposes
         self.no_path_routes       = set()  # store the routes for which we received a No-Path DAO
         self.no_path_routes_trans = 0  # how many times the No-Path DAO have been transmitted
 
+        # targets the DAO parent acknowledged, only the changes are advertised
+        self.__dao_parent         = None  # DAO parent the acknowledged targets refer to
+        self.__dao_acked_targets  = set()
+        self.__dao_resync         = True  # the next DAO advertises all the targets
+        self.__last_full_DAO      = None  # time of the last DAO that advertised all the targets
+
         self.interfaces = interfaces
         if is_root:
             self.is_dodagRoot = True
@@ -126,11 +142,10 @@ class DODAG(object):
         else:
             self.rank = INFINITE_RANK
 
-        # import objective function related function
-        self.compute_rank_increase = partial(of.compute_rank_increase, self)
-        self.OCP                   = of.OCP
+        # objective function of the RPL Instance
+        self.OCP                   = self.instance.of.OCP
 
-        self.last_dio = time.time()
+        self.last_dio = self.scheduler.time()
 
         self.setDIOtimer()
 
@@ -192,14 +207,20 @@ class DODAG(object):
     def sendDAO(self, iface=None, destination=None, retransmit=False, nopath=False):
         """Send a DAO message to its DAO parent (by default)
         Build the target list on the fly
-        nopath parameters indicates that the node must announce all its downward routes as no-path"""
+        nopath parameters indicates that the node must announce all its downward routes as no-path
+        When the targets do not fit in a single message (see gv.dao_mtu), they
+        are split over several DAO messages, each with its own DAOSequence,
+        that are acknowledged and retransmitted independently (but given up
+        together)
+        A DAO parent is only told about the targets that changed since the
+        targets it acknowledged (new targets, and No-Path for the removed
+        ones). All the targets are advertised again periodically, when the DAO
+        parent changes and when it increases its DTSN (see resync_DAO())"""
 
         assert self.active or nopath
 
         logger.info("sending DAO message for %s (version %d)" % (repr(Address(self.dodagID)), self.version.get_val()))
 
-        if not retransmit: self.last_DAOSequence += 1
-
         # if no destination is specified, find the DAO parent
         if not destination:
             # here, destination is None if no DAO parent exists
@@ -212,72 +233,152 @@ class DODAG(object):
                 iface = None
             assert destination != ALL_RPL_NODES
 
-        # build the RPL Target Options for the addresses allocated on the node
-        targets_opt = "".join([str(RPL_Option_RPL_Target(prefix_len=128, target_prefix=str(Address(address))))
-                               for (address, pref_len, nh_iface) in gv.address_cache])
-
-        # the Parent Address field is not needed because the node is in Storing Mode
-        transit_inf_opt = str(RPL_Option_Transit_Information(path_control=0,
-                                                             path_sequence=self.last_PathSequence.get_val(),
-                                                             path_lifetime=0x00 if nopath else self.DftLft,
-                                                             parent_address=""))
-
-        no_path_targets_opt = ""
-        no_path_transit_inf_opt = ""
+        # targets for the addresses allocated on the node
+        targets = set([repr(Address(address)) + "/128" for (address, pref_len, nh_iface) in gv.address_cache])
+        no_path_targets = set()
+        acknowledged = None
 
         if destination and Address(destination).is_RPL_all_nodes():
             logger.debug("sending DAO message to All-RPL-Nodes multicast address: %s" % destination)
-
-            DAO_header = str(DAO(instanceID=self.instanceID, K=0, DAOsequence=self.last_DAOSequence.get_val(), \
-                            DODAGID=self.dodagID))
+            K = 0
 
         elif destination and Address(destination).is_linklocal():
-            # because the K flag is set, we set a timer for receiving a DAO-ACK
-            self.DAO_ACK_source = destination
-            self.DAO_ACK_source_iface = iface
-            self.setDAO_ACKtimer()
-
             logger.debug("sending DAO message to a Link-Local address: %s" % destination)
-            DAO_header = str(DAO(instanceID=self.instanceID, K=1, DAOsequence=self.last_DAOSequence.get_val(), \
-                            DODAGID=self.dodagID))
+            # because the K flag is set, each DAO is retransmitted until a
+            # DAO-ACK is received (a new DAO replaces the pending ones)
+            K = 1
 
             with self.__lock:
-                # build the RPL Target Options from the list of downward routes
-                targets = [tuple(route.target.split("/")) for route in self.downward_routes]
-                targets_opt += "".join([str(RPL_Option_RPL_Target(prefix_len=int(preflen), target_prefix=str(Address(prefix))))
-                                        for (prefix, preflen) in targets])
+                # targets from the list of downward routes
+                targets.update([route.target for route in self.downward_routes])
 
                 if self.no_path_routes_trans < DEFAULT_DAO_NO_PATH_TRANS and self.no_path_routes:
                     logger.debug("advertising additional routes that need to be removed")
                     self.no_path_routes_trans += 1
 
                     # there is no need to propagate the No-Path information when an alternative path exists locally
-                    reachable_targets = set([route.target for route in self.downward_routes])
-                    no_path_targets = [tuple(route.target.split("/")) for route in self.no_path_routes if route.target not in reachable_targets]
+                    no_path_targets = set([route.target for route in self.no_path_routes if route.target not in targets])
+                else:
+                    self.no_path_routes = set()
 
-                    if no_path_targets:
-                        no_path_targets_opt = "".join([str(RPL_Option_RPL_Target(prefix_len=int(preflen), target_prefix=str(Address(prefix))))
-                                                for (prefix, preflen) in no_path_targets])
+                if gv.aggregate_routes:
+                    targets = set(aggregate_targets(targets))
 
-                        no_path_transit_inf_opt = str(RPL_Option_Transit_Information(path_control=0,
-                                                                                    path_sequence=self.last_PathSequence.get_val(),
-                                                                                    path_lifetime=0x00,
-                                                                                    parent_address=""))
+                if nopath:
+                    self.__dao_resync = True
+                elif self.__full_DAO_due(destination):
+                    logger.debug("advertising all the targets to the DAO parent")
+                    no_path_targets |= self.__dao_acked_targets - targets
+                    self.__last_full_DAO = self.scheduler.time()
+                    acknowledged = partial(self.DAO_acknowledged, destination)
                 else:
-                    self.no_path_routes = set()
+                    no_path_targets |= self.__dao_acked_targets - targets
+                    targets -= self.__dao_acked_targets
+                    if not targets and not no_path_targets:
+                        logger.debug("the DAO parent acknowledged all the targets already, no DAO is needed")
+                        return
+                    acknowledged = partial(self.DAO_acknowledged, destination)
         else:
             logger.debug("destination address %s is not a Link-Local address or a Multicast address, dropping command" % destination)
             return
 
+        targets = sorted(targets)
+        no_path_targets = sorted(no_path_targets)
+        targets_opt = [self.__target_option(target) for target in targets]
+        no_path_targets_opt = [self.__target_option(target) for target in no_path_targets]
+        target_of = dict(zip(targets_opt + no_path_targets_opt, targets + no_path_targets))
+
+        # the Parent Address field is not needed because the node is in Storing Mode
+        transit_inf_opt = str(RPL_Option_Transit_Information(path_control=0,
+                                                             path_sequence=self.last_PathSequence.get_val(),
+                                                             path_lifetime=0x00 if nopath else self.DftLft,
+                                                             parent_address=""))
+
         if nopath:
-            DAO_message = DAO_header + targets_opt + no_path_targets_opt + transit_inf_opt
+            groups = [(targets_opt + no_path_targets_opt, transit_inf_opt)]
         else:
-            DAO_message = DAO_header + targets_opt + transit_inf_opt + no_path_targets_opt + no_path_transit_inf_opt
+            no_path_transit_inf_opt = str(RPL_Option_Transit_Information(path_control=0,
+                                                                         path_sequence=self.last_PathSequence.get_val(),
+                                                                         path_lifetime=0x00,
+                                                                         parent_address=""))
+            groups = [(targets_opt, transit_inf_opt), (no_path_targets_opt, no_path_transit_inf_opt)]
+
+        header_length = len(str(DAO(instanceID=self.instanceID, K=K, DODAGID=self.dodagID)))
+        # a DAO without any target still carries the Transit Information option
+        segments = pack_options(groups, segment_budget(gv.dao_mtu, header_length)) or [[(0, [])]]
+        if len(segments) > 1:
+            logger.debug("targets are split over %d DAO messages" % len(segments))
+
+        first_segment = None
+        for (index, segment) in enumerate(segments):
+            if index or not retransmit: self.last_DAOSequence += 1
+            sequence = self.last_DAOSequence.get_val()
+            DAO_message = str(DAO(instanceID=self.instanceID, K=K, DAOsequence=sequence, DODAGID=self.dodagID)) + \
+                          serialize_segment(segment, groups)
+
+            if K:
+                # only the segments that are not acknowledged are sent again
+                if acknowledged:
+                    added = [target_of[option] for (group, options) in segment if group == 0 for option in options]
+                    withdrawn = [target_of[option] for (group, options) in segment if group == 1 for option in options]
+                    on_ack = partial(acknowledged, added, withdrawn)
+                else:
+                    on_ack = None
+                entry = gv.pending_daos.add(self, destination, iface, sequence,
+                                            partial(self.interfaces[iface].send, destination, DAO_message),
+                                            self.DAO_ACK_give_up, supersede=(index == 0), acknowledged=on_ack,
+                                            segment_of=first_segment)
+                first_segment = first_segment or entry
+
+            if iface and destination:
+                self.interfaces[iface].send(destination, DAO_message)
+            else:
+                broadcast(self.interfaces, DAO_message)
 
-        if iface and destination:
-            self.interfaces[iface].send(destination, DAO_message)
-        else:
-            broadcast(self.interfaces, DAO_message)
+
+    @staticmethod
+    def __target_option(target):
+        """RPL Target option for a target (in the prefix/prefix length form)"""
+        (prefix, preflen) = target.split("/")
+        return str(RPL_Option_RPL_Target(prefix_len=int(preflen), target_prefix=str(Address(prefix))))
+
+
+    def __full_DAO_due(self, parent):
+        """Check if the next DAO to parent must advertise all the targets.
+        The acknowledged targets are forgotten when the DAO parent changes or
+        when a resynchronization is requested"""
+        if parent != self.__dao_parent or self.__dao_resync:
+            self.__dao_parent = parent
+            self.__dao_acked_targets = set()
+            self.__dao_resync = False
+            return True
+        return self.__last_full_DAO is None or \
+               self.scheduler.time() - self.__last_full_DAO >= self.DAO_refresh_interval()
+
+
+    def DAO_refresh_interval(self):
+        """Time after which all the targets are advertised again: the routes
+        must be refreshed before their path lifetime expires on the parent"""
+        if self.DftLft == 0xff:  # infinite lifetime
+            return DEFAULT_DAO_REFRESH_INTERVAL
+        return min(DEFAULT_DAO_REFRESH_INTERVAL, self.DftLft * self.LftUnit / 2.0)
+
+
+    def DAO_acknowledged(self, parent, added, withdrawn, entry):
+        """Called when a DAO (segment) is acknowledged: the parent knows about
+        its targets and has removed its No-Path targets"""
+        with self.__lock:
+            if parent != self.__dao_parent:
+                return
+            self.__dao_acked_targets.difference_update(withdrawn)
+            self.__dao_acked_targets.update(added)
+
+
+    def resync_DAO(self):
+        """The next DAO advertises all the targets again (e.g. because the DAO
+        parent increased its DTSN and may have lost its downward routes)"""
+        with self.__lock:
+            self.__dao_resync = True
 
 
     def sendTwoDAOs(self):
@@ -318,92 +419,157 @@ class DODAG(object):
         self.DIOtimer = trickleTimer(self.sendDIO, {}, \
                                          Imin=0.001 * 2 ** self.DIOIntMin, \
                                          Imax=self.DIOIntDoublings, \
-                                         k=self.DIORedundancyConst)
+                                         k=self.DIORedundancyConst, \
+                                         scheduler=self.scheduler, \
+                                         adapt=gv.adaptive_redundancy and self.adapt_redundancy or None)
         self.DIOtimer.start()
 
 
-    def setDAOtimer(self):
-        """Set the DAO timer, ignore new calls when timer is armed.
-        This function ensures that DAO messages is sent after the DEFAULT_DAO_DELAY seconds (so
-        that more routes could be aggregated)
-        """
-        try:
-            if not self.DAOtimer.is_alive():
-                self.DAOtimer = Timer(DEFAULT_DAO_DELAY, self.sendTwoDAOs)
-            else:
-                return
-        except AttributeError:
-            self.DAOtimer = Timer(DEFAULT_DAO_DELAY, self.sendTwoDAOs)
-
-        self.DAOtimer.start()
+    def adapt_redundancy(self, timer, heard):
+        """Compute the redundancy constant (k) of the DIO trickle timer for the
+        next interval.
+        The neighborhood density is estimated from the number of neighbors in
+        this DODAG and from the consistent DIOs heard per interval. k is scaled
+        down when the neighborhood is denser than what the configured k is
+        meant for (redundant DIOs are suppressed more often), and up when it
+        is sparser (DIOs are less likely to be suppressed, which speeds up
+        convergence). k moves by one step per interval, within the bounds set
+        on the command line."""
+        (k_min, k_max) = gv.adaptive_redundancy
+
+        # k = 0 means that suppression is disabled
+        if self.DIORedundancyConst == 0:
+            return timer.k
+
+        if self.heard_dio_average is None:
+            self.heard_dio_average = float(heard)
+        else:
+            self.heard_dio_average = 0.75 * self.heard_dio_average + 0.25 * heard
 
+        density = max(self.instance.neigh_cache.count_neighbors(self), self.heard_dio_average)
+        return adapt_redundancy_constant(timer.k, self.DIORedundancyConst, density, k_min, k_max)
 
-    def setDAO_ACKtimer(self):
-        """Set the DAO ack timer, to retransmit DAO when it is not acknowledged in a timely fashion"""
 
-        self.cancelDAO_ACKtimer()
+    def setDAOtimer(self):
+        """Set the DAO timer, calls that arrive while the timer is armed are
+        coalesced into it.
+        The DAO scheduler sends the DAO messages after a delay that depends on
+        the rank of the node (plus some jitter), so that more routes can be
+        aggregated and the nodes of a sub-DODAG do not all send their DAO at
+        the same time"""
+        if self.rank == INFINITE_RANK:
+            rank = 0
+        else:
+            rank = self.DAGRank(self.rank)
+        parent = self.preferred_parent
+        gv.dao_scheduler.trigger(self, rank, self.sendTwoDAOs, parent and parent.iface or None)
 
-        if self.DAO_trans_retry >= DEFAULT_DAO_MAX_TRANS_RETRY:
-            self.DAO_trans_retry = 0
 
-            # the destination (self.DAO_ACK_source) seems unreachable
-            # hence, it should be removed, and if it was the DIO parent, a new
-            # DIO parent must be found
-            gv.neigh_cache.remove_node_by_address(self, self.DAO_ACK_source)
-            updated = gv.neigh_cache.update_DIO_parent()
-            if updated: self.DIOtimer.hear_inconsistent()
+    def DAO_ACK_give_up(self, entry):
+        """Called when a DAO was never acknowledged by a parent. Depending on
+        the give-up policy, the parent is removed from the neighbor cache (and
+        a new DIO parent is selected)"""
+        policy = gv.dao_give_up_policy
 
+        if policy == "keep":
+            logger.info("parent %s did not acknowledge the DAO, keeping it" % repr(Address(entry.parent)))
             return
 
-        self.DAO_trans_retry += 1
-
-
-        self.DAO_ACKtimer = Timer(DEFAULT_DAO_ACK_DELAY, self.sendDAO, kwargs={'iface':self.DAO_ACK_source_iface, 'destination':self.DAO_ACK_source, 'retransmit':True})
-        self.DAO_ACKtimer.start()
-
+        if policy == "evict-if-silent":
+            node = self.instance.neigh_cache.get_node(entry.iface, entry.parent, self)
+            if node and node.last_dio > entry.first_sent:
+                logger.info("parent %s did not acknowledge the DAO but still sends DIO messages, keeping it" % repr(Address(entry.parent)))
+                return
 
-    def cancelDAO_ACKtimer(self):
-        """cancel the DAO ACK timer (when the acknowledgment message is received)"""
-        try:
-            self.DAO_ACKtimer.cancel()
-        except:
-            pass
+        # the parent seems unreachable, hence, it should be removed, and if it
+        # was the DIO parent, a new DIO parent must be found
+        gv.pending_daos.forget_parent(entry.parent)
+        self.instance.neigh_cache.remove_node_by_address(self, entry.parent)
+        updated = self.instance.neigh_cache.update_DIO_parent()
+        if updated: self.DIOtimer.hear_inconsistent()
 
 
-    def downward_route_add(self, route):
+    def downward_route_add(self, route, lifetime=None):
+        """Add a downward route, valid for lifetime seconds (None means infinite)"""
         with self.__lock:
             if not gv.address_cache.is_assigned(route.target.split("/")[0]):
-                self.downward_routes.add(route)
+                if route not in self.downward_routes:
+                    self.downward_routes.add(route)
+                    self.__route_index.add(route)
+                    state_changed()
+
+                entry = self.route_lifetimes.pop(route, None)
+                if lifetime is None:
+                    if entry:
+                        entry.cancel()
+                elif entry:
+                    entry.reschedule(lifetime)
+                    self.route_lifetimes[route] = entry
+                else:
+                    self.route_lifetimes[route] = gv.timing_wheel.schedule(lifetime, self.downward_routes_expired, route)
 
 
     def downward_route_del(self, route):
         with self.__lock:
             if route in self.downward_routes:
                 self.downward_routes.remove(route)
+                self.__route_index.remove(route)
                 self.no_path_routes_trans = 0
                 self.no_path_routes.add(route)
+                state_changed()
+
+                entry = self.route_lifetimes.pop(route, None)
+                if entry:
+                    entry.cancel()
+
+
+    def downward_routes_expired(self, routes):
+        """The path lifetime of some downward routes has expired (called by the timing wheel)"""
+        with self.__lock:
+            routes = [route for route in routes if route in self.downward_routes]
+            logger.debug("%d downward routes have expired" % len(routes))
+            for route in routes:
+                self.route_lifetimes.pop(route, None)
+                self.downward_route_del(route)
+
+            (removed_routes, new_routes) = self.take_route_changes()
+
+        if not routes or not self.active:
+            return
+
+        if self.instance.route_cache.update_routes(routes + removed_routes, new_routes):
+            self.last_PathSequence += 1
+            if not self.is_dodagRoot:
+                self.setDAOtimer()
 
 
     def downward_routes_reset(self):
         logger.debug("Removing all downward routes for this DODAG (%s)" % str(Address(self.dodagID)))
         with self.__lock:
-            gv.route_cache.remove_routes(self.downward_routes)
+            self.instance.route_cache.remove_routes(self.downward_routes | self.__route_index.installed_routes())
             self.downward_routes = set()
+            self.__route_index = self.__new_route_index()
+            self.__cancel_route_lifetimes()
+        state_changed()
+
+
+    def __cancel_route_lifetimes(self):
+        for entry in self.route_lifetimes.itervalues():
+            entry.cancel()
+        self.route_lifetimes = {}
 
 
     def downward_routes_remove_by_nexthop(self, address):
+        """Remove the downward routes going through a next hop (the routes
+        installed in the route cache are left for the caller to update)"""
         logger.debug("Removing all downward routes going through %s" % address)
 
-        updated = False
-
         with self.__lock:
-            for route in self.downward_routes.copy():
-                if address == route.nexthop:
-                    self.downward_route_del(route)
-                    if self.active:
-                        updated += gv.route_cache.remove_route(route)
+            routes = self.__route_index.routes_through(address)
+            for route in routes:
+                self.downward_route_del(route)
 
-        return updated
+        return bool(routes)
 
 
     def downward_routes_get(self):
@@ -411,56 +577,66 @@ class DODAG(object):
             return self.downward_routes.copy()
 
 
-    def get_filtered_downward_routes(self):
-        new_routes = {}
-        removed_routes = []
+    def best_downward_routes_get(self):
+        """Return the downward route that is used for each target (or the
+        aggregated routes, when the routes are aggregated)"""
+        with self.__lock:
+            return self.__route_index.best_routes()
+
 
+    def installed_downward_routes_get(self):
+        """Return the downward routes that were handed over to the route cache
+        by the previous take_route_changes() call"""
         with self.__lock:
-            for route in self.downward_routes:
-                    if route.target not in new_routes:
-                        new_routes[route.target] = (route.nexthop, route.nexthop_iface, route.onehop)
-                        continue
+            return self.__route_index.installed_routes()
 
-                    (current_nexthop, current_nexthop_iface, current_onehop) = new_routes[route.target]
 
-                    # only one route can be one hop to a destination
-                    # (unless a node uses two link local addresses)
-                    assert not (current_onehop and route.onehop)
+    def __new_route_index(self):
+        return DownwardRouteIndex(self.__route_key, gv.aggregate_routes, Route)
 
-                    # one hop route takes precedence over multiphop routes
-                    if current_onehop:
-                        removed_routes.append(route)
-                        continue
 
-                    # one hop route takes precedence over multihop routes
-                    if route.onehop:
-                        removed_routes.append(Route(route.target, current_nexthop, current_nexthop_iface, current_onehop))
-                        new_routes[route.target] = (route.nexthop, route.nexthop_iface, route.onehop)
-                        continue
+    def __route_key(self, route):
+        """Sort key of the candidate routes to a target (the best route has the
+        lowest key): one hop routes come first, then the routes through a
+        known neighbor, by increasing DAGRank of the neighbor"""
+        if route.onehop:
+            return (False, False, 0)
+        node = self.instance.neigh_cache.get_node(route.nexthop_iface, route.nexthop, self)
+        if node is None:
+            return (True, True, 0)
+        return (True, False, self.DAGRank(node.rank))
 
-                    node = gv.neigh_cache.get_node(route.nexthop_iface, route.nexthop, self)
-                    current_node = gv.neigh_cache.get_node(current_nexthop_iface, current_nexthop, self)
 
-                    assert id(node) != id(current_node)
+    def downward_routes_nexthop_changed(self, address):
+        """The neighbor whose address is address appeared, disappeared or
+        changed its rank: the targets reachable through it might now have a
+        different best route"""
+        with self.__lock:
+            self.__route_index.nexthop_changed(address)
+            (removed_routes, new_routes) = self.take_route_changes()
 
-                    if not node:
-                        removed_routes.append(route)
-                        continue
+        if self.active and (removed_routes or new_routes):
+            self.instance.route_cache.update_routes(removed_routes, new_routes)
 
-                    if not current_node:
-                        removed_routes.append(Route(route.target, current_nexthop, current_nexthop_iface, current_onehop))
-                        new_routes[route.target] = (route.nexthop, route.nexthop_iface, route.onehop)
-                        continue
 
-                    if self.DAGRank(node.rank) >= self.DAGRank(current_node.rank):
-                        removed_routes.append(route)
-                    else:
-                        new_routes[route.target] = (route.nexthop, route.nexthop_iface, route.onehop)
-                        removed_routes.append(Route(route.target, current_nexthop, current_nexthop_iface, current_onehop))
+    def take_route_changes(self):
+        """Return the changes to the best downward routes (or to the
+        aggregated routes) since the previous call, as (routes to withdraw,
+        routes to install). A target that moved to a new next hop is in both
+        lists"""
+        with self.__lock:
+            return self.__route_index.take_changes()
 
-            new_routes = [Route(target, nexthop, nexthop_iface, onehop) for (target, (nexthop, nexthop_iface, onehop)) in new_routes.items()]
 
-            return (removed_routes, new_routes)
+    def neighbor_lifetime(self):
+        """Time (in seconds) after which a neighbor that sends no DIO message is removed"""
+        Imax = 0.001 * 2 ** self.DIOIntMin * 2 ** self.DIOIntDoublings
+        return DEFAULT_NEIGHBOR_LIFETIME_INTERVALS * Imax
+
+
+    def compute_rank_increase(self, parent_rank):
+        """Compute the rank of the node when its parent has rank parent_rank"""
+        return self.instance.of.compute_rank_increase(self, parent_rank)
 
 
     def DAGRank(self, rank):
@@ -488,26 +664,48 @@ class DODAG(object):
         self.sendDAO_ACK = undef
         self.setDAOtimer = undef
         self.setDIOtimer = undef
-        self.setDAO_ACKtimer = undef
 
         # disable all the running timers
         try: self.DIOtimer.cancel()
         except: pass
-        try: self.DAOtimer.cancel()
-        except: pass
-        try: self.DAO_ACKtimer.cancel()
-        except: pass
+        gv.dao_scheduler.cancel(self)
+        gv.pending_daos.cancel_owner(self)
 
         del self.DIOtimer
-        try: del self.DAOtimer
-        except: pass
-        try: del self.DAO_ACKtimer
-        except: pass
 
-        gv.neigh_cache.remove_nodes_by_dodag(self)
+        self.__cancel_route_lifetimes()
+
+        self.instance.neigh_cache.remove_nodes_by_dodag(self)
 
 
 
+    @property
+    def version(self):
+        """DODAG Version Number"""
+        return self.__version
+
+
+    @version.setter
+    def version(self, version):
+        old_version = self.__version
+        self.__version = version
+        # the DODAG cache indexes the DODAGs by version
+        self.instance.dodag_cache.version_changed(self, old_version)
+
+
+    @property
+    def active(self):
+        """Indicates if this is the DODAG the node currently participates in"""
+        return self.__active
+
+
+    @active.setter
+    def active(self, active):
+        self.__active = active
+        # the DODAG cache keeps track of the active DODAG
+        self.instance.dodag_cache.activity_changed(self)
+
+
     def __eq__(self, other):
         """
         Compare DODAG Versions between two DODAGs
@@ -577,7 +775,18 @@ class DODAG_cache(object):
     """Store multiple DODAG instance"""
 
     def __init__(self):
-        self.__dodag_cache = []
+        # DODAGs indexed by RPL Instance ID, then DODAG ID, then version
+        # number: instanceID -> dodagID -> version value -> DODAG
+        self.__index = {}
+        # all the DODAGs, in the order they were added: id(DODAG) -> DODAG
+        self.__dodags = OrderedDict()
+        self.__position = {}  # id(DODAG) -> insertion sequence number
+        self.__sequence = 0
+        self.__active = None
+        # most recent version of each DODAG: (instanceID, dodagID) -> DODAG
+        self.__latest = {}
+        # DODAGs that have older versions left to purge: set of (instanceID, dodagID)
+        self.__outdated = set()
 
 
     def add(self, dodag):
@@ -585,7 +794,87 @@ class DODAG_cache(object):
         # make sure we don't track the same DODAG twice
         assert not self.has_dodag(dodag.dodagID, dodag.version, dodag.instanceID)
 
-        self.__dodag_cache.insert(0, dodag)
+        versions = self.__index.setdefault(dodag.instanceID, {}).setdefault(dodag.dodagID, OrderedDict())
+        versions[dodag.version.get_val()] = dodag
+        self.__version_added(dodag, versions)
+        self.__sequence += 1
+        self.__dodags[id(dodag)] = dodag
+        self.__position[id(dodag)] = self.__sequence
+        if dodag.active:
+            self.activity_changed(dodag)
+
+        state_changed()
+        self.__solicit()
+
+
+    def __remove(self, dodag):
+        """Remove a DODAG from the indexes"""
+        instances = self.__index[dodag.instanceID]
+        versions = instances[dodag.dodagID]
+        del versions[dodag.version.get_val()]
+        key = (dodag.instanceID, dodag.dodagID)
+        if not versions:
+            del instances[dodag.dodagID]
+            if not instances:
+                del self.__index[dodag.instanceID]
+            del self.__latest[key]
+            self.__outdated.discard(key)
+        elif self.__latest[key] is dodag:
+            latest = None
+            for other in versions.itervalues():
+                if latest is None or other.version > latest.version:
+                    latest = other
+            self.__latest[key] = latest
+        del self.__dodags[id(dodag)]
+        del self.__position[id(dodag)]
+        if self.__active is dodag:
+            self.__active = None
+
+
+    def version_changed(self, dodag, old_version):
+        """The version of a DODAG changed, e.g. during a global repair
+        (called by the DODAG)"""
+        if id(dodag) not in self.__dodags:
+            return
+
+        versions = self.__index[dodag.instanceID][dodag.dodagID]
+        del versions[old_version.get_val()]
+        versions[dodag.version.get_val()] = dodag
+        self.__version_added(dodag, versions)
+
+
+    def __version_added(self, dodag, versions):
+        """Update the most recent version of a DODAG after dodag was indexed
+        in versions (the version bucket of its DODAG ID)"""
+        key = (dodag.instanceID, dodag.dodagID)
+        latest = self.__latest.get(key)
+        if latest is None or dodag.version > latest.version:
+            self.__latest[key] = dodag
+        if len(versions) > 1:
+            self.__outdated.add(key)
+
+
+    def activity_changed(self, dodag):
+        """The active flag of a DODAG changed (called by the DODAG)"""
+        if id(dodag) not in self.__dodags:
+            return
+
+        if dodag.active:
+            # only one DODAG must be active at a time
+            assert self.__active is None or self.__active is dodag
+            self.__active = dodag
+        elif self.__active is dodag:
+            self.__active = None
+
+
+    def __solicit(self):
+        """Solicit DIO messages (DIS) only when no DODAG is known"""
+        if not gv.dis_scheduler:
+            return
+        if gv.instances.is_empty():
+            gv.dis_scheduler.start()
+        else:
+            gv.dis_scheduler.stop()
 
 
     def has_dodag(self, dodagID=None,  version=None, instanceID=None):
@@ -593,82 +882,231 @@ class DODAG_cache(object):
         return bool(self.get_dodag(dodagID, version, instanceID))
 
 
+    @staticmethod
+    def __match_version(versions, version):
+        """DODAGs of a version bucket (version value -> DODAG) that match version"""
+        if version is None:
+            return versions.values()
+
+        if isinstance(version, Lollipop):
+            version = version.get_val()
+        try:
+            return [versions[version]]
+        except KeyError:
+            pass
+
+        # versions that are too far apart are not comparable, and are
+        # considered equal by Lollipop (a bucket only holds a few versions)
+        return [dodag for dodag in versions.itervalues() if dodag.version == version]
+
+
     def get_dodag(self, dodagID=None, version=None, instanceID=None, is_root=None):
-        """Retrieves the DODAG with the corresponding DODAG ID.
-        Returns None if no such DODAG exists"""
-        dodags = []
+        """Retrieves the DODAGs that match the parameters (None matches any
+        value), the most recently added first.
+        Returns an empty list if no such DODAG exists"""
+        if instanceID is None:
+            instances = self.__index.values()
+        else:
+            try:
+                instances = [self.__index[instanceID]]
+            except KeyError:
+                return []
 
-        for dodag in self.__dodag_cache:
-            if dodagID is not None and dodag.dodagID != dodagID:
-                continue
-            if version is not None and dodag.version != version:
-                continue
-            if instanceID is not None and dodag.instanceID != instanceID:
-                continue
-            if isinstance(is_root, bool) and dodag.is_dodagRoot != is_root:
+        dodags = []
+        for dodagIDs in instances:
+            if dodagID is None:
+                buckets = dodagIDs.itervalues()
+            elif dodagID in dodagIDs:
+                buckets = [dodagIDs[dodagID]]
+            else:
                 continue
 
-            dodags.append(dodag)
+            for versions in buckets:
+                dodags.extend(self.__match_version(versions, version))
 
+        if isinstance(is_root, bool):
+            dodags = [dodag for dodag in dodags if dodag.is_dodagRoot == is_root]
+
+        if len(dodags) > 1:
+            dodags.sort(key=lambda dodag: self.__position[id(dodag)], reverse=True)
         return dodags
 
 
     def get_active_dodag(self):
         """Retrieves the active DODAGID"""
-        active_dodags =  [dodag for dodag in self.__dodag_cache if dodag.active]
+        return self.__active
 
-        # only one DODAG must be active at a time
-        assert len(active_dodags) <= 1
 
-        if active_dodags:
-            return active_dodags[0]
-        else:
-            return None
+    def get_latest_dodag(self, dodagID, instanceID):
+        """Retrieves the most recent version of a DODAG (None if the DODAG is unknown)"""
+        return self.__latest.get((instanceID, dodagID))
+
+
+    def is_latest(self, dodag):
+        """Indicates if no newer version of the DODAG is in the cache"""
+        return self.__latest.get((dodag.instanceID, dodag.dodagID)) is dodag
 
 
     def purge_old_versions(self):
-        """Remove from the cache DODAGs whose version has been updated"""
-        # retrieves all unique DODAG IDs
-        dodagIDs = set()
-        for dodag in self.__dodag_cache:
-            dodagIDs.add(dodag.dodagID)
-
-        for dodagID in dodagIDs:
-            # it could probably be optimized, as I go through the cache 3 times in total
-            latest_version = None
-            for dodag in self.__dodag_cache: # find the more recent cache entry for this DODAG
-                if dodag.dodagID == dodagID:
-                    if latest_version is None:
-                        latest_version = dodag.version
-                    elif dodag.version > latest_version:
-                        latest_version = dodag.version
+        """Remove from the cache DODAGs whose version has been updated
+        (only DODAGs for which a version was added since the last call are
+        looked at, which usually means that there is nothing to do)"""
+        if not self.__outdated:
+            return
+
+        outdated = self.__outdated
+        self.__outdated = set()
+        for (instanceID, dodagID) in outdated:
+            latest = self.__latest[(instanceID, dodagID)]
+            versions = self.__index[instanceID][dodagID]
 
             # remove all old DODAG
-            for (index, dodag) in reversed(list(enumerate(self.__dodag_cache))):
-                if dodag.dodagID == dodagID \
-                   and dodag.version < latest_version:
-                    # this DODAG should already have been migrated (because
-                    # there is a new version), thus it has no reason to still
-                    # be active
-                    assert not dodag.active
-                    logger.debug("Removing old DODAG %s (version %d)" % (repr(Address(dodag.dodagID)), dodag.version.get_val()))
-                    dodag.poison()
-                    dodag.cleanup()
-                    del self.__dodag_cache[index]
-                    del dodag
+            old_dodags = [dodag for dodag in versions.itervalues() if dodag.version < latest.version]
+            for dodag in old_dodags:
+                # this DODAG should already have been migrated (because
+                # there is a new version), thus it has no reason to still
+                # be active
+                assert not dodag.active
+                logger.debug("Removing old DODAG %s (version %d)" % (repr(Address(dodag.dodagID)), dodag.version.get_val()))
+                dodag.poison()
+                dodag.cleanup()
+
+            if len(old_dodags) == len(versions) - 1:
+                # only the latest version is left
+                self.__index[instanceID][dodagID] = OrderedDict([(latest.version.get_val(), latest)])
+                for dodag in old_dodags:
+                    del self.__dodags[id(dodag)]
+                    del self.__position[id(dodag)]
+            else:
+                # some versions can not be compared with the latest one
+                for dodag in old_dodags:
+                    self.__remove(dodag)
+
+            if old_dodags:
+                state_changed()
+
+        self.__solicit()
 
 
     def is_empty(self):
-        return len(self.__dodag_cache) == 0
+        return len(self.__dodags) == 0
 
 
     def poison_all(self):
-        for dodag in self.__dodag_cache:
+        for dodag in self.__dodags.values():
             dodag.poison(shutdown=True)
 
 
     def cleanup(self):
-        for dodag in self.__dodag_cache:
+        for dodag in self.__dodags.values():
             dodag.cleanup()
 
 
+
+
+def test_delta_DAO():
+    from instance import simulated_node
+    from icmp import getAllOption
+
+    interfaces = simulated_node()
+    dodag = DODAG(1, 240, 1, 2, 0, 240, socket.inet_pton(socket.AF_INET6, "2001:db8::1"), interfaces, active=True)
+    dodag.instance.dodag_cache.add(dodag)
+    parent = socket.inet_pton(socket.AF_INET6, "fe80::1")
+    child = socket.inet_pton(socket.AF_INET6, "fe80::2")
+    dodag.instance.neigh_cache.register_node("eth0", parent, dodag, 256, 240)
+    dodag.preferred_parent = dodag.instance.neigh_cache.get_node("eth0", parent, dodag)
+    route = lambda target: Route("2001:db8:1::%x/128" % target, child, "eth0", False)
+    target = lambda target: "2001:db8:1::%x/128" % target
+
+    def advertise(acknowledge=True):
+        """Send a DAO to the DAO parent, return the targets and No-Path targets
+        it advertised (the parent acknowledges it, unless told otherwise)"""
+        dodag.sendDAO()
+        (targets, no_path_targets) = (set(), set())
+        for (destination, message) in interfaces["eth0"].sent:
+            dao = DAO()
+            options = getAllOption(dao.parse(message))
+            current = []
+            for opt in options:
+                if isinstance(opt, RPL_Option_RPL_Target):
+                    current.append(repr(Address(opt.target_prefix)) + "/" + str(opt.prefix_len))
+                elif isinstance(opt, RPL_Option_Transit_Information):
+                    (targets if opt.path_lifetime else no_path_targets).update(current)
+                    current = []
+            if acknowledge:
+                gv.pending_daos.acknowledge(destination, dao.DAOsequence)
+        del interfaces["eth0"].sent[:]
+        return (targets, no_path_targets)
+
+    # the first DAO advertises all the targets, the next ones only the changes
+    dodag.downward_route_add(route(1))
+    dodag.downward_route_add(route(2))
+    assert advertise() == (set([target(1), target(2)]), set())
+    dodag.downward_route_add(route(3))
+    assert advertise() == (set([target(3)]), set())
+
+    # no DAO is needed when the parent acknowledged all the targets
+    dodag.sendDAO()
+    assert interfaces["eth0"].sent == [] and len(gv.pending_daos) == 0
+
+    # a target is advertised until the parent acknowledges it
+    dodag.downward_route_add(route(4))
+    assert advertise(acknowledge=False) == (set([target(4)]), set())
+    assert advertise() == (set([target(4)]), set())
+
+    # a removed target is withdrawn
+    dodag.downward_route_del(route(1))
+    assert advertise() == (set(), set([target(1)]))
+
+    # all the targets are advertised again when the parent asks for it
+    # (it increased its DTSN), and once the refresh interval has elapsed
+    all_targets = set([target(2), target(3), target(4)])
+    dodag.resync_DAO()
+    assert advertise()[0] == all_targets
+    assert advertise()[0] == set()
+    gv.scheduler.clock.advance_to(gv.scheduler.time() + dodag.DAO_refresh_interval())
+    assert advertise()[0] == all_targets
+    assert advertise()[0] == set()
+
+    # and when the DAO parent changes
+    other_parent = socket.inet_pton(socket.AF_INET6, "fe80::3")
+    dodag.instance.neigh_cache.register_node("eth0", other_parent, dodag, 256, 240)
+    dodag.preferred_parent = dodag.instance.neigh_cache.get_node("eth0", other_parent, dodag)
+    assert advertise()[0] == all_targets
+
+
+def test_aggregated_route_changes():
+    from instance import simulated_node
+
+    interfaces = simulated_node()
+    gv.aggregate_routes = True
+    dodag = DODAG(1, 240, 1, 2, 0, 240, socket.inet_pton(socket.AF_INET6, "2001:db8::1"), interfaces, active=True)
+    dodag.instance.dodag_cache.add(dodag)
+    route_cache = dodag.instance.route_cache
+    child = socket.inet_pton(socket.AF_INET6, "fe80::2")
+    known_child = socket.inet_pton(socket.AF_INET6, "fe80::3")
+    dodag.instance.neigh_cache.register_node("eth0", known_child, dodag, 512, 240)
+    route = lambda target, nexthop: Route("2001:db8:1::%x/128" % target, nexthop, "eth0", False)
+    aggregated = Route("2001:db8:1::/126", child, "eth0", False)
+
+    # the targets that share a next hop are installed as a single route
+    for target in range(4):
+        dodag.downward_route_add(route(target, child))
+    assert dodag.take_route_changes() == ([], [aggregated])
+    route_cache.update_routes([], [aggregated])
+    assert dodag.take_route_changes() == ([], [])
+
+    # a better route to one of the targets (through a known neighbor) only
+    # splits the aggregated route it belongs to
+    dodag.downward_route_add(route(2, known_child))
+    (removed, new) = dodag.take_route_changes()
+    split = set([Route("2001:db8:1::/127", child, "eth0", False), route(2, known_child), route(3, child)])
+    assert removed == [aggregated] and set(new) == split
+    route_cache.update_routes(removed, new)
+    assert dodag.installed_downward_routes_get() == split
+
+    # when the neighbor goes away, the targets are aggregated again (the
+    # changes are applied to the route cache right away)
+    dodag.instance.neigh_cache.remove_node_by_address(dodag, known_child)
+    assert route_cache.route_cache == set([aggregated])
+    assert dodag.take_route_changes() == ([], [])
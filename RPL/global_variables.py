@@ -19,11 +19,25 @@
 
 """defines the global variable used through the program"""
 
-# will be set the first time a DIO message is received
-global_instanceID = 0
+# bounds (min, max) of the DIO redundancy constant when it is adapted to the
+# neighborhood density (None when the configured value is used as is)
+adaptive_redundancy = None
 
-route_cache = None
+scheduler = None
+timing_wheel = None
+dis_scheduler = None
+dao_scheduler = None
+pending_daos = None
+# largest DAO message sent (the targets are split over several DAO beyond it)
+dao_mtu = None
+# aggregate the downward routes and the DAO targets (see prefix_trie)
+aggregate_routes = False
+# what to do with a parent that never acknowledges a DAO (see DAO_GIVE_UP_POLICIES)
+dao_give_up_policy = None
 address_cache = None
-neigh_cache = None
-dodag_cache = None
+# read-only snapshots of the state (for the CLI)
+snapshots = None
+# RPL Instances (each one has its own DODAG cache, neighbor cache and route cache)
+instances = None
 link_cache = None
+netlink_monitor = None
@@ -0,0 +1,334 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""RPL Instances.
+
+The state of the node is partitioned by RPL Instance ID: each instance has
+its own DODAG cache, neighbor cache (hence its own DIO parents, preferred
+parent and active DODAG), objective function and route cache. The node
+participates in one DODAG of each instance it knows about.
+
+Each instance installs its routes in a routing table of its own, as the
+default routes of two instances would conflict in a shared table. The node
+joins the first instance it hears about with the default table, and only the
+instances that were given a table afterwards. The ip rule of an instance
+table only selects the traffic of the instance (fwmark by default), and comes
+before the rule of the default table."""
+
+import of_zero
+from dodag import DODAG_cache
+from neighbor_cache import NeighborCache
+from rpl_constants import DEFAULT_NEIGHBOR_CACHE_SIZE, DEFAULT_RULE_PRIORITY
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+# supported objective functions, by Objective Code Point
+OBJECTIVE_FUNCTIONS = {of_zero.OCP: of_zero}
+
+
+class RPLInstance(object):
+    def __init__(self, instanceID, route_cache, neighbor_capacity=DEFAULT_NEIGHBOR_CACHE_SIZE):
+        """State of a RPL Instance:
+        - instanceID: the RPL Instance ID
+        - route_cache: the route cache the routes of the instance are installed in
+        - neighbor_capacity: maximum number of neighbors (None for an unbounded cache)"""
+        self.instanceID = instanceID
+        self.of = of_zero
+        self.route_cache = route_cache
+        self.dodag_cache = DODAG_cache()
+        self.neigh_cache = NeighborCache(self, capacity=neighbor_capacity)
+
+
+    def set_objective_function(self, OCP):
+        """Use the objective function identified by OCP.
+        Returns False if this objective function is not supported"""
+        try:
+            of = OBJECTIVE_FUNCTIONS[OCP]
+        except KeyError:
+            return False
+
+        if of is not self.of:
+            logger.info("RPL instance %d now uses objective function %d" % (self.instanceID, OCP))
+            self.of = of
+            for dodag in self.dodag_cache.get_dodag():
+                self.neigh_cache.refresh_candidates(dodag)
+        return True
+
+
+    def __str__(self):
+        return "RPL Instance ID: %d (objective function: %d, routing table: %s, DODAGs: %d)" % \
+               (self.instanceID, self.of.OCP, self.route_cache.table, len(self.dodag_cache.get_dodag()))
+
+
+class InstanceCache(object):
+    """Store the RPL Instances the node participates in"""
+
+    def __init__(self, new_route_cache, table, instance_tables={},
+                 neighbor_capacity=DEFAULT_NEIGHBOR_CACHE_SIZE,
+                 rule_priority=DEFAULT_RULE_PRIORITY, instance_selectors={}):
+        """Instance cache:
+        - new_route_cache: function(table, rule_priority, rule_selector) that
+          returns a new route cache
+        - table: routing table of the instance that does not have its own
+        - instance_tables: RPL Instance ID -> routing table of the instances
+          that have their own
+        - neighbor_capacity: maximum number of neighbors of each instance
+        - rule_priority: priority of the ip rule of the default table (the
+          rules of the instance tables take the priorities just before it)
+        - instance_selectors: RPL Instance ID -> ip rule selector of the
+          traffic routed by the instance (e.g. "tos 0x10", "fwmark
+          instanceID" by default)"""
+        self.new_route_cache = new_route_cache
+        self.table = str(table)
+        self.instance_tables = dict((instanceID, str(table)) for (instanceID, table) in instance_tables.iteritems())
+        self.neighbor_capacity = neighbor_capacity
+        self.rule_priority = rule_priority
+        self.__instances = {}
+        self.__route_caches = {}  # routing table -> route cache
+
+        tables = [self.table] + self.instance_tables.values()
+        if len(set(tables)) != len(tables):
+            raise Exception("each RPL instance must have a routing table of its own")
+
+        # routing table -> (priority, selector) of the ip rule of the instance tables
+        self.__rules = {}
+        for (position, instanceID) in enumerate(sorted(self.instance_tables)):
+            priority = rule_priority - 1 - position
+            if priority < 1:
+                raise Exception("rule priority %d leaves no room for the rules of the instance tables" % rule_priority)
+            selector = instance_selectors.get(instanceID, "fwmark %d" % instanceID).split()
+            self.__rules[self.instance_tables[instanceID]] = (priority, selector)
+
+
+    def get_route_cache(self, table=None):
+        """Return the route cache of a routing table (the default table if
+        table is None)"""
+        if table is None:
+            table = self.table
+        try:
+            return self.__route_caches[table]
+        except KeyError:
+            (priority, selector) = self.__rules.get(table, (self.rule_priority, ()))
+            route_cache = self.__route_caches[table] = \
+                self.new_route_cache(table, rule_priority=priority, rule_selector=selector)
+            return route_cache
+
+
+    def get_route_caches(self):
+        return self.__route_caches.values()
+
+
+    def get(self, instanceID):
+        """Return a RPL Instance (None if the node does not know it)"""
+        return self.__instances.get(instanceID)
+
+
+    def can_join(self, instanceID):
+        """Indicates if the node can participate in a RPL Instance, i.e. if no
+        other instance uses the routing table of this instance"""
+        if instanceID in self.__instances or instanceID in self.instance_tables:
+            return True
+        return all(instance.route_cache.table != self.table for instance in self.__instances.itervalues())
+
+
+    def get_or_create(self, instanceID):
+        """Return a RPL Instance, create it if the node does not know it yet"""
+        try:
+            return self.__instances[instanceID]
+        except KeyError:
+            pass
+
+        if not self.can_join(instanceID):
+            raise Exception("RPL instance %d has no routing table of its own (see --instance-table)" % instanceID)
+
+        table = self.instance_tables.get(instanceID, self.table)
+        logger.info("joining RPL instance %d (routing table %s)" % (instanceID, table))
+        instance = RPLInstance(instanceID, self.get_route_cache(table), self.neighbor_capacity)
+        self.__instances[instanceID] = instance
+        return instance
+
+
+    def get_instances(self):
+        """Return the RPL Instances, by increasing RPL Instance ID"""
+        return [self.__instances[instanceID] for instanceID in sorted(self.__instances)]
+
+
+    def get_dodag(self, dodagID=None, version=None, instanceID=None, is_root=None):
+        """Retrieves the DODAGs that match the parameters, in all the RPL
+        Instances (None matches any value)"""
+        if instanceID is not None:
+            instance = self.__instances.get(instanceID)
+            if instance is None:
+                return []
+            return instance.dodag_cache.get_dodag(dodagID, version, instanceID, is_root)
+
+        dodags = []
+        for instance in self.__instances.itervalues():
+            dodags.extend(instance.dodag_cache.get_dodag(dodagID, version, is_root=is_root))
+        return dodags
+
+
+    def get_active_dodags(self):
+        """Retrieves the active DODAG of each RPL Instance"""
+        return [instance.dodag_cache.get_active_dodag() for instance in self.__instances.itervalues()
+                if instance.dodag_cache.get_active_dodag()]
+
+
+    def is_empty(self):
+        """Indicates if the node does not know any DODAG"""
+        return all(instance.dodag_cache.is_empty() for instance in self.__instances.itervalues())
+
+
+    def remove_nodes_by_iface(self, iface, address=None):
+        """Remove the neighbors reachable through an interface (or only the
+        neighbor whose binary address is address), and select new parents"""
+        for instance in self.__instances.values():
+            neigh_cache = instance.neigh_cache
+            neigh_cache.reselect_parents(neigh_cache.remove_nodes_by_iface(iface, address))
+
+
+    def poison_all(self):
+        for instance in self.__instances.itervalues():
+            instance.dodag_cache.poison_all()
+
+
+    def cleanup(self):
+        for instance in self.__instances.itervalues():
+            instance.dodag_cache.cleanup()
+
+
+    def empty_route_caches(self):
+        for route_cache in self.__route_caches.itervalues():
+            route_cache.empty_cache()
+
+
+class RecordingSocket(object):
+    """Interface socket that records the messages instead of sending them
+    (see simulated_node())"""
+
+    def __init__(self):
+        self.sent = []  # (destination, message)
+
+
+    def send(self, destination, msg):
+        self.sent.append((destination, msg))
+
+
+class _DiscardingWriter(object):
+    """Netlink writer that drops the kernel operations"""
+
+    def submit(self, key, before, after, apply):
+        pass
+
+
+    def supersede(self, key_prefix, key, function):
+        pass
+
+
+    def get_stats(self):
+        return "operations discarded"
+
+
+class _StaticAddressCache(object):
+    """Address cache whose addresses never change"""
+
+    def __init__(self, addresses):
+        self.addresses = set(addresses)
+
+
+    def is_assigned(self, address):
+        return address in self.addresses
+
+
+    def __iter__(self):
+        # the addresses of the node are not advertised as DAO targets
+        return iter(())
+
+
+def simulated_node(addresses=(), ifaces=("eth0",), instance_tables={}, neighbor_capacity=None):
+    """Set up the global state of a node whose timers run on a virtual clock
+    and whose routes are only recorded in the route caches (the kernel is
+    left alone), for the tests:
+    - addresses: addresses assigned to the node (binary and printable forms
+      are distinct addresses)
+    - ifaces: names of the interfaces of the node
+    - instance_tables, neighbor_capacity: see InstanceCache
+    Returns the interfaces (name -> RecordingSocket)"""
+    from functools import partial
+    import global_variables as gv
+    from clock import VirtualClock
+    from scheduler import Scheduler
+    from timing_wheel import TimingWheel
+    from dao_scheduler import DAOScheduler, PendingDAOTable
+    from snapshot import SnapshotPublisher
+    from route_cache import RouteCache
+    from rpl_constants import DEFAULT_DAO_GIVE_UP_POLICY, DEFAULT_DAO_MTU
+
+    gv.scheduler = Scheduler(VirtualClock())
+    gv.timing_wheel = TimingWheel(scheduler=gv.scheduler)
+    gv.dis_scheduler = None
+    gv.dao_scheduler = DAOScheduler(gv.scheduler)
+    gv.pending_daos = PendingDAOTable(gv.scheduler, gv.dao_scheduler)
+    gv.dao_give_up_policy = DEFAULT_DAO_GIVE_UP_POLICY
+    gv.dao_mtu = DEFAULT_DAO_MTU
+    gv.aggregate_routes = False
+    gv.snapshots = SnapshotPublisher(gv.scheduler)
+    gv.address_cache = _StaticAddressCache(addresses)
+    gv.instances = InstanceCache(partial(RouteCache, writer=_DiscardingWriter()), "local",
+                                 instance_tables, neighbor_capacity=neighbor_capacity)
+    return dict((iface, RecordingSocket()) for iface in ifaces)
+
+
+def test_instance_tables():
+    class FakeRouteCache(object):
+        def __init__(self, table, rule_priority, rule_selector):
+            (self.table, self.rule_priority, self.rule_selector) = (table, rule_priority, rule_selector)
+
+    instances = InstanceCache(FakeRouteCache, 100, {1: 101, 2: 102}, rule_priority=1000,
+                              instance_selectors={2: "tos 0x10"})
+
+    # the first instance heard of uses the default table, the other ones
+    # need a table of their own
+    assert instances.can_join(3)
+    assert instances.get_or_create(3).route_cache.table == "100"
+    assert not instances.can_join(4)
+    try:
+        instances.get_or_create(4)
+    except Exception:
+        pass
+    else:
+        assert False
+    assert instances.get(4) is None
+
+    # the rules of the instance tables only select the traffic of their
+    # instance, and come before the rule of the default table
+    rules = dict((instanceID, (instances.get_or_create(instanceID).route_cache.rule_priority,
+                               instances.get_or_create(instanceID).route_cache.rule_selector))
+                 for instanceID in (1, 2, 3))
+    assert rules == {1: (999, ["fwmark", "1"]), 2: (998, ["tos", "0x10"]), 3: (1000, ())}
+
+    # two instances can not share a table
+    try:
+        InstanceCache(FakeRouteCache, 100, {1: 100})
+    except Exception:
+        pass
+    else:
+        assert False
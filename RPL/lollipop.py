@@ -28,6 +28,7 @@ DEFAULT_SEQUENCE_VAL = 256 - SEQUENCE_WINDOW
 
 
 class Lollipop(object):
+    __slots__ = ("val",)
 
     def __init__(self, val = DEFAULT_SEQUENCE_VAL):
         """Counter divided in a lollipop fashion"""
@@ -24,14 +24,30 @@ import logging
 import socket
 import sys
 from signal import SIGKILL
+from functools import partial
 
 import RPL.global_variables as gv
-from RPL.core import process_loop, register_interfaces, iface_listener, stop_processing
+from RPL.core import process_loop, register_interfaces, iface_listener, stop_processing, broadcast_dis
 from RPL.route_cache import RouteCache
 from RPL.address_cache import AddressCache
-from RPL.dodag import DODAG, DODAG_cache
-from RPL.neighbor_cache import NeighborCache
+from RPL.dodag import DODAG
+from RPL.instance import InstanceCache
+from RPL.netlink_writer import NetlinkWriter
+from RPL.netlink_monitor import NetlinkMonitor
+from RPL.scheduler import Scheduler
+from RPL.timing_wheel import TimingWheel
+from RPL.dao_scheduler import DAOScheduler, PendingDAOTable
+from RPL.dis_scheduler import DISScheduler
+from RPL.snapshot import SnapshotPublisher
 from RPL.lollipop import DEFAULT_SEQUENCE_VAL
+from RPL.rpl_constants import DEFAULT_RULE_PRIORITY, \
+                              DEFAULT_ADAPTIVE_REDUNDANCY_MIN, \
+                              DEFAULT_ADAPTIVE_REDUNDANCY_MAX, \
+                              DEFAULT_DAO_MAX_TRANS_RETRY, \
+                              DAO_GIVE_UP_POLICIES, \
+                              DEFAULT_DAO_GIVE_UP_POLICY, \
+                              DEFAULT_DAO_MTU, \
+                              DEFAULT_NEIGHBOR_CACHE_SIZE
 from Routing import Link
 
 
@@ -57,6 +73,8 @@ def main(args):
 
     parser.add_argument("-d", "--dodagID", type=str, action="append", default=[],
             help="RPL DODAG Identifier, has to be an IPv6 address that is assigned on the node (optional)")
+    parser.add_argument("-I", "--instance-id", type=int, action="append", default=[],
+            help="RPL Instance ID of the DODAG Identifier given at the same position (only for DODAG root, 0 by default, optional)")
     parser.add_argument("-i", "--iface", default=None, action="append",
             help="network interfaces that RPL will listen on")
     parser.add_argument("-R", "--root", default=False, action="store_true",
@@ -65,6 +83,33 @@ def main(args):
             help="verbose output")
     parser.add_argument("-p", "--prefix", action="append", default=[],
             help="Routable prefix(es) that this node advertise (only for DODAG root, optional)")
+    parser.add_argument("-t", "--table", type=str, default="local",
+            help="routing table where RPL routes are installed (a table other than local or main is dedicated to RPL and flushed at once, optional)")
+    parser.add_argument("--rule-priority", type=int, default=DEFAULT_RULE_PRIORITY,
+            help="priority of the ip rule that references a dedicated routing table (the rules of the instance tables take the priorities just before it, optional)")
+    parser.add_argument("--instance-table", type=str, nargs=2, action="append", default=[], metavar=("INSTANCE", "TABLE"),
+            help="routing table where the routes of a RPL instance are installed (only the first instance heard of uses --table, the others are ignored unless they have their own table, optional)")
+    parser.add_argument("--instance-selector", type=str, nargs=2, action="append", default=[], metavar=("INSTANCE", "SELECTOR"),
+            help="ip rule selector of the traffic routed through the table of a RPL instance (\"fwmark INSTANCE\" by default, optional)")
+    parser.add_argument("--sync-netlink", default=False, action="store_true",
+            help="update routes and addresses from the message handlers instead of a separate writer thread")
+    parser.add_argument("--no-netlink-monitor", default=False, action="store_true",
+            help="do not listen to the kernel notifications on links, addresses and neighbors")
+    parser.add_argument("--adaptive-redundancy", default=False, action="store_true",
+            help="adapt the DIO redundancy constant to the neighborhood density (optional)")
+    parser.add_argument("--redundancy-bounds", type=int, nargs=2, metavar=("KMIN", "KMAX"),
+            default=[DEFAULT_ADAPTIVE_REDUNDANCY_MIN, DEFAULT_ADAPTIVE_REDUNDANCY_MAX],
+            help="bounds of the adaptive DIO redundancy constant (optional)")
+    parser.add_argument("--dao-max-transmissions", type=int, default=DEFAULT_DAO_MAX_TRANS_RETRY,
+            help="number of times a DAO is sent before giving up on the parent (optional)")
+    parser.add_argument("--dao-give-up", choices=DAO_GIVE_UP_POLICIES, default=DEFAULT_DAO_GIVE_UP_POLICY,
+            help="what to do with a parent that never acknowledges a DAO (optional)")
+    parser.add_argument("--dao-mtu", type=int, default=DEFAULT_DAO_MTU,
+            help="largest DAO message sent, larger target sets are split over several DAO (optional)")
+    parser.add_argument("--aggregate-routes", default=False, action="store_true",
+            help="advertise and install a covering prefix for the targets that share a next hop (optional)")
+    parser.add_argument("--max-neighbors", type=int, default=DEFAULT_NEIGHBOR_CACHE_SIZE,
+            help="maximum number of neighbors in the neighbor cache of each RPL instance, no limit by default or when 0 (optional)")
     args = parser.parse_args()
 
     if args.verbose == 0:
@@ -95,22 +140,60 @@ def main(args):
         else:
             listener_processes.append(pid)
 
+    if args.adaptive_redundancy:
+        gv.adaptive_redundancy = tuple(args.redundancy_bounds)
+
+    # protocol timers run from the main loop
+    gv.scheduler = Scheduler()
+    # route, address and neighbor lifetimes expire from the same loop
+    gv.timing_wheel = TimingWheel(scheduler=gv.scheduler)
+    # DIO messages are solicited while no DODAG is known
+    gv.dis_scheduler = DISScheduler(gv.scheduler, partial(broadcast_dis, interfaces))
+    # DAO messages are spread over time
+    gv.dao_scheduler = DAOScheduler(gv.scheduler)
+    gv.pending_daos = PendingDAOTable(gv.scheduler, gv.dao_scheduler,
+                                      max_transmissions=args.dao_max_transmissions)
+    gv.dao_give_up_policy = args.dao_give_up
+    gv.dao_mtu = args.dao_mtu
+    gv.aggregate_routes = args.aggregate_routes
+    # the CLI reads snapshots of the state instead of the live caches
+    gv.snapshots = SnapshotPublisher(gv.scheduler)
+
+    # kernel updates are performed outside of the message handlers
+    if args.sync_netlink:
+        writer = None
+    else:
+        logger.warning("starting netlink writer")
+        writer = NetlinkWriter()
+        writer.start()
+
+    # each RPL instance has its own DODAG cache, neighbor cache and route cache
+    logger.warning("registering RPL instance cache")
+    gv.instances = InstanceCache(partial(RouteCache, writer=writer),
+                                 args.table,
+                                 dict((int(instanceID), table) for (instanceID, table) in args.instance_table),
+                                 neighbor_capacity=args.max_neighbors or None,
+                                 rule_priority=args.rule_priority,
+                                 instance_selectors=dict((int(instanceID), selector)
+                                                         for (instanceID, selector) in args.instance_selector))
+
     # start routing cache (in order to clean up new routes upon exit)
     logger.warning("registering routing cache")
-    gv.route_cache = RouteCache()
-
-    logger.warning("registering RPL neighbor cache")
-    gv.neigh_cache = NeighborCache()
+    gv.instances.get_route_cache()
 
     #populate address cache (in order to clean up new addresses upon exit)
     logger.warning("registering address cache")
-    gv.address_cache = AddressCache()
+    gv.address_cache = AddressCache(writer=writer)
 
     # register Netlink Link Cache facility
     logger.warning("registering Netlink link cache")
     gv.link_cache = Link()
 
-    gv.dodag_cache = DODAG_cache()
+    # follow the changes on links, addresses and neighbors
+    if not args.no_netlink_monitor:
+        logger.warning("registering Netlink monitor")
+        gv.netlink_monitor = NetlinkMonitor(interfaces, link=gv.link_cache)
+        gv.link_cache = gv.netlink_monitor
 
     if args.root:
         if args.dodagID == []:
@@ -118,18 +201,23 @@ def main(args):
         else:
             # convert the "printable" prefixes into "network" format
             prefixes = [socket.inet_pton(socket.AF_INET6, prefix) for prefix in args.prefix]
-            for dodag in args.dodagID:
-                gv.dodag_cache.add(DODAG(instanceID=0,
-                                         version=DEFAULT_SEQUENCE_VAL,
-                                         G=1,
-                                         MOP=2,
-                                         Prf=0,
-                                         DTSN=DEFAULT_SEQUENCE_VAL,
-                                         dodagID=dodag,
-                                         advertised_prefixes=prefixes,
-                                         interfaces=interfaces,
-                                         active=True,
-                                         is_root=True))
+            instanceIDs = args.instance_id + [0] * (len(args.dodagID) - len(args.instance_id))
+            for (dodag, instanceID) in zip(args.dodagID, instanceIDs):
+                dodag = DODAG(instanceID=instanceID,
+                              version=DEFAULT_SEQUENCE_VAL,
+                              G=1,
+                              MOP=2,
+                              Prf=0,
+                              DTSN=DEFAULT_SEQUENCE_VAL,
+                              dodagID=dodag,
+                              advertised_prefixes=prefixes,
+                              interfaces=interfaces,
+                              active=True,
+                              is_root=True)
+                dodag.instance.dodag_cache.add(dodag)
+
+    # the CLI can be served from now on
+    gv.snapshots.start()
 
     # start the process loop that listen for all interfaces
     try:
@@ -144,12 +232,16 @@ def main(args):
             os.kill(pid, SIGKILL)
 
         # poison every DODAG the node is attached to
-        gv.dodag_cache.poison_all()
+        gv.instances.poison_all()
 
         # clean up the resources allocated to the DODAGs
-        gv.dodag_cache.cleanup()
+        gv.instances.cleanup()
 
-        gv.route_cache.empty_cache()
+        gv.instances.empty_route_caches()
         gv.address_cache.emptyCache()
 
+        # wait for the pending kernel updates
+        if writer:
+            writer.stop()
+
         logging.shutdown()
@@ -0,0 +1,115 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Memory benchmark: reports how many bytes a neighbor (Node) and a downward
+route (Route) take.
+
+Objects that are shared between many neighbors or routes (the DODAG, the
+interned interface names and next hops) are not accounted for.
+
+Usage: python memory_benchmark.py [count]"""
+
+import sys
+import socket
+import struct
+
+from neighbor_cache import Node
+from route_cache import Route
+from lollipop import Lollipop
+from tools import intern_string
+
+
+def deep_size(obj, seen):
+    """Size of an object and of the objects it references (objects whose
+    id is in seen are skipped)"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if hasattr(obj, "__dict__"):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, "__slots__", ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            size += deep_size(key, seen) + deep_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_size(item, seen)
+    return size
+
+
+def resident_memory():
+    """Resident set size of the process (in bytes), or None"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * socket.os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class BenchmarkDODAG(object):
+    """Stands for the DODAG that all the neighbors share"""
+    dodagID = "2001:db8::1"
+    version = Lollipop(240)
+
+
+def link_local(index):
+    return "\xfe\x80" + "\x00" * 6 + struct.pack("!Q", index)
+
+
+def measure(count, build):
+    """Return (bytes per object according to sys.getsizeof, bytes per object
+    according to the resident memory)"""
+    shared = set([id(value) for value in (intern_string("eth0"), BenchmarkDODAG, None, True, False)])
+
+    before = resident_memory()
+    objects = [build(index) for index in xrange(count)]
+    after = resident_memory()
+
+    seen = set(shared)
+    seen.add(id(objects))
+    size = sum(deep_size(obj, seen) for obj in objects) / float(count)
+    if before is None or after is None:
+        return (size, None)
+    return (size, (after - before) / float(count))
+
+
+def main(count):
+    dodag = BenchmarkDODAG()
+
+    results = [("neighbor", measure(count, lambda index: Node("eth0", link_local(index), dodag, 256 + index % 1024, 240))),
+               ("route", measure(count, lambda index: Route("2001:db8::%x/128" % index,
+                                                            socket.inet_ntop(socket.AF_INET6, link_local(index % 16)),
+                                                            "eth0"))),
+              ]
+
+    for (name, (size, resident)) in results:
+        line = "bytes per %s: %.1f" % (name, size)
+        if resident is not None:
+            line += " (resident memory: %.1f)" % resident
+        print line
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
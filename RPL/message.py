@@ -18,7 +18,10 @@
 # this software.
 
 class Message(object):
-    """Container for a message, as received by RPL sockets"""
+    """Container for a message, as received by RPL sockets
+    (it is pickled with protocol 2, which supports __slots__)"""
+    __slots__ = ("msg", "src", "dst", "iface")
+
     def __init__(self, msg, src, dst, iface):
         super(Message, self).__init__()
         self.msg = msg
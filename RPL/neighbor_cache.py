@@ -21,63 +21,232 @@
 Neighbor Cache (store the preferred parent and the set of backup parents)
 """
 from threading import RLock
-import of_zero as of
+from collections import OrderedDict
+import heapq
 from address import Address
 from route_cache import Route
 import global_variables as gv
-from rpl_constants import INFINITE_RANK
-from lollipop import Lollipop
+from rpl_constants import INFINITE_RANK, \
+                          DEFAULT_NEIGHBOR_CACHE_SIZE
+from tools import intern_string
+from snapshot import state_changed
 
 
 import logging
 logger = logging.getLogger("RPL")
 
 class NeighborCache(object):
-    __cache = []
-    __parents = []
     __preferred = None
+    __stale_default_route = None
 
 
-    def __init__(self):
+    def __init__(self, instance, capacity=DEFAULT_NEIGHBOR_CACHE_SIZE):
+        """Neighbor cache:
+        - instance: the RPL Instance the neighbors belong to
+        - capacity: maximum number of neighbors (None for an unbounded cache)"""
         self.__lock = RLock()
+        self.instance = instance
+        self.capacity = capacity
+        # neighbors are indexed by (interface, binary address, DODAG identity),
+        # the least recently heard neighbors come first
+        self.__nodes = OrderedDict()
+        # neighbors of each DODAG: id(DODAG) -> ordered dict of key -> node
+        self.__by_dodag = {}
+        # candidate parents of each DODAG: id(DODAG) -> heap of [sort key, sequence, node]
+        # (entries of nodes that have since been updated or removed hold None
+        # instead of the node, and are discarded when they reach the top)
+        self.__candidates = {}
+        self.__sequence = 0
+
+        # statistics
+        self.evictions = 0  # neighbors removed to make room for a new one
+        self.rejections = 0  # new neighbors that were not admitted in a full cache
+
+
+    @staticmethod
+    def __key(iface, address, dodag):
+        # the DODAG cache never holds two equal DODAGs, hence the identity of
+        # the DODAG object is enough (and much cheaper than DODAG.__eq__)
+        return (iface, address, id(dodag))
 
 
     def register_node(self, iface, address, dodag, rank, dtsn):
-        """Register a node to the neighbor cache"""
+        """Register a node to the neighbor cache.
+        Returns True if the DIO parent selection may change because of this
+        node (that is, if the node is the preferred parent of the DODAG and
+        its rank changed, or if it is now better than the preferred parent)"""
+        key = self.__key(iface, address, dodag)
         with self.__lock:
-            for node in self.__cache:
-                # check if the neighbor is not already in the cache
-                # update the rank value if necessary
-                if node.iface == iface and \
-                node.address == address and \
-                node.dodag == dodag:
-                    node.rank = rank
-                    node.dtsn.set_val(dtsn)
-                    return
-            self.__cache.append(Node(iface, address, dodag, rank, dtsn))
-            logger.debug("Register new node: %s" % self.__cache[-1])
+            try:
+                node = self.__nodes.pop(key)
+            except KeyError:
+                if not self.__admit(dodag, rank):
+                    logger.debug("neighbor cache is full, ignoring %s" % repr(Address(address)))
+                    self.rejections += 1
+                    return False
+
+                node = Node(iface, address, dodag, rank, dtsn)
+                node.last_dio = dodag.scheduler.time()
+                # neighbors that stop sending DIO messages are eventually removed
+                node.lifetime = gv.timing_wheel.schedule(dodag.neighbor_lifetime(), self.nodes_expired, node)
+                self.__nodes[key] = node
+                self.__by_dodag.setdefault(id(dodag), OrderedDict())[key] = node
+                logger.debug("Register new node: %s" % node)
+                old_rank = None
+                state_changed()
+                # routes through the node might now be preferred
+                dodag.downward_routes_nexthop_changed(address)
+            else:
+                # the neighbor is already in the cache, update the rank value
+                # if necessary
+                old_rank = node.rank
+                node.rank = rank
+                node.dtsn = dtsn
+                node.last_dio = dodag.scheduler.time()
+                node.lifetime.reschedule(dodag.neighbor_lifetime())
+                # the node becomes the most recently heard neighbor
+                self.__nodes[key] = node
+                if old_rank != rank:
+                    state_changed()
+                    if dodag.DAGRank(old_rank) != dodag.DAGRank(rank):
+                        dodag.downward_routes_nexthop_changed(address)
+
+            self.__push_candidate(node)
+
+            preferred = dodag.preferred_parent
+            if preferred is None or preferred.candidate is None:
+                return True
+            if preferred is node:
+                return old_rank != rank
+            return node.candidate[0] < preferred.candidate[0]
+
+
+    def __is_protected(self, node):
+        """Indicates if a node is a preferred parent (of the node or of a DODAG)"""
+        return node is self.__preferred or node is node.dodag.preferred_parent
+
+
+    def __admit(self, dodag, rank):
+        """Make room for a new neighbor (of rank rank in dodag) if the cache is
+        full. Neighbors that are not parents are evicted first, starting with
+        the least recently heard one. A parent that is not preferred is only
+        evicted in favor of a new neighbor that would be a parent.
+        Returns False if the new neighbor should not be admitted
+        (the lock must be held)"""
+        if self.capacity is None or len(self.__nodes) < self.capacity:
+            return True
+
+        would_be_parent = dodag.DAGRank(dodag.rank) > dodag.DAGRank(rank)
+
+        victim = None
+        for node in self.__nodes.itervalues():
+            if self.__is_protected(node):
+                continue
+            if not self.is_parent(node):
+                victim = node
+                break
+            if would_be_parent and victim is None:
+                victim = node
+
+        if victim is None:
+            return False
+
+        logger.debug("neighbor cache is full, evicting %s" % repr(Address(victim.address)))
+        # the routes through the victim are left untouched: it has not
+        # disappeared, it is only not tracked as a potential parent anymore
+        self.__remove(victim)
+        self.evictions += 1
+        return True
+
+
+    def get_stats(self):
+        """Return a text presentation of the neighbor cache statistics"""
+        stats = "neighbors: %d (capacity: %s)\n" % (len(self.__nodes), self.capacity or "unbounded")
+        stats += "evicted neighbors: %d\n" % self.evictions
+        stats += "rejected neighbors: %d" % self.rejections
+        return stats
 
 
     def get_node(self, iface, address, dodag):
         """Return a matching Node object or None"""
         with self.__lock:
-            for node in self.__cache:
-                if node.iface == iface and \
-                node.address == address and \
-                node.dodag == dodag:
-                    return node
+            return self.__nodes.get(self.__key(iface, address, dodag))
 
 
-    @staticmethod
-    def compute_DIO_parents(neighs):
-        """Establish a parent list for the node"""
-        parents = []
+    def get_nodes_by_dodag(self, dodag):
+        """Return the neighbors that belong to a DODAG"""
+        with self.__lock:
+            try:
+                return self.__by_dodag[id(dodag)].values()
+            except KeyError:
+                return []
+
+
+    def __remove(self, node):
+        """Remove a node from the indexes (the lock must be held)"""
+        key = self.__key(node.iface, node.address, node.dodag)
+        del self.__nodes[key]
+        neighbors = self.__by_dodag[id(node.dodag)]
+        del neighbors[key]
+        if not neighbors:
+            del self.__by_dodag[id(node.dodag)]
+            self.__candidates.pop(id(node.dodag), None)
+        node.lifetime.cancel()
+
+        # remove from the candidate parents
+        if node.candidate:
+            node.candidate[2] = None
+            node.candidate = None
+
+        # routes through the node are not preferred anymore
+        node.dodag.downward_routes_nexthop_changed(node.address)
+
+        state_changed()
+
+
+    def __push_candidate(self, node):
+        """(Re)insert a node in the candidate heap of its DODAG, after its
+        sort key changed (the lock must be held)"""
+        if node.candidate:
+            node.candidate[2] = None
+        self.__sequence += 1
+        node.candidate = [node.sort_key(), self.__sequence, node]
+        heap = self.__candidates.setdefault(id(node.dodag), [])
+        heapq.heappush(heap, node.candidate)
+
+        # get rid of the outdated entries when they take too much room
+        if len(heap) > 2 * len(self.__by_dodag[id(node.dodag)]) + 16:
+            heap[:] = [entry for entry in heap if entry[2] is not None]
+            heapq.heapify(heap)
+
+
+    def refresh_candidates(self, dodag):
+        """Recompute the sort keys of the neighbors of a DODAG (after the
+        parameters used by the objective function changed)"""
+        with self.__lock:
+            for node in self.get_nodes_by_dodag(dodag):
+                self.__push_candidate(node)
+
+
+    def best_candidate(self, dodag):
+        """Return the neighbor of the DODAG that has the lowest sort key"""
+        with self.__lock:
+            heap = self.__candidates.get(id(dodag))
+            while heap and heap[0][2] is None:
+                heapq.heappop(heap)
+            if heap:
+                return heap[0][2]
+            return None
 
-        for n in neighs:
-            if n.dodag.DAGRank(n.dodag.rank) > n.dodag.DAGRank(n.rank):
-                parents.append(n)
 
-        return parents
+    def is_parent(self, node):
+        """Indicates if a neighbor is a DIO parent (its rank is lower than the
+        rank of the node in the DODAG)"""
+        dodag = node.dodag
+        with self.__lock:
+            return self.get_node(node.iface, node.address, dodag) is node and \
+                   dodag.DAGRank(dodag.rank) > dodag.DAGRank(node.rank)
+
 
     @staticmethod
     def rank_increase_is_legit(node):
@@ -105,26 +274,36 @@ class NeighborCache(object):
         with self.__lock:
             if len(parents) == 0:
                 if self.__preferred:
+                    state_changed()
                     logger.info("Removing route through %s" % self.__preferred.address)
                     # remove routes to preferred
-                    gv.route_cache.remove_route(Route("default",
+                    self.instance.route_cache.remove_route(Route("default",
                                                       self.__preferred.address,
                                                       self.__preferred.iface,
                                                       True))
 
                     self.__preferred.preferred = False
+                    self.__refresh_candidate(self.__preferred)
                     self.__preferred = None
+                if self.__stale_default_route:
+                    self.instance.route_cache.remove_route(self.__stale_default_route)
+                    self.__stale_default_route = None
                 return True
             elif id(parents[0]) != id(self.__preferred):
                 logger.info("A new DIO parent has been selected %s" % parents[0].address)
+                state_changed()
+
+                # the default route through the previous parent is kept until
+                # the route through the new parent replaces it
+                old_default_route = self.__stale_default_route
+
                 if self.__preferred:
-                    logger.info("Removing route through %s" % self.__preferred.address)
-                    # remove routes to preferred
-                    gv.route_cache.remove_route(Route("default",
-                                                      self.__preferred.address,
-                                                      self.__preferred.iface,
-                                                      True))
+                    old_default_route = Route("default",
+                                              self.__preferred.address,
+                                              self.__preferred.iface,
+                                              True)
                     self.__preferred.preferred = False
+                    self.__refresh_candidate(self.__preferred)
 
                     DAGRank = self.__preferred.dodag.DAGRank
 
@@ -133,25 +312,34 @@ class NeighborCache(object):
                     # removed, while some others might need to be added
                     if parents[0].dodag != self.__preferred.dodag:
                         logger.debug("downward routes need to be updated")
-                        routes_to_remove = self.__preferred.dodag.downward_routes_get() - \
-                                           parents[0].dodag.downward_routes_get()
-                        gv.route_cache.remove_routes(routes_to_remove)
-                        routes_to_add = parents[0].dodag.downward_routes_get() - \
-                                        self.__preferred.dodag.downward_routes_get()
-                        gv.route_cache.add_routes(routes_to_add)
+                        old_dodag = self.__preferred.dodag
+                        new_dodag = parents[0].dodag
+                        # the route cache only withdraws the routes it holds
+                        # (and only installs the routes it does not hold)
+                        old_routes = old_dodag.downward_routes_get() | old_dodag.installed_downward_routes_get()
+                        # the pending changes of both DODAGs are superseded
+                        # by the update below, after which the routes of the
+                        # new DODAG are the ones it handed over
+                        old_dodag.take_route_changes()
+                        new_dodag.take_route_changes()
+                        new_routes = new_dodag.installed_downward_routes_get()
+                        self.instance.route_cache.update_routes(old_routes - new_routes, new_routes)
                     # new parent is from the exact same DODAG, check if the
                     # new rank matches the DAGMaxRankIncrease value
                     elif DAGRank(parents[0].rank) > DAGRank(self.__preferred.rank):
                         logger.info("New parent has a higher rank that the previous preferred parent, poisoning the DODAG")
+                        logger.info("Removing route through %s" % self.__preferred.address)
+                        self.instance.route_cache.remove_route(old_default_route)
                         self.__preferred.dodag.rank = INFINITE_RANK
                         self.__preferred = None
                         return False
 
-                dodag = gv.dodag_cache.get_active_dodag()
+                dodag = self.instance.dodag_cache.get_active_dodag()
                 if dodag:
                     dodag.active = False
 
                 parents[0].preferred = True
+                self.__refresh_candidate(parents[0])
                 parents[0].dodag.active = True
 
                 # if the new preferred DIO parent is on a different DODAG version,
@@ -161,16 +349,24 @@ class NeighborCache(object):
                     parents[0].dodag.DIOtimer.hear_inconsistent()
 
                 self.__preferred = parents[0]
+                self.__stale_default_route = None
 
                 logger.info("Adding route through %s" % self.__preferred.address)
-                # add routes to the new preferred node
-                gv.route_cache.add_route(Route("default",
-                                               self.__preferred.address,
-                                               self.__preferred.iface,
-                                               True))
+                # add routes to the new preferred node (replacing the route
+                # through the previous one)
+                self.instance.route_cache.replace_route(old_default_route,
+                                             Route("default",
+                                                   self.__preferred.address,
+                                                   self.__preferred.iface,
+                                                   True))
                 return True
             return True
 
+    def __refresh_candidate(self, node):
+        """The preferred flag of node changed, update its sort key"""
+        if node.candidate:
+            self.__push_candidate(node)
+
     def get_preferred(self):
         """Return the preferred parent"""
         with self.__lock:
@@ -180,11 +376,11 @@ class NeighborCache(object):
 
     def get_parent_list(self):
         with self.__lock:
-            return self.__parents
+            return [node for node in self.__nodes.values() if self.is_parent(node)]
 
     def get_neighbor_list(self):
         with self.__lock:
-            return self.__cache
+            return self.__nodes.values()
 
 
     def update_DIO_parent(self):
@@ -195,34 +391,29 @@ class NeighborCache(object):
         """
         old_pref_parent = self.get_preferred()
 
-        self.__parents = []
-
         # select or update one preferred parent per DODAG
         # (even if not currently active)
-        dodags = gv.dodag_cache.get_dodag()
-
+        dodags = self.instance.dodag_cache.get_dodag()
 
         for dodag in dodags:
-            with self.__lock:
-                neighbors = [neigh for neigh in self.__cache if neigh.dodag == dodag]
-            parents = self.compute_DIO_parents(neighbors)
-            self.__parents.extend(parents)
-            parents.sort()
-            try:
-                if self.rank_increase_is_legit(parents[0]):
-                    dodag.preferred_parent = parents[0]
-                else:
-                    dodag.preferred_parent = None
-            except:
+            # within a DODAG, the best candidate is also the one with the
+            # lowest rank: if it is not a parent, no other neighbor is
+            candidate = self.best_candidate(dodag)
+            if candidate and self.is_parent(candidate) and self.rank_increase_is_legit(candidate):
+                dodag.preferred_parent = candidate
+            else:
                 dodag.preferred_parent = None
 
 
         # update the globally preferred parent
         # (default route will go through this parent)
 
+        # the most recent version of each DODAG is preferred
+        is_latest = self.instance.dodag_cache.is_latest
+
         # select the preferred parent
         parents = [dodag.preferred_parent for dodag in dodags if dodag.preferred_parent]
-        parents.sort()
+        parents.sort(key=lambda parent: parent.sort_key(not is_latest(parent.dodag)))
 
         completed = self.set_preferred(parents)
         while not completed:
@@ -240,6 +431,8 @@ class NeighborCache(object):
         if pref_parent:
             old_rank = pref_parent.dodag.rank
             pref_parent.dodag.rank = pref_parent.dodag.compute_rank_increase(pref_parent.rank)
+            if old_rank != pref_parent.dodag.rank:
+                state_changed()
             # node's rank has been updated
             if old_rank > pref_parent.dodag.rank:
                 pref_parent.dodag.DIOtimer.hear_inconsistent()
@@ -257,87 +450,133 @@ class NeighborCache(object):
         Note: it is expected that this function is not be called on the currently active DODAG
         """
         with self.__lock:
-            for (index, node) in reversed(list(enumerate(self.__cache))):
-                if dodag == node.dodag\
-                   and not node.dodag.active:
+            for node in self.get_nodes_by_dodag(dodag):
+                if not node.dodag.active:
                     logger.debug("Removing node %s from cache (DODAG ID: %s, version: %d)" % (repr(Address(node.address)), repr(Address(dodag.dodagID)), dodag.version.get_val()))
-
-                    del self.__cache[index]
-
-                    # remove from the parent list (if appropriate)
-                    try:
-                        self.__parents.remove(node)
-                    except ValueError:
-                        pass
-
-                    del node
+                    self.__remove(node)
 
 
     def remove_node_by_address(self, dodag, address):
         """Remove a specified node from the neighbor cache using its address and DODAG information"""
         updated = False
         with self.__lock:
-            for (index, node) in reversed(list(enumerate(self.__cache))):
-                if dodag == node.dodag \
-                   and node.address == address:
+            for node in self.get_nodes_by_dodag(dodag):
+                if node.address == address:
                     logger.debug("Removing node %s from cache (DODAG ID: %s, version: %d)" % (repr(Address(node.address)), repr(Address(dodag.dodagID)), dodag.version.get_val()))
-
-                    del self.__cache[index]
-
-                    # remove from the parent list (if appropriate)
-                    try:
-                        self.__parents.remove(node)
-                    except ValueError:
-                        pass
+                    self.__remove(node)
 
                     if node.dodag.active:
+                        # routes through the removed node are replaced by
+                        # alternative downward routes (when they exist): the
+                        # route index of the DODAG knows which of its routes
+                        # go through the node
                         dodag.downward_routes_remove_by_nexthop(node.address)
-
-                        updated += gv.route_cache.remove_nexthop(node.address)
+                        (removed_routes, new_routes) = dodag.take_route_changes()
+                        updated += self.instance.route_cache.update_routes(removed_routes, new_routes)
 
                         if id(node) == id(self.__preferred):
-                            # remove routes to the preferred DIO parent
-                            updated += gv.route_cache.remove_route(Route("default",
-                                                            self.__preferred.address,
-                                                            self.__preferred.iface,
-                                                            True))
+                            # the default route through the preferred DIO
+                            # parent is replaced (or removed) during the next
+                            # parent selection
+                            self.__stale_default_route = Route("default",
+                                                               self.__preferred.address,
+                                                               self.__preferred.iface,
+                                                               True)
                             self.__preferred = None
-
-                    del node
+                            updated = True
         return updated
 
 
+    def nodes_expired(self, nodes):
+        """Remove neighbors that have not sent DIO messages for too long
+        (called by the timing wheel)"""
+        dodags = []
+        with self.__lock:
+            for node in nodes:
+                logger.debug("Neighbor %s has been silent for too long" % repr(Address(node.address)))
+                self.remove_node_by_address(node.dodag, node.address)
+                dodags.append(node.dodag)
+        self.reselect_parents(dodags)
+
+
+    def reselect_parents(self, dodags):
+        """Select new parents after neighbors were removed from the DODAGs"""
+        if not dodags:
+            return
+
+        updated = self.update_DIO_parent()
+        if updated:
+            for dodag in dodags:
+                try:
+                    dodag.DIOtimer.hear_inconsistent()
+                except AttributeError:  # DODAG has been cleaned up
+                    pass
+
+
+    def remove_nodes_by_iface(self, iface, address=None):
+        """Remove the neighbors reachable through an interface (or only the
+        neighbor whose binary address is address, when specified).
+        Returns the DODAGs the removed neighbors belonged to"""
+        with self.__lock:
+            nodes = [node for node in self.__nodes.values()
+                     if node.iface == iface and \
+                     (address is None or node.address == address)]
+            for node in nodes:
+                self.remove_node_by_address(node.dodag, node.address)
+            return [node.dodag for node in nodes]
+
+
     def has_neighbors(self, dodag):
         """
         Returns true of the neighbor cache contains at least one node belonging to the DODAG in its cache.
         Returns false otherwise.
         """
 
-        has_neighbor = False
-
         with self.__lock:
-            for node in self.__cache:
-                if node.dodag == dodag:
-                    has_neighbor = True
-                    break
+            return id(dodag) in self.__by_dodag
 
-        return has_neighbor
+
+    def count_neighbors(self, dodag):
+        """Returns the number of nodes belonging to the DODAG in the neighbor cache"""
+        with self.__lock:
+            try:
+                return len(self.__by_dodag[id(dodag)])
+            except KeyError:
+                return 0
 
 
 
 
 class Node(object):
-    __cmp__ = of.compare_parents
+    __slots__ = ("iface", "address", "rank", "dodag", "preferred", "dtsn", "lifetime",
+                 "candidate", "static_key", "static_key_params", "last_dio")
+
     def __init__(self, iface, address, dodag, rank, dtsn):
-        self.iface = iface
-        self.address = address
+        self.iface = intern_string(iface)
+        self.address = intern_string(address)
         self.rank = rank
         self.dodag = dodag
         self.preferred = False
-        self.dtsn = Lollipop(dtsn)
+        self.dtsn = dtsn  # value of a Lollipop counter
+        self.lifetime = None  # timing wheel entry
+        self.candidate = None  # entry in the candidate heap of the DODAG
+        self.static_key = None  # cached part of the sort key
+        self.static_key_params = None  # rank, DODAG parameters and objective function the cached key was computed with
+        self.last_dio = None  # time of the last DIO message received from the node
 
         assert Address(self.address).is_linklocal()
 
+    def sort_key(self, stale=False):
+        """Sort key of the node as a parent (the best parent has the lowest key)
+        - stale: the DODAG of the node has been replaced by a newer version"""
+        dodag = self.dodag
+        of = dodag.instance.of
+        params = (self.rank, dodag.G, dodag.Prf, dodag.MinHopRankIncrease, of)
+        if params != self.static_key_params:
+            self.static_key = of.parent_static_key(self)
+            self.static_key_params = params
+        return of.parent_key(self, stale, self.static_key)
+
     def __str__(self):
         string  = "address: %s\n" % self.address
         string += "rank: %d\n" % self.rank
@@ -346,3 +585,100 @@ class Node(object):
 
         return string
 
+
+
+def test_remove_node_by_address():
+    import socket
+    from instance import simulated_node
+    from dodag import DODAG
+
+    interfaces = simulated_node(instance_tables={2: "rpl2"})
+    child = socket.inet_pton(socket.AF_INET6, "fe80::1")
+    backup = socket.inet_pton(socket.AF_INET6, "fe80::2")
+
+    # the same child advertises routes in two instances
+    dodags = {}
+    for instanceID in (1, 2):
+        dodag = DODAG(instanceID, 240, 1, 2, 0, 240,
+                      socket.inet_pton(socket.AF_INET6, "2001:db8::%d" % instanceID),
+                      interfaces, active=True)
+        gv.instances.get(instanceID).dodag_cache.add(dodag)
+        dodag.instance.neigh_cache.register_node("eth0", child, dodag, 512, 240)
+        dodag.downward_route_add(Route("2001:db8:1::1/128", child, "eth0", False))
+        dodags[instanceID] = dodag
+    dodags[1].downward_route_add(Route("2001:db8:1::1/128", backup, "eth0", False))
+    for dodag in dodags.itervalues():
+        dodag.instance.route_cache.update_routes(*dodag.take_route_changes())
+
+    # the child leaves the first instance: its route is replaced by the
+    # alternative one, the route of the other instance is left alone
+    instance = gv.instances.get(1)
+    assert instance.neigh_cache.remove_node_by_address(dodags[1], child)
+    assert instance.route_cache.route_cache == set([Route("2001:db8:1::1/128", backup, "eth0", False)])
+    assert gv.instances.get(2).route_cache.route_cache == \
+           set([Route("2001:db8:1::1/128", child, "eth0", False)])
+
+
+def test_register_node_reselection():
+    import socket
+    from instance import simulated_node
+    from dodag import DODAG
+
+    interfaces = simulated_node()
+    dodag = DODAG(1, 240, 1, 2, 0, 240, socket.inet_pton(socket.AF_INET6, "2001:db8::1"), interfaces)
+    dodag.instance.dodag_cache.add(dodag)
+    neigh_cache = dodag.instance.neigh_cache
+    (parent, worse, better) = [socket.inet_pton(socket.AF_INET6, "fe80::%d" % i) for i in (1, 2, 3)]
+
+    # without a preferred parent, any neighbor calls for a parent selection
+    assert neigh_cache.register_node("eth0", parent, dodag, 512, 240)
+    dodag.preferred_parent = neigh_cache.get_node("eth0", parent, dodag)
+
+    # the preferred parent only does when its rank changes
+    assert not neigh_cache.register_node("eth0", parent, dodag, 512, 240)
+    assert neigh_cache.register_node("eth0", parent, dodag, 768, 240)
+    assert not neigh_cache.register_node("eth0", parent, dodag, 768, 240)
+
+    # another neighbor only does when it is better than the preferred parent
+    assert not neigh_cache.register_node("eth0", worse, dodag, 1024, 240)
+    assert not neigh_cache.register_node("eth0", worse, dodag, 1024, 240)
+    assert neigh_cache.register_node("eth0", better, dodag, 256, 240)
+    assert neigh_cache.register_node("eth0", worse, dodag, 256, 240)
+
+
+def test_capacity():
+    import socket
+    from instance import simulated_node
+    from dodag import DODAG
+
+    interfaces = simulated_node(neighbor_capacity=3)
+    dodag = DODAG(1, 240, 1, 2, 0, 240, socket.inet_pton(socket.AF_INET6, "2001:db8::1"), interfaces)
+    dodag.instance.dodag_cache.add(dodag)
+    dodag.rank = 1024
+    neigh_cache = dodag.instance.neigh_cache
+    address = lambda name: socket.inet_pton(socket.AF_INET6, "fe80::%x" % name)
+    known = lambda: set(node.address for node in neigh_cache.get_neighbor_list())
+
+    # the preferred parent is the least recently heard neighbor
+    neigh_cache.register_node("eth0", address(0xa), dodag, 512, 240)
+    dodag.preferred_parent = neigh_cache.get_node("eth0", address(0xa), dodag)
+    neigh_cache.register_node("eth0", address(0xb), dodag, 768, 240)
+    neigh_cache.register_node("eth0", address(0xc1), dodag, 2048, 240)
+
+    # a new neighbor takes the place of the least recently heard neighbor
+    # that is not a parent
+    neigh_cache.register_node("eth0", address(0xc2), dodag, 2048, 240)
+    assert known() == set([address(0xa), address(0xb), address(0xc2)])
+
+    # even when it would be a parent
+    neigh_cache.register_node("eth0", address(0xd), dodag, 256, 240)
+    assert known() == set([address(0xa), address(0xb), address(0xd)])
+
+    # once only parents are left, a neighbor that would not be a parent is
+    # rejected, and one that would be evicts a parent that is not preferred
+    assert not neigh_cache.register_node("eth0", address(0xc3), dodag, 2048, 240)
+    neigh_cache.register_node("eth0", address(0xe), dodag, 256, 240)
+    assert known() == set([address(0xa), address(0xd), address(0xe)])
+    neigh_cache.register_node("eth0", address(0xf), dodag, 256, 240)
+    assert known() == set([address(0xa), address(0xe), address(0xf)])
+    assert (neigh_cache.evictions, neigh_cache.rejections) == (4, 1)
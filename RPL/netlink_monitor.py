@@ -0,0 +1,244 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Netlink monitor: listen to the kernel notifications on links, IPv6
+addresses and neighbors, so that the caches are updated as soon as the
+kernel state changes (instead of being polled)"""
+
+import socket
+import struct
+import errno
+from address import Address
+import global_variables as gv
+
+import logging
+logger = logging.getLogger("RPL")
+
+NETLINK_ROUTE = 0
+
+# multicast groups
+RTMGRP_LINK = 0x1
+RTMGRP_NEIGH = 0x4
+RTMGRP_IPV6_IFADDR = 0x100
+
+# message types
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWNEIGH = 28
+RTM_DELNEIGH = 29
+
+# message flags
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+# attributes
+IFLA_ADDRESS = 1
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+NDA_DST = 1
+
+IFF_UP = 0x1
+NUD_FAILED = 0x20
+
+NLMSGHDR = struct.Struct("=LHHLL")  # length, type, flags, sequence, pid
+IFINFOMSG = struct.Struct("=BxHiII")  # family, type, index, flags, change
+IFADDRMSG = struct.Struct("=BBBBi")  # family, prefix length, flags, scope, index
+NDMSG = struct.Struct("=BxxxiHBB")  # family, index, state, flags, type
+RTATTR = struct.Struct("=HH")  # length, type
+RTGENMSG = struct.Struct("=Bxxx")  # family
+
+
+def align(length):
+    """Netlink messages and attributes are aligned on 4 bytes"""
+    return (length + 3) & ~3
+
+
+def parse_attributes(data):
+    """Return a dictionary of the (type: value) routing attributes"""
+    attributes = {}
+    while len(data) >= RTATTR.size:
+        (length, attr_type) = RTATTR.unpack_from(data)
+        if length < RTATTR.size:
+            break
+        attributes[attr_type] = data[RTATTR.size:length]
+        data = data[align(length):]
+    return attributes
+
+
+class NetlinkMonitor(object):
+    def __init__(self, interfaces, link=None):
+        """Netlink monitor:
+        - interfaces: interfaces RPL is running on (other interfaces are ignored)
+        - link: a Routing Link object, used for the interfaces the monitor
+          has no information on"""
+        self.interfaces = interfaces
+        self.link = link
+        self.ifnames = {}  # interface index -> interface name
+        self.lladdrs = {}  # interface name -> link-layer address
+        self.sequence = 0
+
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK | RTMGRP_NEIGH | RTMGRP_IPV6_IFADDR))
+
+        # retrieve the current state, then follow the changes
+        self.reload()
+
+
+    def fileno(self):
+        """File descriptor to poll for incoming notifications"""
+        return self.sock.fileno()
+
+
+    def reload(self):
+        """Retrieve the interfaces and addresses currently configured"""
+        self.sock.setblocking(True)
+        self.dump(RTM_GETLINK, socket.AF_UNSPEC)
+        gv.address_cache.kernel_view_reset()
+        self.dump(RTM_GETADDR, socket.AF_INET6)
+        self.sock.setblocking(False)
+
+
+    def dump(self, msg_type, family):
+        """Request the kernel to dump a table and process the answer"""
+        self.sequence += 1
+        request = NLMSGHDR.pack(NLMSGHDR.size + RTGENMSG.size, msg_type,
+                                NLM_F_REQUEST | NLM_F_DUMP, self.sequence, 0) + \
+                  RTGENMSG.pack(family)
+        self.sock.send(request)
+
+        done = False
+        while not done:
+            done = self.process_data(self.sock.recv(65536))
+
+
+    def process(self):
+        """Process all the pending notifications (the socket is readable)"""
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error, err:
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if err.errno == errno.ENOBUFS:
+                    # some notifications are lost, the caches can not be
+                    # trusted anymore
+                    logger.warning("netlink notifications have been lost, reloading the link and address caches")
+                    self.reload()
+                    continue
+                raise
+            self.process_data(data)
+
+
+    def process_data(self, data):
+        """Dispatch the netlink messages contained in data.
+        Returns True when the end of a dump is reached"""
+        done = False
+        while len(data) >= NLMSGHDR.size:
+            (length, msg_type, flags, sequence, pid) = NLMSGHDR.unpack_from(data)
+            if length < NLMSGHDR.size:
+                break
+            payload = data[NLMSGHDR.size:length]
+            data = data[align(length):]
+
+            if msg_type == NLMSG_DONE:
+                done = True
+            elif msg_type == NLMSG_ERROR:
+                logger.debug("netlink error message received")
+                done = True
+            elif msg_type in (RTM_NEWLINK, RTM_DELLINK):
+                self.handle_link(msg_type, payload)
+            elif msg_type in (RTM_NEWADDR, RTM_DELADDR):
+                self.handle_address(msg_type, payload)
+            elif msg_type in (RTM_NEWNEIGH, RTM_DELNEIGH):
+                self.handle_neighbor(msg_type, payload)
+        return done
+
+
+    def handle_link(self, msg_type, payload):
+        (family, link_type, index, flags, change) = IFINFOMSG.unpack_from(payload)
+        attributes = parse_attributes(payload[IFINFOMSG.size:])
+
+        name = attributes.get(IFLA_IFNAME, "").rstrip("\0") or self.ifnames.get(index)
+        if not name:
+            return
+
+        if msg_type == RTM_DELLINK:
+            self.ifnames.pop(index, None)
+            self.lladdrs.pop(name, None)
+        else:
+            self.ifnames[index] = name
+            if IFLA_ADDRESS in attributes:
+                self.lladdrs[name] = ":".join(["%02x" % ord(byte) for byte in attributes[IFLA_ADDRESS]])
+
+        if name not in self.interfaces:
+            return
+
+        if msg_type == RTM_DELLINK or not flags & IFF_UP:
+            logger.info("interface %s is down or has been removed" % name)
+            gv.instances.remove_nodes_by_iface(name)
+
+
+    def handle_address(self, msg_type, payload):
+        (family, prefix_len, flags, scope, index) = IFADDRMSG.unpack_from(payload)
+        attributes = parse_attributes(payload[IFADDRMSG.size:])
+
+        if family != socket.AF_INET6 or IFA_ADDRESS not in attributes or index not in self.ifnames:
+            return
+
+        address = repr(Address(attributes[IFA_ADDRESS]))
+        if msg_type == RTM_NEWADDR:
+            gv.address_cache.kernel_address_added(address, self.ifnames[index])
+        else:
+            gv.address_cache.kernel_address_removed(address, self.ifnames[index])
+
+
+    def handle_neighbor(self, msg_type, payload):
+        (family, index, state, flags, neigh_type) = NDMSG.unpack_from(payload)
+        attributes = parse_attributes(payload[NDMSG.size:])
+
+        if family != socket.AF_INET6 or NDA_DST not in attributes or \
+           msg_type != RTM_NEWNEIGH or not state & NUD_FAILED:
+            return
+
+        iface = self.ifnames.get(index)
+        if iface not in self.interfaces:
+            return
+
+        address = Address(attributes[NDA_DST])
+        if not address.is_linklocal():
+            return
+
+        logger.debug("neighbor %s on %s is unreachable (NUD FAILED)" % (repr(address), iface))
+        gv.instances.remove_nodes_by_iface(iface, str(address))
+
+
+    def get_lladdr(self, iface):
+        """Return the link-layer address of an interface"""
+        try:
+            return self.lladdrs[iface]
+        except KeyError:
+            if self.link:
+                return self.link.get_lladdr(iface)
+            return None
@@ -0,0 +1,206 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Asynchronous writer for the netlink operations (routes and addresses)
+
+Caches update their in-memory state right away and queue the corresponding
+kernel operations here. An operation brings a kernel object (identified by a
+key, e.g. the target of a route) from a "before" state to an "after" state
+(None meaning that the object does not exist). Operations on the same key that
+are still pending are merged, so that only the net change reaches the kernel
+(e.g. add/remove/add becomes a single add)."""
+
+from threading import Thread, Condition
+from time import sleep, time
+try:
+    from collections import OrderedDict
+except ImportError:  # your python version might be too old already
+    from backport import OrderedDict
+
+from rpl_constants import DEFAULT_NETLINK_COALESCING_DELAY
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+class NetlinkWriter(Thread):
+    def __init__(self, coalescing_delay=DEFAULT_NETLINK_COALESCING_DELAY):
+        """Netlink writer thread:
+        - coalescing_delay: how long (in seconds) the writer waits after the
+          first operation of a batch is queued, so that more operations can be
+          merged"""
+        super(NetlinkWriter, self).__init__(name="netlink writer")
+        self.daemon = True
+        self.coalescing_delay = coalescing_delay
+
+        self.__condition = Condition()
+        self.__pending = OrderedDict()  # key -> list of (before, after, apply function)
+        self.__busy = False
+        self.__running = True
+
+        # statistics
+        self.queued = 0
+        self.coalesced = 0
+        self.applied = 0
+        self.failed = 0
+        self.batches = 0
+
+
+    def submit(self, key, before, after, apply):
+        """Queue an operation that brings the object identified by key from
+        the before state to the after state. apply(before, after) performs
+        the operation, in the writer thread"""
+        with self.__condition:
+            self.queued += 1
+            steps = self.__pending.setdefault(key, [])
+            if steps and steps[-1][1] == before:
+                # the kernel is still in the state the pending operation
+                # started from, only the net change is needed
+                before = steps.pop()[0]
+                self.coalesced += 1
+            steps.append((before, after, apply))
+            self.__condition.notify_all()
+
+
+    def supersede(self, key_prefix, key, function):
+        """Queue an operation (e.g. a table flush) that makes all pending
+        operations whose key starts with key_prefix useless. These operations
+        are discarded, and function() is called in the writer thread"""
+        with self.__condition:
+            self.queued += 1
+            for pending_key in self.__pending.keys():
+                if pending_key[:len(key_prefix)] == key_prefix:
+                    del self.__pending[pending_key]
+                    self.coalesced += 1
+            self.__pending[key] = [(None, None, lambda before, after: function())]
+            self.__condition.notify_all()
+
+
+    def run(self):
+        """Apply the queued operations, one batch at a time"""
+        while True:
+            with self.__condition:
+                while self.__running and not self.__pending:
+                    self.__condition.wait()
+                if not self.__running and not self.__pending:
+                    return
+
+            # give some time for more operations to be merged
+            if self.coalescing_delay and self.__running:
+                sleep(self.coalescing_delay)
+
+            with self.__condition:
+                batch = self.__pending
+                self.__pending = OrderedDict()
+                self.__busy = True
+
+            logger.debug("applying a batch of %d netlink operations" % len(batch))
+            for (key, steps) in batch.iteritems():
+                for (before, after, apply) in steps:
+                    try:
+                        apply(before, after)
+                        self.applied += 1
+                    except Exception, err:
+                        self.failed += 1
+                        logger.warning("netlink operation on %s failed: %s" % (repr(key), err))
+
+            with self.__condition:
+                self.batches += 1
+                self.__busy = False
+                self.__condition.notify_all()
+
+
+    def flush(self, timeout=None):
+        """Wait until all the queued operations are applied (barrier).
+        Returns False if operations are still pending after timeout seconds"""
+        deadline = None if timeout is None else time() + timeout
+        with self.__condition:
+            while self.__pending or self.__busy:
+                if not self.is_alive():
+                    return False
+                if deadline is None:
+                    self.__condition.wait(1)
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return False
+                    self.__condition.wait(remaining)
+            return True
+
+
+    def stop(self):
+        """Apply the remaining operations and stop the thread"""
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        if self.is_alive():
+            self.join()
+
+
+    def get_stats(self):
+        """Return a text presentation of the writer statistics"""
+        with self.__condition:
+            pending = len(self.__pending)
+        return "operations queued: %d\n" \
+               "operations merged or discarded: %d\n" \
+               "operations applied: %d\n" \
+               "operations failed: %d\n" \
+               "batches: %d\n" \
+               "operations pending: %d" % (self.queued, self.coalesced, self.applied,
+                                           self.failed, self.batches, pending)
+
+
+def test_netlink_writer():
+    kernel = {}
+    applied = []
+
+    def apply(before, after):
+        applied.append((before, after))
+        if after is None:
+            del kernel["a"]
+        else:
+            kernel["a"] = after
+
+    writer = NetlinkWriter(coalescing_delay=0)
+
+    # add/remove/add becomes an add
+    writer.submit("a", None, 1, apply)
+    writer.submit("a", 1, None, apply)
+    writer.submit("a", None, 2, apply)
+    writer.start()
+    assert writer.flush(timeout=5)
+    assert applied == [(None, 2)] and kernel == {"a": 2}
+
+    # operations that do not follow each other are kept apart
+    writer.submit("a", 2, 3, apply)
+    writer.submit("a", 4, None, apply)
+    assert writer.flush(timeout=5)
+    assert applied[1:] == [(2, 3), (4, None)]
+
+    # a flush discards the pending operations
+    flushed = []
+    writer.stop()
+    writer = NetlinkWriter(coalescing_delay=0)
+    writer.submit(("route", "a"), 2, None, apply)
+    writer.submit(("address", "b"), None, 1, lambda before, after: flushed.append("address"))
+    writer.supersede(("route",), ("flush",), lambda: flushed.append("flush"))
+    writer.start()
+    writer.stop()
+    assert flushed == ["address", "flush"]
+    assert writer.coalesced == 1
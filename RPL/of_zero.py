@@ -47,52 +47,125 @@ def compute_rank_increase(dodag, parent_rank):
     else:
         return parent_rank + rank_increase
 
-def compare_parents(parent1, parent2):
-    """Compare two parents"""
-
-    # sanity check
-    if parent1.dodag.OCP != parent2.dodag.OCP:
-        raise NotImplementedError("unable to compare rank between two different objective functions")
-
-    # comparison only make sense within the same RPL instance
-    if parent1.dodag.instanceID != parent2.dodag.instanceID:
-        raise NotImplementedError("current implementation only support a single RPL instance")
-
-    # over two grounded DODAG, select the one with the best administrative preference
-    if (parent1.dodag.G and parent2.dodag.G):
-        if parent1.dodag.Prf != parent2.dodag.Prf:
-            return parent2.dodag.Prf - parent1.dodag.Prf
-
-    # prefer grounded DODAG over a floating one
-    if (not parent1.dodag.G and parent2.dodag.G):
-        return 1  # parent 2
-    if (not parent2.dodag.G and parent1.dodag.G):
-        return -1 # parent 1
-
-    # if the parent belong to the same DODAG,
-    # the router that offer the most recent DODAG Version should be preferred
-    if (parent1.dodag.dodagID == parent2.dodag.dodagID) and \
-       (parent1.dodag.version != parent2.dodag.version):
-        if parent2.dodag.version > parent1.dodag.version:
-            return 1
-        else:
-            return -1
-
-    # the parent that causes the lesser resulting Rank for this node should
-    # be preferred
-    rank1 = parent1.dodag.compute_rank_increase(parent1.rank)
-    rank2 = parent2.dodag.compute_rank_increase(parent2.rank)
-    if (parent1.dodag.DAGRank(rank1) != parent2.dodag.DAGRank(rank2)):
-        return rank1 - rank2
-
-    # a preferred parent should stay preferred
-    if parent1.preferred:
-        return -1
-
-    if parent2.preferred:
-        return 1
-
-    # router that has announced a DIO message more recently should be
-    # preferred
-    return parent2.dodag.last_dio - parent1.dodag.last_dio
-
+def parent_static_key(parent):
+    """Part of the sort key of a parent that only depends on the rank of the
+    parent and on the parameters of its DODAG (so that it can be cached)"""
+    dodag = parent.dodag
+    return (not dodag.G,
+            -dodag.Prf if dodag.G else 0,
+            dodag.DAGRank(dodag.compute_rank_increase(parent.rank)))
+
+def parent_key(parent, stale=False, static_key=None):
+    """Sort key of a parent, the best parent has the lowest key. The parents
+    are ordered by:
+    - grounded DODAG first, then by decreasing administrative preference
+    - parents of a DODAG that has been replaced by a newer version (stale)
+      last (that is, after all the parents of up-to-date DODAGs with the same
+      administrative preference, whatever their DODAG and their resulting
+      rank)
+    - increasing resulting rank for this node
+    - the preferred parent first (so that it stays preferred)
+    - the parent whose DODAG announced a DIO message most recently first
+    Only the parents of a single RPL Instance are compared (each instance has
+    a neighbor cache of its own).
+    - stale: the DODAG of the parent has been replaced by a newer version
+    - static_key: value of parent_static_key(parent), if the caller caches it"""
+    if static_key is None:
+        static_key = parent_static_key(parent)
+    (not_grounded, preference, resulting_rank) = static_key
+    return (not_grounded,
+            preference,
+            stale,
+            resulting_rank,
+            not parent.preferred,
+            -(parent.last_dio or 0))
+
+
+def test_parent_key():
+    from functools import partial
+    from itertools import product
+    from math import floor
+
+    class DODAG(object):
+        OCP = OCP
+        instanceID = 1
+        MinHopRankIncrease = 256
+        dodagID = "2001::1"
+        version = 1
+        last_dio = 0
+
+        def __init__(self, G, Prf):
+            self.G = G
+            self.Prf = Prf
+            self.compute_rank_increase = partial(compute_rank_increase, self)
+
+        def DAGRank(self, rank):
+            return floor(float(rank) / self.MinHopRankIncrease)
+
+    class Node(object):
+        def __init__(self, dodag, rank, preferred):
+            self.dodag = dodag
+            self.rank = rank
+            self.preferred = preferred
+            self.last_dio = 0
+
+    def compare_parents(parent1, parent2):
+        """Comparison function the parents used to be sorted with (RFC 6552
+        criteria, negative when parent1 is preferred)"""
+        dodag1 = parent1.dodag
+        dodag2 = parent2.dodag
+        # over two grounded DODAG, select the one with the best administrative preference
+        if dodag1.G and dodag2.G and dodag1.Prf != dodag2.Prf:
+            return dodag2.Prf - dodag1.Prf
+        # prefer grounded DODAG over a floating one
+        if dodag1.G != dodag2.G:
+            return dodag2.G - dodag1.G
+        # the most recent version of the same DODAG should be preferred
+        if dodag1.dodagID == dodag2.dodagID and dodag1.version != dodag2.version:
+            return 1 if dodag2.version > dodag1.version else -1
+        # the parent that causes the lesser resulting Rank should be preferred
+        rank1 = dodag1.compute_rank_increase(parent1.rank)
+        rank2 = dodag2.compute_rank_increase(parent2.rank)
+        if dodag1.DAGRank(rank1) != dodag2.DAGRank(rank2):
+            return rank1 - rank2
+        # a preferred parent should stay preferred
+        if parent1.preferred or parent2.preferred:
+            return -1 if parent1.preferred else 1
+        # router that has announced a DIO message more recently should be preferred
+        return dodag2.last_dio - dodag1.last_dio
+
+    dodags = [DODAG(G, Prf) for (G, Prf) in product((0, 1), (0, 4))]
+    nodes = [Node(dodag, rank, preferred)
+             for (dodag, rank, preferred) in product(dodags, (256, 300, 512), (False, True))]
+
+    # the key orders parents as the comparison function did
+    for (node1, node2) in product(nodes, nodes):
+        if node1.preferred and node2.preferred:
+            continue  # only one parent is preferred at a time
+        expected = compare_parents(node1, node2)
+        key1 = parent_key(node1)
+        key2 = parent_key(node2)
+        if expected < 0:
+            assert key1 < key2
+        elif expected > 0:
+            assert key1 > key2
+
+    # a newer version of the same DODAG is preferred, as in compare_parents
+    old_dodag = DODAG(1, 0)
+    new_dodag = DODAG(1, 0)
+    new_dodag.version = 2
+    old_parent = Node(old_dodag, 256, True)
+    new_parent = Node(new_dodag, 512, False)
+    assert compare_parents(old_parent, new_parent) > 0
+    assert parent_key(old_parent, stale=True) > parent_key(new_parent)
+
+    # a stale parent also comes after the parents of another (up-to-date)
+    # DODAG, even when compare_parents prefers its lower resulting rank
+    other_dodag = DODAG(1, 0)
+    other_dodag.dodagID = "2001::2"
+    other_parent = Node(other_dodag, 512, False)
+    assert compare_parents(old_parent, other_parent) < 0
+    assert parent_key(old_parent, stale=True) > parent_key(other_parent)
+    # but not after the parents of a DODAG with a lower preference
+    old_dodag.Prf = 4
+    assert parent_key(old_parent, stale=True) < parent_key(other_parent)
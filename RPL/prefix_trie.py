@@ -0,0 +1,473 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+"""Binary prefix trie, used to aggregate the downward routes.
+
+The trie stores a value for each prefix (e.g. the route to a target). A key
+function tells which values are equivalent (e.g. the routes that share the
+same next hop). aggregate() returns the smallest set of prefixes that routes
+every address the same way as the stored prefixes (with a longest prefix
+match): when all the addresses covered by a prefix have equivalent values,
+the covering prefix replaces the prefixes below it, and it is split again as
+soon as one of them stops having an equivalent value.
+
+The aggregation is lossless: a covering prefix is only used when every one of
+its addresses is covered by the stored prefixes, so that an aggregated route
+never captures the traffic of a target that is not known to the node.
+
+The trie is path compressed, and each node records whether its whole range
+has equivalent values, hence an insertion or a removal only updates the
+nodes on the path to its prefix. The aggregated prefixes are kept on the
+nodes as well: they are only computed again below the highest node whose
+range changed, and take_changes() reports the aggregated prefixes that
+changed since its previous call."""
+
+from binascii import hexlify, unhexlify
+import socket
+
+# summary of a range where no address is covered by a stored prefix
+_INHERIT = object()
+# summary of a range where the addresses do not have equivalent values
+_MIXED = object()
+
+
+class _Node(object):
+    __slots__ = ("prefix", "length", "value", "has_value", "children", "summary", "sample",
+                 "aggregated", "count")
+
+    def __init__(self, prefix, length):
+        self.prefix = prefix
+        self.length = length
+        self.value = None
+        self.has_value = False
+        self.children = [None, None]
+        self.summary = _INHERIT  # key shared by the whole range (or _INHERIT, _MIXED)
+        self.sample = None  # a value of the range whose key is summary
+        self.aggregated = None  # (value, exact) when the node is an aggregated prefix
+        self.count = 0  # number of aggregated prefixes in the subtree of the node
+
+
+class PrefixTrie(object):
+    def __init__(self, bits=128, key=None):
+        """Prefix trie:
+        - bits: length of the addresses
+        - key: function that returns the key of a value, values with the same
+          key are equivalent (by default, the value itself is the key)"""
+        self.bits = bits
+        self.key = key if key is not None else (lambda value: value)
+        self.root = _Node(0, 0)
+        self.size = 0
+        self.changes = {}  # (prefix, length) -> (value, exact) at the previous take_changes() call, or None
+
+
+    def __bit(self, prefix, position):
+        return (prefix >> (self.bits - 1 - position)) & 1
+
+
+    def __mask(self, prefix, length):
+        return prefix & (((1 << length) - 1) << (self.bits - length))
+
+
+    def __common_length(self, a, b, length):
+        """Length of the common prefix of a and b (at most length)"""
+        return min(length, self.bits - (a ^ b).bit_length())
+
+
+    def __find(self, prefix, length):
+        """Return the path from the root to the node of a prefix, or None"""
+        node = self.root
+        path = [node]
+        while node.length < length:
+            node = node.children[self.__bit(prefix, node.length)]
+            if node is None or node.length > length or self.__mask(prefix, node.length) != node.prefix:
+                return None
+            path.append(node)
+        return path
+
+
+    def insert(self, prefix, length, value):
+        """Store the value of a prefix (replaces the previous value)"""
+        prefix = self.__mask(prefix, length)
+        node = self.root
+        path = [node]
+
+        while node.length < length:
+            bit = self.__bit(prefix, node.length)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = node = _Node(prefix, length)
+                path.append(node)
+                break
+
+            common = self.__common_length(child.prefix, prefix, min(child.length, length))
+            if common == child.length:
+                node = child
+                path.append(node)
+                continue
+
+            # the prefix diverges from the child (or is above it), a node is
+            # added where they split
+            middle = _Node(self.__mask(prefix, common), common)
+            middle.children[self.__bit(child.prefix, common)] = child
+            node.children[bit] = node = middle
+            path.append(node)
+            if common < length:
+                middle.children[self.__bit(prefix, common)] = node = _Node(prefix, length)
+                path.append(node)
+            break
+
+        if not node.has_value:
+            self.size += 1
+        node.value = value
+        node.has_value = True
+        self.__update(path)
+
+
+    def remove(self, prefix, length):
+        """Remove the value of a prefix (KeyError if the prefix is unknown)"""
+        path = self.__find(self.__mask(prefix, length), length)
+        if path is None or not path[-1].has_value:
+            raise KeyError((prefix, length))
+
+        node = path[-1]
+        node.value = None
+        node.has_value = False
+        self.size -= 1
+
+        # remove the nodes that neither hold a value nor split the trie
+        while len(path) > 1:
+            node = path[-1]
+            children = [child for child in node.children if child is not None]
+            if node.has_value or len(children) == 2:
+                break
+            parent = path[-2]
+            parent.children[self.__bit(node.prefix, parent.length)] = children[0] if children else None
+            path.pop()
+            if node.aggregated is not None:
+                self.changes.setdefault((node.prefix, node.length), node.aggregated)
+            if children:
+                break
+
+        self.__update(path)
+
+
+    def get(self, prefix, length, default=None):
+        """Return the value of a prefix"""
+        path = self.__find(self.__mask(prefix, length), length)
+        if path is None or not path[-1].has_value:
+            return default
+        return path[-1].value
+
+
+    def __update(self, path):
+        """Summarize again the nodes of a path, from the bottom up, after the
+        last node of the path changed, then aggregate again below the highest
+        node whose summary changed"""
+        top = len(path) - 1
+        for index in range(len(path) - 1, -1, -1):
+            node = path[index]
+            summary = node.summary
+            self.__summarize(node)
+            if node.summary != summary:
+                top = index
+            elif node.aggregated is not None and not node.aggregated[1]:
+                # the sample of a covering prefix might be gone
+                node.aggregated = (node.sample, False)
+            node.count = int(node.aggregated is not None) + \
+                         sum(child.count for child in node.children if child is not None)
+
+        # the aggregated prefixes above top are unchanged, and top is only
+        # aggregated when all the nodes above it are mixed
+        inherited = _INHERIT
+        for node in path[:top]:
+            if node.summary is not _MIXED:
+                inherited = None
+                break
+            if node.has_value:
+                inherited = self.key(node.value)
+
+        node = path[top]
+        self.__clear(node)
+        if inherited is not None:
+            self.__aggregate(node, inherited)
+
+        for node in reversed(path[:top]):
+            node.count = int(node.aggregated is not None) + \
+                         sum(child.count for child in node.children if child is not None)
+
+
+    def __summarize(self, node):
+        if node.has_value:
+            (base, sample) = (self.key(node.value), node.value)
+        else:
+            (base, sample) = (_INHERIT, None)
+
+        if node.length == self.bits:
+            (node.summary, node.sample) = (base, sample)
+            return
+
+        halves = []
+        for child in node.children:
+            if child is None:
+                halves.append((base, sample))
+                continue
+            (summary, child_sample) = (child.summary, child.sample)
+            if summary is _INHERIT:
+                (summary, child_sample) = (base, sample)
+            # the addresses of the half that are not below the child are
+            # covered by the node itself
+            if child.length > node.length + 1 and summary != base:
+                summary = _MIXED
+            halves.append((summary, child_sample))
+
+        ((left, left_sample), (right, right_sample)) = halves
+        if left is not _MIXED and left == right:
+            node.summary = left
+            node.sample = left_sample if left_sample is not None else right_sample
+        else:
+            node.summary = _MIXED
+            node.sample = None
+
+
+    def __clear(self, node):
+        """Forget the aggregated prefixes below node"""
+        if node.aggregated is not None:
+            self.changes.setdefault((node.prefix, node.length), node.aggregated)
+            node.aggregated = None
+        node.count = 0
+        for child in node.children:
+            if child is not None and child.count:
+                self.__clear(child)
+
+
+    def __aggregate(self, node, inherited):
+        """Aggregate the prefixes below node, where inherited is the key of
+        the (aggregated) prefix that covers node, and return the number of
+        aggregated prefixes"""
+        summary = node.summary
+        if summary is _INHERIT:
+            return 0
+
+        if summary is not _MIXED:
+            if summary != inherited:
+                # the prefixes below a stored prefix may cover all of its range
+                if node.has_value and self.key(node.value) == summary:
+                    self.__set_aggregated(node, (node.value, True))
+                else:
+                    self.__set_aggregated(node, (node.sample, False))
+            return node.count
+
+        if node.has_value:
+            key = self.key(node.value)
+            if key != inherited:
+                self.__set_aggregated(node, (node.value, True))
+            inherited = key
+
+        for child in node.children:
+            if child is not None:
+                node.count += self.__aggregate(child, inherited)
+        return node.count
+
+
+    def __set_aggregated(self, node, aggregated):
+        self.changes.setdefault((node.prefix, node.length), None)
+        node.aggregated = aggregated
+        node.count = 1
+
+
+    def aggregate(self):
+        """Return the aggregated prefixes, as a list of (prefix, length,
+        value, exact) where exact is True when the prefix is a stored prefix
+        (and value its value) and False for a covering prefix (value is then
+        one of the equivalent values it covers)"""
+        result = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node.aggregated is not None:
+                result.append((node.prefix, node.length) + node.aggregated)
+            nodes.extend(child for child in node.children if child is not None and child.count)
+        return result
+
+
+    def take_changes(self):
+        """Return the changes to the aggregated prefixes since the previous
+        call, as (removed prefixes, new prefixes) in the aggregate() form. A
+        prefix whose value changed is in both lists"""
+        removed = []
+        new = []
+        for ((prefix, length), previous) in self.changes.iteritems():
+            path = self.__find(prefix, length)
+            current = path[-1].aggregated if path is not None else None
+            if self.__same(previous, current):
+                continue
+            if previous is not None:
+                removed.append((prefix, length) + previous)
+            if current is not None:
+                new.append((prefix, length) + current)
+        self.changes = {}
+        return (removed, new)
+
+
+    def __same(self, a, b):
+        """Whether two aggregated prefixes route the same way (the values of
+        the covering prefixes are only compared by key)"""
+        if a is None or b is None:
+            return a is b
+        if a[1] != b[1]:
+            return False
+        if a[1]:
+            return a[0] == b[0]
+        return self.key(a[0]) == self.key(b[0])
+
+
+    def __len__(self):
+        return self.size
+
+
+def parse_prefix(text):
+    """Return the (prefix, length) of an IPv6 prefix in the prefix/length
+    form (an address without a length is a /128)"""
+    (address, _, length) = text.partition("/")
+    prefix = int(hexlify(socket.inet_pton(socket.AF_INET6, address)), 16)
+    return (prefix, int(length) if length else 128)
+
+
+def format_prefix(prefix, length):
+    """Return the prefix/length form of an IPv6 prefix"""
+    return "%s/%d" % (socket.inet_ntop(socket.AF_INET6, unhexlify("%032x" % prefix)), length)
+
+
+def aggregate_targets(targets):
+    """Return the smallest list of prefixes that covers the same addresses as
+    targets (IPv6 prefixes in the prefix/length form)"""
+    trie = PrefixTrie(key=lambda target: True)
+    for target in targets:
+        (prefix, length) = parse_prefix(target)
+        trie.insert(prefix, length, target)
+    return [value if exact else format_prefix(prefix, length)
+            for (prefix, length, value, exact) in trie.aggregate()]
+
+
+def test_aggregate_targets():
+    assert sorted(aggregate_targets(["2001:db8::%x/128" % i for i in range(4)])) == ["2001:db8::/126"]
+    assert sorted(aggregate_targets(["2001:db8::%x/128" % i for i in range(1, 5)])) == \
+           ["2001:db8::1/128", "2001:db8::2/127", "2001:db8::4/128"]
+    # a prefix that covers other targets is enough
+    assert aggregate_targets(["2001:db8::/64", "2001:db8::1/128", "2001:db8:0:1::/64"]) == ["2001:db8::/63"]
+    assert aggregate_targets([]) == []
+    assert parse_prefix("::1") == (1, 128)
+    assert format_prefix(*parse_prefix("2001:db8::/32")) == "2001:db8::/32"
+
+
+def test_prefix_trie():
+    trie = PrefixTrie()
+    (a, _) = parse_prefix("2001:db8::")
+
+    # targets with the same value are aggregated, and split again when one changes
+    for i in range(4):
+        trie.insert(a + i, 128, "x")
+    assert trie.aggregate() == [(a, 126, "x", False)]
+    assert trie.take_changes() == ([], [(a, 126, "x", False)])
+    trie.insert(a + 2, 128, "y")
+    assert sorted(trie.aggregate()) == [(a, 127, "x", False), (a + 2, 128, "y", True), (a + 3, 128, "x", True)]
+    (removed, new) = trie.take_changes()
+    assert removed == [(a, 126, "x", False)] and sorted(new) == sorted(trie.aggregate())
+    trie.insert(a + 2, 128, "x")
+    assert trie.aggregate() == [(a, 126, "x", False)]
+    assert trie.take_changes()[1] == [(a, 126, "x", False)]
+    # changes that cancel out are not reported
+    trie.insert(a + 2, 128, "y")
+    trie.insert(a + 2, 128, "x")
+    assert trie.take_changes() == ([], [])
+
+    # a more specific prefix with another value stays
+    trie.insert(a, 126, "x")
+    trie.insert(a + 1, 128, "y")
+    assert sorted(trie.aggregate()) == [(a, 126, "x", True), (a + 1, 128, "y", True)]
+
+    # removals
+    trie.remove(a + 1, 128)
+    assert trie.aggregate() == [(a, 126, "x", True)]
+    trie.remove(a, 126)
+    assert sorted(trie.aggregate()) == [(a, 128, "x", True), (a + 2, 127, "x", False)]
+    for i in (0, 2, 3):
+        trie.remove(a + i, 128)
+    assert len(trie) == 0 and trie.aggregate() == []
+    assert trie.root.children == [None, None]
+    try:
+        trie.remove(a, 128)
+        assert False
+    except KeyError:
+        pass
+
+
+def test_prefix_trie_lossless():
+    from random import Random
+
+    bits = 6
+    rand = Random(4)
+
+    def lookup(prefixes, address):
+        """Longest prefix match"""
+        matches = [(length, value) for ((prefix, length), value) in prefixes.items()
+                   if (address >> (bits - length)) == (prefix >> (bits - length))]
+        return max(matches)[1] if matches else None
+
+    def routing(trie, entries):
+        return set((prefix, length, exact, value if exact else trie.key(value))
+                   for (prefix, length, value, exact) in entries)
+
+    for run in range(20):
+        trie = PrefixTrie(bits=bits, key=lambda value: value[0])
+        stored = {}
+        installed = {}  # aggregated prefixes, as given by take_changes()
+        for step in range(60):
+            length = rand.choice([bits, bits, bits, bits - 1, bits - 3, 1])
+            prefix = rand.randrange(1 << bits) >> (bits - length) << (bits - length)
+            if (prefix, length) in stored and rand.random() < 0.5:
+                trie.remove(prefix, length)
+                del stored[(prefix, length)]
+            else:
+                value = (rand.choice("ab"), step)
+                trie.insert(prefix, length, value)
+                stored[(prefix, length)] = value
+            assert len(trie) == len(stored)
+
+            # the aggregated prefixes are those of a trie built from scratch
+            fresh = PrefixTrie(bits=bits, key=trie.key)
+            for ((prefix, length), value) in stored.items():
+                fresh.insert(prefix, length, value)
+            assert routing(trie, trie.aggregate()) == routing(fresh, fresh.aggregate())
+
+            # and the changes lead to them
+            if rand.random() < 0.5:
+                (removed, new) = trie.take_changes()
+                for (prefix, length, value, exact) in removed:
+                    assert installed.pop((prefix, length))[3] == exact
+                for (prefix, length, value, exact) in new:
+                    assert (prefix, length) not in installed
+                    installed[(prefix, length)] = (prefix, length, value, exact)
+                assert routing(trie, installed.values()) == routing(trie, trie.aggregate())
+
+            aggregated = dict(((prefix, length), value) for (prefix, length, value, exact) in trie.aggregate())
+            assert len(aggregated) <= len(stored)
+            for address in range(1 << bits):
+                expected = lookup(stored, address)
+                found = lookup(aggregated, address)
+                assert (expected and expected[0]) == (found and found[0])
@@ -21,20 +21,197 @@
 """Route cache"""
 from Routing import Routing
 from copy import copy
+from inspect import getargspec
+from threading import RLock
+from time import time
+from tools import ip_command, intern_string
+from snapshot import state_changed
+from rpl_constants import DEFAULT_RULE_PRIORITY
 import global_variables as gv
 
 import logging
 logger = logging.getLogger("RPL")
 
+# minimum number of routes to remove at once before flushing a dedicated table
+# becomes worthwhile
+FLUSH_MIN_ROUTES = 16
+
+
+# routing tables that are shared with the rest of the system and must never be
+# flushed (names and their numerical values, see /etc/iproute2/rt_tables)
+RESERVED_TABLES = ["local", "main", "default", "unspec", "0", "253", "254", "255"]
+
+
+def supports_replace(routing_obj):
+    """Indicates if the add() method of a Routing object accepts the replace
+    argument (that is, if it can swap the next hop of a route in a single
+    NLM_F_REPLACE operation)"""
+    try:
+        (args, varargs, keywords, defaults) = getargspec(routing_obj.add)
+    except TypeError:
+        # a method of an extension module can not be inspected, its
+        # documentation tells its arguments
+        return "replace" in (routing_obj.add.__doc__ or "")
+    return "replace" in args or keywords is not None
+
 
 class RouteCache(object):
     routing_obj = None
-    route_cache = []
-
-    def __init__(self):
+    route_cache = set()
+
+    def __init__(self, table="local", rule_priority=DEFAULT_RULE_PRIORITY, rule_selector=(), writer=None):
+        """Route cache:
+        - table: routing table where the RPL routes are installed. When this is
+          not one of the system tables (e.g. "local" or "main"), the table is
+          considered dedicated to RPL: an ip rule is added to make it
+          reachable, and the table is flushed in a single operation instead of
+          removing routes one by one
+        - rule_priority: priority of the ip rule that references a dedicated table
+        - rule_selector: arguments of the ip rule that select the traffic the
+          dedicated table routes (e.g. ("fwmark", 1), all traffic by default)
+        - writer: a NetlinkWriter that performs the kernel operations
+          asynchronously (if None, they are performed right away)"""
+        self.__lock = RLock()  # the Routing object is shared with the writer thread
         self.routing_obj = Routing()
         self.routing_obj.set_family("inet6")
-        self.route_cache = []
+        self.route_cache = set()
+        self.table = str(table)
+        self.rule_priority = rule_priority
+        self.rule_selector = list(rule_selector)
+        self.writer = writer
+
+        self.replace_supported = supports_replace(self.routing_obj)
+        if not self.replace_supported:
+            logger.warning("the Routing module can not replace routes, the routes to "
+                           "the targets that change next hops are removed before the "
+                           "new ones are added")
+
+        # statistics on next hop changes
+        self.replaced_routes = 0
+        self.replacement_gaps = 0  # number of replaced routes that were missing for a while
+        self.replacement_missing_time = 0.0  # for how long (in seconds)
+        self.default_route_gaps = 0  # number of times the node was left without a default route
+        self.default_route_missing_time = 0.0  # for how long (in seconds)
+        self.__default_missing_since = None
+
+        if self.has_dedicated_table():
+            # routes left over by a previous run would conflict with the new ones
+            self.flush_table()
+            self.__add_rule()
+
+
+    def has_dedicated_table(self):
+        """Indicates if the routes are installed in a table that only RPL uses"""
+        return self.table not in RESERVED_TABLES
+
+
+    def __add_rule(self):
+        """Add an ip rule so that the dedicated table is looked up"""
+        # remove a rule that a previous run might not have cleaned up
+        self.__remove_rule()
+        if not ip_command("rule", "add", *self.__rule()):
+            logger.warning("unable to add an ip rule for routing table %s" % self.table)
+
+
+    def __remove_rule(self):
+        """Remove the ip rule that references the dedicated table"""
+        ip_command("rule", "del", *self.__rule())
+
+
+    def __rule(self):
+        """Arguments of the ip rule that references the dedicated table"""
+        return self.rule_selector + ["table", self.table, "priority", self.rule_priority]
+
+
+    def flush_table(self):
+        """Remove all the routes of the dedicated table in one netlink operation"""
+        assert self.has_dedicated_table()
+
+        logger.debug("Flushing routing table %s (%d routes)" % (self.table, len(self.route_cache)))
+
+        if self.writer:
+            # pending operations on the table are useless now
+            self.writer.supersede(("route", self.table), ("flush", self.table), self.__flush_kernel_table)
+        else:
+            self.__flush_kernel_table()
+
+        if self.__has_default_route():
+            self.__default_missing_since = time()
+        self.route_cache = set()
+        state_changed()
+
+
+    def __flush_kernel_table(self):
+        """Flush the dedicated table in the kernel"""
+        if not ip_command("route", "flush", "table", self.table):
+            logger.warning("unable to flush routing table %s" % self.table)
+
+
+    def __update_kernel(self, before, after):
+        """Bring the kernel route for a target from the before route to the
+        after route (None meaning that there is no route)"""
+        target = (before or after).target
+
+        if self.writer:
+            self.writer.submit(("route", self.table, target), before, after, self.__apply)
+        else:
+            self.__apply(before, after)
+
+
+    def __apply(self, before, after):
+        """Perform the netlink operation (in the writer thread, if any)"""
+        # the Routing object is shared with the main thread (see __str__())
+        with self.__lock:
+            if before is None and after is None:
+                return
+
+            if after is None:
+                (target, nexthop, nexthop_iface) = before.to_tuple()
+                self.routing_obj.remove(target, (nexthop, nexthop_iface), table=self.table)
+                return
+
+            (target, nexthop, nexthop_iface) = after.to_tuple()
+
+            if before is None:
+                try:
+                    self.routing_obj.add(target, (nexthop, nexthop_iface), table=self.table)
+                except: pass
+            elif before.to_tuple() != after.to_tuple():
+                if self.replace_supported:
+                    try:
+                        # NLM_F_REPLACE: the kernel swaps the next hop in a single operation
+                        self.routing_obj.add(target, (nexthop, nexthop_iface), table=self.table, replace=True)
+                        return
+                    except Exception, err:
+                        logger.warning("unable to replace the route to %s (%s), removing it before adding the new one" % (target, err))
+
+                # the target is unreachable until the new route is added
+                removed = time()
+                self.__apply(before, None)
+                self.__apply(None, after)
+                self.replacement_gaps += 1
+                self.replacement_missing_time += time() - removed
+
+
+    def __has_default_route(self):
+        """Indicates if a default route is currently installed"""
+        return any(route.target == "default" for route in self.route_cache)
+
+
+    def __default_route_removed(self):
+        """Start measuring the time during which no default route is installed"""
+        if not self.__has_default_route():
+            self.__default_missing_since = time()
+
+
+    def __default_route_added(self):
+        """Stop measuring the time during which no default route is installed"""
+        if self.__default_missing_since is not None:
+            gap = time() - self.__default_missing_since
+            self.__default_missing_since = None
+            self.default_route_gaps += 1
+            self.default_route_missing_time += gap
+            logger.info("default route was missing for %f seconds" % gap)
 
     def remove_route(self, route):
         """Remove a route from the route cache"""
@@ -45,13 +222,28 @@ class RouteCache(object):
 
         logger.debug("Remove route to %s through %s on iface %s" % (target, nexthop, nexthop_iface))
 
-        self.routing_obj.remove(target, (nexthop, nexthop_iface), table="local")
+        self.__update_kernel(route, None)
         self.route_cache.remove(route)
+        state_changed()
+
+        if target == "default":
+            self.__default_route_removed()
         return True
 
 
     def remove_routes(self, routes):
         """Remove a list of routes from the route cache"""
+        routes = [route for route in routes if route in self.route_cache]
+
+        # when the whole table goes away, it is cheaper to flush it (when some
+        # routes remain, they are not flushed, as the node would be left
+        # without them until they are installed again)
+        if self.has_dedicated_table() and \
+           len(routes) > FLUSH_MIN_ROUTES and \
+           len(routes) == len(self.route_cache):
+            self.flush_table()
+            return True
+
         route_update = False
         for route in routes:
             route_update += self.remove_route(route)
@@ -88,14 +280,67 @@ class RouteCache(object):
         # the node
         assert target == "default" or not gv.address_cache.is_assigned(target.split("/")[0])
 
-        try:
-            self.routing_obj.add(target, (nexthop, nexthop_iface), table="local")
-        except: pass
+        self.__update_kernel(None, route)
+        self.route_cache.add(route)
+        state_changed()
+
+        if target == "default":
+            self.__default_route_added()
+        return True
+
+
+    def replace_route(self, old_route, new_route):
+        """Move a route to a new next hop without removing it first (make-before-break).
+        Both routes must have the same target. When old_route is None or is
+        not installed, new_route is simply added"""
+        if old_route is None or old_route not in self.route_cache:
+            return self.add_route(new_route)
 
-        self.route_cache.append(route)
+        if old_route == new_route:
+            return False
+
+        assert old_route.target == new_route.target
+
+        if new_route in self.route_cache:
+            return self.remove_route(old_route)
+
+        (target, nexthop, nexthop_iface) = new_route.to_tuple()
+
+        logger.debug("Replace route to %s through %s on iface %s (was through %s on iface %s)" % \
+                     (target, nexthop, nexthop_iface, old_route.nexthop, old_route.nexthop_iface))
+
+        self.__update_kernel(old_route, new_route)
+        self.route_cache.remove(old_route)
+        self.route_cache.add(new_route)
+        self.replaced_routes += 1
+        state_changed()
         return True
 
 
+    def update_routes(self, old_routes, new_routes):
+        """Withdraw old_routes and install new_routes. When a target is in both
+        lists, its route is replaced so that the target stays reachable"""
+        route_update = False
+
+        new_routes = set(new_routes)
+        old_routes = set([route for route in old_routes if route in self.route_cache]) - new_routes
+        new_routes = [route for route in new_routes if route not in self.route_cache]
+
+        # pair the routes to withdraw with the new routes for the same target
+        replaced = {}
+        for route in old_routes:
+            replaced.setdefault(route.target, route)
+
+        for route in new_routes:
+            old_route = replaced.pop(route.target, None)
+            if old_route is not None:
+                old_routes.remove(old_route)
+            route_update += self.replace_route(old_route, route)
+
+        route_update += self.remove_routes(old_routes)
+        return bool(route_update)
+
+
     def add_routes(self, routes):
         """Add a list of routes to the route cache"""
         route_update = False
@@ -106,18 +351,37 @@ class RouteCache(object):
 
     def empty_cache(self):
         """Empty the route cache"""
-        for route in copy(self.route_cache):
-            self.remove_route(route)
+        if self.has_dedicated_table():
+            self.flush_table()
+            self.__remove_rule()
+        else:
+            for route in copy(self.route_cache):
+                self.remove_route(route)
+
+        assert not self.route_cache
 
-        assert self.route_cache == []
+
+    def get_stats(self):
+        """Return a text presentation of the statistics on next hop changes"""
+        stats = "routes moved to a new next hop: %d\n" % self.replaced_routes
+        stats += "replaced routes removed before the new route was added: %d\n" % self.replacement_gaps
+        stats += "time spent without the replaced routes: %f seconds\n" % self.replacement_missing_time
+        stats += "times without a default route: %d\n" % self.default_route_gaps
+        stats += "time spent without a default route: %f seconds" % self.default_route_missing_time
+        if self.__default_missing_since is not None:
+            stats += "\ndefault route has been missing for %f seconds" % (time() - self.__default_missing_since)
+        return stats
 
 
     def __str__(self):
         """Print the complete route cache"""
-        return self.routing_obj.__str__()
+        with self.__lock:
+            return self.routing_obj.__str__()
 
 
 class Route(object):
+    __slots__ = ("target", "nexthop", "nexthop_iface", "onehop")
+
     def __init__(self, target, nexthop, nexthop_iface, onehop=False):
         """Store route information:
         - target is the route target address (it can be a prefix e.g "2000::/3"))
@@ -125,8 +389,8 @@ class Route(object):
         - nexthop_iface is the interface name where nexthop can be reached (e.g. "eth0")
         - onehop indicate if the route is for a direct neighbor"""
         self.target = target
-        self.nexthop = nexthop
-        self.nexthop_iface = nexthop_iface
+        self.nexthop = intern_string(nexthop)
+        self.nexthop_iface = intern_string(nexthop_iface)
         self.onehop = onehop
 
 
@@ -136,6 +400,8 @@ class Route(object):
 
 
     def __eq__(self, other):
+        if not isinstance(other, Route):
+            return False
         return self.target == other.target and \
            self.nexthop == other.nexthop and \
            self.nexthop_iface == other.nexthop_iface and \
@@ -158,3 +424,39 @@ class Route(object):
 
     def __hash__(self):
         return hash((self.target, self.nexthop, self.nexthop_iface, self.onehop))
+
+
+def test_route_replacement():
+    class OldRouting(object):
+        """Routing module that can not replace routes"""
+        def __init__(self):
+            self.operations = []
+
+        def add(self, target, nexthop, table):
+            self.operations.append(("add", nexthop[0]))
+
+        def remove(self, target, nexthop, table):
+            self.operations.append(("remove", nexthop[0]))
+
+    class NewRouting(OldRouting):
+        def add(self, target, nexthop, table, replace=False):
+            self.operations.append(("replace" if replace else "add", nexthop[0]))
+
+    assert not supports_replace(OldRouting())
+    assert supports_replace(NewRouting())
+
+    for (routing_obj, operations, gaps) in ((NewRouting(), ["add", "replace"], 0),
+                                            (OldRouting(), ["add", "remove", "add"], 1)):
+        route_cache = RouteCache()
+        route_cache.routing_obj = routing_obj
+        route_cache.replace_supported = supports_replace(routing_obj)
+        route_cache.add_route(Route("default", "fe80::1", "eth0"))
+        assert route_cache.replace_route(Route("default", "fe80::1", "eth0"),
+                                         Route("default", "fe80::2", "eth0"))
+
+        # without replacement, the route is removed and added again, and the
+        # time it was missing is measured
+        assert [operation for (operation, nexthop) in routing_obj.operations] == operations
+        assert routing_obj.operations[-1] == (operations[-1], "fe80::2")
+        assert route_cache.replaced_routes == 1 and route_cache.replacement_gaps == gaps
+        assert route_cache.default_route_gaps == 0
@@ -0,0 +1,260 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+"""Index of the downward routes of a DODAG.
+
+A DODAG can learn several routes to the same target (through different
+children). The index keeps the candidate routes of each target, the best one
+(the route that is installed in the route cache) and the routes through each
+next hop, so that only the targets involved are examined when a route is
+added or removed, or when a next hop changes its rank.
+
+The changes to the best routes are recorded until take_changes() hands them
+over to the route cache. When the routes are aggregated, the best routes are
+stored in a prefix trie and the changes are those of the aggregated routes
+(see prefix_trie)."""
+
+from operator import attrgetter
+from prefix_trie import PrefixTrie, parse_prefix, format_prefix
+
+
+class DownwardRouteIndex(object):
+    def __init__(self, key, aggregate=False, make_route=None):
+        """Downward route index:
+        - key: function that returns the sort key of a route (the best route
+          to a target has the lowest key)
+        - aggregate: when True, the changes are those of the aggregated routes
+        - make_route: function(target, nexthop, nexthop_iface) that builds the
+          aggregated routes"""
+        self.key = key
+        self.make_route = make_route
+        self.__candidates = {}  # target -> routes to the target
+        self.__best = {}  # target -> route that is used for the target
+        self.__by_nexthop = {}  # next hop -> routes through this next hop
+        self.__changed = {}  # target -> best route at the previous take_changes() call
+        self.__trie = PrefixTrie(key=attrgetter("nexthop", "nexthop_iface")) if aggregate else None
+        self.__aggregated = {}  # (prefix, length) -> aggregated route at the previous take_changes() call
+
+
+    def add(self, route):
+        """Record a new candidate route for its target"""
+        self.__candidates.setdefault(route.target, set()).add(route)
+        self.__by_nexthop.setdefault(route.nexthop, set()).add(route)
+        self.__update(route.target)
+
+
+    def remove(self, route):
+        """Forget a candidate route"""
+        candidates = self.__candidates[route.target]
+        candidates.remove(route)
+        if not candidates:
+            del self.__candidates[route.target]
+
+        routes = self.__by_nexthop[route.nexthop]
+        routes.remove(route)
+        if not routes:
+            del self.__by_nexthop[route.nexthop]
+
+        self.__update(route.target)
+
+
+    def nexthop_changed(self, nexthop):
+        """The key of the routes through nexthop might have changed: select
+        the best route of their targets again"""
+        for route in list(self.__by_nexthop.get(nexthop, ())):
+            self.__update(route.target)
+
+
+    def routes_through(self, nexthop):
+        """Return the candidate routes through a next hop"""
+        return list(self.__by_nexthop.get(nexthop, ()))
+
+
+    def best_routes(self):
+        """Return the route that is used for each target (or the aggregated
+        routes, when the routes are aggregated)"""
+        if self.__trie is not None:
+            return set(self.__route(prefix, length, route, exact)
+                       for (prefix, length, route, exact) in self.__trie.aggregate())
+        return set(self.__best.itervalues())
+
+
+    def installed_routes(self):
+        """Return the routes as of the previous take_changes() call (i.e. the
+        routes the route cache was given)"""
+        if self.__trie is not None:
+            return set(self.__aggregated.itervalues())
+
+        routes = dict(self.__best)
+        for (target, previous) in self.__changed.iteritems():
+            if previous is None:
+                routes.pop(target, None)
+            else:
+                routes[target] = previous
+        return set(routes.itervalues())
+
+
+    def __update(self, target):
+        """Select the best route to a target again"""
+        current = self.__best.get(target)
+        candidates = self.__candidates.get(target)
+
+        best = None
+        if candidates:
+            # on a tie, the current route is kept
+            if current in candidates:
+                best = current
+                best_key = self.key(current)
+            for route in candidates:
+                if route is best:
+                    continue
+                key = self.key(route)
+                if best is None or key < best_key:
+                    (best, best_key) = (route, key)
+
+        if best == current:
+            return
+
+        if best is None:
+            del self.__best[target]
+        else:
+            self.__best[target] = best
+
+        if self.__trie is not None:
+            # the trie records the changes to the aggregated routes
+            (prefix, length) = parse_prefix(target)
+            if best is None:
+                self.__trie.remove(prefix, length)
+            else:
+                self.__trie.insert(prefix, length, best)
+        else:
+            # remember which route the route cache knows about
+            self.__changed.setdefault(target, current)
+
+
+    def __route(self, prefix, length, route, exact):
+        """Return the route of an aggregated prefix"""
+        if exact:
+            return route
+        return self.make_route(format_prefix(prefix, length), route.nexthop, route.nexthop_iface)
+
+
+    def take_changes(self):
+        """Return the changes to the best routes (or to the aggregated routes)
+        since the previous call, as (routes to withdraw, routes to install). A
+        target that moved to a new next hop is in both lists"""
+        removed_routes = []
+        new_routes = []
+
+        if self.__trie is not None:
+            (removed, new) = self.__trie.take_changes()
+            for (prefix, length, route, exact) in removed:
+                removed_routes.append(self.__aggregated.pop((prefix, length)))
+            for (prefix, length, route, exact) in new:
+                route = self.__route(prefix, length, route, exact)
+                self.__aggregated[(prefix, length)] = route
+                new_routes.append(route)
+            return (removed_routes, new_routes)
+
+        for (target, previous) in self.__changed.iteritems():
+            best = self.__best.get(target)
+            if best == previous:
+                continue
+            if previous is not None:
+                removed_routes.append(previous)
+            if best is not None:
+                new_routes.append(best)
+        self.__changed = {}
+
+        return (removed_routes, new_routes)
+
+
+def test_route_index():
+    from collections import namedtuple
+
+    R = namedtuple("R", "target nexthop nexthop_iface onehop")
+    rank = {"a": 2, "b": 1, "c": 3}
+    index = DownwardRouteIndex(key=lambda route: rank[route.nexthop])
+
+    via_a = R("2001:db8::1/128", "a", "eth0", False)
+    via_b = R("2001:db8::1/128", "b", "eth0", False)
+    via_c = R("2001:db8::1/128", "c", "eth0", False)
+
+    # the first route is installed, a better one replaces it
+    index.add(via_a)
+    assert index.take_changes() == ([], [via_a])
+    index.add(via_c)
+    assert index.take_changes() == ([], [])
+    index.add(via_b)
+    assert index.installed_routes() == set([via_a])
+    assert index.take_changes() == ([via_a], [via_b])
+    assert index.best_routes() == set([via_b])
+    assert sorted(index.routes_through("b")) == [via_b]
+
+    # the rank of a next hop changes: the targets through it are examined again
+    rank["b"] = 5
+    index.nexthop_changed("b")
+    assert index.take_changes() == ([via_b], [via_a])
+
+    # on a tie, the current route is kept
+    rank["c"] = 2
+    index.nexthop_changed("c")
+    assert index.take_changes() == ([], [])
+
+    # changes that cancel out before take_changes() are not reported
+    rank["c"] = 1
+    index.nexthop_changed("c")
+    rank["c"] = 3
+    index.nexthop_changed("c")
+    assert index.take_changes() == ([], [])
+
+    # the best route goes away: the next best one is installed, then none
+    index.remove(via_a)
+    assert index.take_changes() == ([via_a], [via_c])
+    index.remove(via_c)
+    index.remove(via_b)
+    assert index.installed_routes() == set([via_c])
+    assert index.take_changes() == ([via_c], [])
+    assert index.best_routes() == set() and index.routes_through("b") == []
+
+
+def test_route_index_aggregate():
+    from collections import namedtuple
+
+    R = namedtuple("R", "target nexthop nexthop_iface onehop")
+    index = DownwardRouteIndex(key=lambda route: route.nexthop, aggregate=True,
+                               make_route=lambda target, nexthop, iface: R(target, nexthop, iface, False))
+
+    routes = [R("2001:db8::%x/128" % i, "a", "eth0", False) for i in range(4)]
+    for route in routes:
+        index.add(route)
+    aggregated = R("2001:db8::/126", "a", "eth0", False)
+    assert index.take_changes() == ([], [aggregated])
+
+    # a target reachable through a better next hop splits the aggregated route
+    better = R("2001:db8::2/128", "0", "eth0", False)
+    index.add(better)
+    (removed, new) = index.take_changes()
+    assert removed == [aggregated]
+    assert sorted(new) == [R("2001:db8::/127", "a", "eth0", False), better, routes[3]]
+    assert index.installed_routes() == set(new)
+
+    # and it is aggregated again when that route goes away
+    index.remove(better)
+    (removed, installed) = index.take_changes()
+    assert sorted(removed) == sorted(new) and installed == [aggregated]
@@ -34,12 +34,30 @@ DEFAULT_DIO_INTERVAL_DOUBLINGS = 20  # 2.3 hours
 # default value used to configure k for the DIO Trickle timer
 DEFAULT_DIO_REDUNDANCY_CONSTANT = 10
 
+# bounds of the locally adapted k for the DIO Trickle timer
+# (this value is not defined in the RFC)
+DEFAULT_ADAPTIVE_REDUNDANCY_MIN = 1
+DEFAULT_ADAPTIVE_REDUNDANCY_MAX = 20
+
 # default value of MinHopRankIncrease
 DEFAULT_MIN_HOP_RANK_INCREASE = 256
 
 # default value for the DelayDAO Timer
 DEFAULT_DAO_DELAY = 1
 
+# additional DelayDAO per DAGRank unit, so that the levels of a sub-DODAG send
+# their DAO one after the other after a repair
+# (this value is not defined in the RFC)
+DEFAULT_DAO_RANK_DELAY = 0.2
+
+# upper bound of the random jitter added to DelayDAO
+# (this value is not defined in the RFC)
+DEFAULT_DAO_JITTER = 1
+
+# maximum number of unacknowledged DAO per interface, further DAO are delayed
+# (this value is not defined in the RFC)
+DEFAULT_DAO_MAX_OUTSTANDING = 4
+
 # default duration to wait in order to receive a DAO-ACK message
 # (this value is not defined in the RFC)
 DEFAULT_DAO_ACK_DELAY = 2
@@ -48,6 +66,25 @@ DEFAULT_DAO_ACK_DELAY = 2
 # (this value is not defined in the RFC)
 DEFAULT_DAO_MAX_TRANS_RETRY = 3
 
+# bounds of the DAO-ACK retransmission timeout, once it is derived from the
+# round trip times measured with a parent
+# (these values are not defined in the RFC)
+DEFAULT_DAO_ACK_MIN_DELAY = 0.5
+DEFAULT_DAO_ACK_MAX_DELAY = 30
+
+# relative jitter applied to the DAO-ACK retransmission timeout
+# (this value is not defined in the RFC)
+DEFAULT_DAO_ACK_JITTER = 0.25
+
+# what to do with a parent that never acknowledges a DAO:
+# - evict: remove the parent from the neighbor cache
+# - evict-if-silent: remove the parent only if no DIO was heard from it since
+#   the DAO was sent
+# - keep: stop retransmitting, keep the parent
+# (this value is not defined in the RFC)
+DAO_GIVE_UP_POLICIES = ("evict", "evict-if-silent", "keep")
+DEFAULT_DAO_GIVE_UP_POLICY = "evict-if-silent"
+
 # number of time a DAO will transmit No-Path that contains information on
 # routes that recently have been deleted
 DEFAULT_DAO_NO_PATH_TRANS = 3
@@ -69,3 +106,46 @@ INFINITE_RANK = 0xffff
 # Non RFC defined constants
 #
 DEFAULT_INTERVAL_BETWEEN_DIS = 300  # 5 minutes (should be probably be set to a higher value)
+# the first DIS are sent quickly, the interval then doubles up to DEFAULT_INTERVAL_BETWEEN_DIS
+DEFAULT_DIS_INITIAL_INTERVAL = 0.5
+
+# a neighbor that does not send any DIO message during this number of maximum
+# DIO intervals (Imax) is removed from the neighbor cache
+DEFAULT_NEIGHBOR_LIFETIME_INTERVALS = 3
+
+# maximum number of entries in the neighbor cache (None: unbounded). The
+# cache is unbounded unless a limit is configured: a root or a router with
+# many children would keep evicting some of them, and the downward routes
+# through an evicted child lose their preference over the other routes
+DEFAULT_NEIGHBOR_CACHE_SIZE = None
+
+# priority of the ip rule that references the routing table dedicated to RPL
+# routes (rules for the local and main tables have priority 0 and 32766)
+DEFAULT_RULE_PRIORITY = 1000
+
+# how long (in seconds) the netlink writer waits before applying a batch of
+# operations, so that redundant operations can be merged
+DEFAULT_NETLINK_COALESCING_DELAY = 0.01
+
+# duration of a tick of the timing wheel that tracks the route, address and
+# neighbor lifetimes (in seconds)
+DEFAULT_WHEEL_RESOLUTION = 1
+
+# minimum time (in seconds) between two publications of the state snapshot
+# the CLI reads (changes that happen in between are published together)
+DEFAULT_SNAPSHOT_INTERVAL = 0.5
+
+# time (in seconds) between two refreshes of the statistics of the state
+# snapshot (they change without a state change)
+DEFAULT_SNAPSHOT_STATS_INTERVAL = 5
+
+# largest DAO message (IPv6 header included) a node sends, the targets that do
+# not fit are advertised in additional DAO messages, so that a DAO never
+# relies on IP fragmentation (1280 is the IPv6 minimum MTU)
+DEFAULT_DAO_MTU = 1280
+
+# maximum time (in seconds) between two DAO that advertise all the targets of
+# a node to its DAO parent, the DAO in between only advertise the targets that
+# changed since the last acknowledged DAO (the interval is shortened when the
+# path lifetime of the routes is shorter)
+DEFAULT_DAO_REFRESH_INTERVAL = 600
@@ -0,0 +1,244 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Timer scheduler: a single min-heap of deadlines that is driven from the
+main loop (the poll timeout is the delay until the next deadline), instead of
+one thread per timer"""
+
+import heapq
+from threading import RLock
+from clock import SystemClock, VirtualClock
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+class TimerHandle(object):
+    """A timer armed on a Scheduler"""
+
+    def __init__(self, scheduler, function, args, kwargs):
+        self.scheduler = scheduler
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.deadline = None
+        self.sequence = None  # identifies the heap entry that is currently valid
+        self.alive = False
+
+    def cancel(self):
+        """Cancel the timer (it does nothing if the timer already fired)"""
+        self.scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        """(Re)arm the timer so that it fires in delay seconds"""
+        self.scheduler.reschedule(self, delay)
+
+    def is_alive(self):
+        """Indicates if the timer is armed"""
+        return self.alive
+
+    def remaining(self):
+        """Number of seconds before the timer fires (None if it is not armed)"""
+        if not self.alive:
+            return None
+        return max(0, self.deadline - self.scheduler.time())
+
+
+class Scheduler(object):
+    def __init__(self, clock=None):
+        """Scheduler:
+        - clock: the clock deadlines are measured with (default: the wall clock)"""
+        self.clock = clock or SystemClock()
+        self.__heap = []  # list of [deadline, sequence, handle]
+        self.__sequence = 0
+        self.__stale = 0  # number of heap entries that belong to cancelled timers
+        self.__lock = RLock()
+
+
+    def time(self):
+        """Current time, as seen by the scheduler"""
+        return self.clock.time()
+
+
+    def schedule(self, delay, function, *args, **kwargs):
+        """Call function(*args, **kwargs) in delay seconds.
+        Returns a TimerHandle that can cancel or reschedule the call"""
+        handle = TimerHandle(self, function, args, kwargs)
+        self.reschedule(handle, delay)
+        return handle
+
+
+    def reschedule(self, handle, delay):
+        """(Re)arm a timer"""
+        with self.__lock:
+            rearmed = handle.alive
+            self.__sequence += 1
+            handle.deadline = self.clock.time() + delay
+            handle.sequence = self.__sequence
+            handle.alive = True
+            if rearmed:
+                # the previous heap entry is left in place and ignored later
+                self.__stale += 1
+                self.__compact()
+            heapq.heappush(self.__heap, [handle.deadline, handle.sequence, handle])
+
+
+    def cancel(self, handle):
+        """Disarm a timer"""
+        with self.__lock:
+            if not handle.alive:
+                return
+            handle.alive = False
+            self.__stale += 1
+            self.__compact()
+
+
+    def __compact(self):
+        """Do not let the entries of cancelled or rearmed timers pile up (the
+        lock must be held)"""
+        if self.__stale > len(self.__heap) / 2:
+            self.__heap = [entry for entry in self.__heap if self.__is_valid(entry)]
+            heapq.heapify(self.__heap)
+            self.__stale = 0
+
+
+    @staticmethod
+    def __is_valid(entry):
+        (deadline, sequence, handle) = entry
+        return handle.alive and handle.sequence == sequence
+
+
+    def __pop_stale(self):
+        """Remove the cancelled entries from the top of the heap"""
+        while self.__heap and not self.__is_valid(self.__heap[0]):
+            heapq.heappop(self.__heap)
+            self.__stale = max(0, self.__stale - 1)
+
+
+    def next_timeout(self):
+        """Number of seconds until the next deadline (None if no timer is armed)"""
+        with self.__lock:
+            self.__pop_stale()
+            if not self.__heap:
+                return None
+            return max(0, self.__heap[0][0] - self.clock.time())
+
+
+    def run_pending(self, now=None):
+        """Run the timers whose deadline is reached.
+        Returns the number of timers that fired"""
+        fired = 0
+        while True:
+            with self.__lock:
+                if now is None:
+                    current_time = self.clock.time()
+                else:
+                    current_time = now
+                self.__pop_stale()
+                if not self.__heap or self.__heap[0][0] > current_time:
+                    return fired
+                (deadline, sequence, handle) = heapq.heappop(self.__heap)
+                handle.alive = False
+
+            fired += 1
+            try:
+                handle.function(* handle.args, ** handle.kwargs)
+            except Exception:
+                logger.exception("timer function %s failed" % handle.function)
+
+
+    def run_until(self, end):
+        """Virtual time only: jump from one deadline to the next and run the
+        timers, until the clock reaches end.
+        Returns the number of timers that fired"""
+        assert isinstance(self.clock, VirtualClock)
+
+        fired = 0
+        while True:
+            with self.__lock:
+                self.__pop_stale()
+                if not self.__heap or self.__heap[0][0] > end:
+                    break
+                self.clock.advance_to(self.__heap[0][0])
+            fired += self.run_pending()
+        self.clock.advance_to(end)
+        return fired
+
+
+    def run_for(self, duration):
+        """Virtual time only: run the timers for duration seconds"""
+        return self.run_until(self.clock.time() + duration)
+
+
+    def __len__(self):
+        """Number of armed timers"""
+        with self.__lock:
+            return len(self.__heap) - self.__stale
+
+
+def test_scheduler():
+    fired = []
+    s = Scheduler()
+
+    s.schedule(0, fired.append, 1)
+    later = s.schedule(1000, fired.append, 2)
+    cancelled = s.schedule(0, fired.append, 3)
+    cancelled.cancel()
+    assert len(s) == 2
+
+    assert s.run_pending() == 1
+    assert fired == [1]
+    assert not cancelled.is_alive() and later.is_alive()
+    assert 0 < s.next_timeout() <= 1000
+
+    # rescheduling moves the deadline
+    later.reschedule(0)
+    assert s.run_pending() == 1
+    assert fired == [1, 2]
+    assert s.next_timeout() is None and len(s) == 0
+
+    # timers fire in deadline order
+    s.schedule(3, fired.append, "c")
+    s.schedule(1, fired.append, "a")
+    s.schedule(2, fired.append, "b")
+    s.run_pending(now=s.time() + 10)
+    assert fired[2:] == ["a", "b", "c"]
+
+    # a timer that is rearmed over and over does not fill the heap
+    timers = [s.schedule(1000, fired.append, i) for i in range(10)]
+    for delay in range(1000):
+        timers[delay % 10].reschedule(delay)
+    assert len(s) == 10 and len(s._Scheduler__heap) <= 2 * 10 + 1
+    s.run_pending(now=s.time() + 1000)
+    assert sorted(fired[5:]) == range(10)
+
+
+def test_virtual_time():
+    fired = []
+    s = Scheduler(VirtualClock())
+
+    def periodic():
+        fired.append(s.time())
+        s.schedule(3600, periodic)
+
+    # a day of hourly timers runs instantly
+    s.schedule(3600, periodic)
+    assert s.run_for(24 * 3600) == 24
+    assert fired == [3600.0 * hour for hour in range(1, 25)]
+    assert s.time() == 24 * 3600
@@ -0,0 +1,268 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Read-only snapshots of the neighbor, parent, DODAG and route state.
+
+The caches signal their changes with state_changed(). A new snapshot is then
+built from the main loop, at most once per interval (changes that happen
+close together are published in a single snapshot), and replaces the
+previous one in a single assignment. Readers (the CLI) only ever fetch the
+latest complete snapshot: they neither build one nor take the locks of the
+caches.
+
+The statistics change with every message, without a state change, so they
+are formatted again every stats interval (a reader may see statistics that
+are up to stats interval seconds old).
+
+A snapshot only holds tuples of formatted strings, hence it can not be
+modified and does not keep references to the live objects."""
+
+from collections import namedtuple
+
+import global_variables as gv
+from address import Address
+from rpl_constants import DEFAULT_SNAPSHOT_INTERVAL, DEFAULT_SNAPSHOT_STATS_INTERVAL
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+Snapshot = namedtuple("Snapshot", ["version",          # increases with each publication
+                                   "time",             # when the snapshot was built
+                                   "instances",        # RPL Instances
+                                   "active_dodags",    # text presentation of the active DODAG of each instance
+                                   "dao_parents",      # DAO parent of each active DODAG
+                                   "dodags",           # DODAGs of the DODAG caches
+                                   "neighbors",        # (neighbor, its DODAG) for each neighbor
+                                   "parents",          # (parent, its DODAG) for each DIO parent
+                                   "preferred",        # preferred DIO parent of each instance
+                                   "downward_routes",  # (DODAG ID, downward routes) for each active DODAG
+                                   "routes",           # routes installed by the RPL implementation
+                                   "neighbor_stats",   # statistics of the neighbor caches
+                                   "route_stats",      # statistics of the route caches
+                                   "netlink_stats",    # statistics of the netlink writer
+                                   "trickle_stats",    # statistics of the DIO trickle timers
+                                   "dao_stats",        # statistics of the DAO scheduler and of the pending DAO
+                                   ])
+
+
+def capture_stats():
+    """Format the statistics of a snapshot.
+    Returns a dictionary of the statistics fields"""
+    route_caches = gv.instances.get_route_caches()
+    writer = route_caches and route_caches[0].writer
+    if writer:
+        netlink_stats = writer.get_stats()
+    else:
+        netlink_stats = "netlink operations are performed synchronously"
+
+    return dict(neighbor_stats="\n".join(["RPL Instance ID: %d\n%s" % (instance.instanceID, instance.neigh_cache.get_stats())
+                                          for instance in gv.instances.get_instances()]),
+                route_stats="\n".join(["routing table %s:\n%s" % (route_cache.table, route_cache.get_stats())
+                                       for route_cache in route_caches]),
+                netlink_stats=netlink_stats,
+                trickle_stats="\n".join(["DODAGID: %s; version: %d\n%s" % (repr(Address(dodag.dodagID)), dodag.version.get_val(), dodag.DIOtimer.get_stats())
+                                         for dodag in gv.instances.get_dodag()]),
+                dao_stats=gv.dao_scheduler.get_stats() + "\n" + gv.pending_daos.get_stats())
+
+
+def capture(version, when):
+    """Build a snapshot of the global state"""
+    # a DODAG is formatted once, even if many neighbors belong to it
+    dodag_text = {}
+    def format_dodag(dodag):
+        try:
+            return dodag_text[id(dodag)]
+        except KeyError:
+            text = dodag_text[id(dodag)] = str(dodag)
+            return text
+
+    instances = gv.instances.get_instances()
+    active_dodags = [dodag for dodag in (instance.dodag_cache.get_active_dodag() for instance in instances) if dodag]
+
+    dodags = []
+    neighbors = []
+    parents = []
+    for instance in instances:
+        dodags.extend(format_dodag(dodag) for dodag in instance.dodag_cache.get_dodag())
+        neighbors.extend((str(neigh), format_dodag(neigh.dodag)) for neigh in instance.neigh_cache.get_neighbor_list())
+        parents.extend((str(parent), format_dodag(parent.dodag)) for parent in instance.neigh_cache.get_parent_list())
+
+    return Snapshot(version=version,
+                    time=when,
+                    instances=tuple(str(instance) for instance in instances),
+                    active_dodags=tuple(format_dodag(dodag) for dodag in active_dodags),
+                    dao_parents=tuple(str(dodag.preferred_parent) for dodag in active_dodags),
+                    dodags=tuple(dodags),
+                    neighbors=tuple(neighbors),
+                    parents=tuple(parents),
+                    preferred=tuple(str(instance.neigh_cache.get_preferred()) for instance in instances),
+                    downward_routes=tuple((dodag.dodagID, tuple(str(route) for route in dodag.downward_routes_get()))
+                                          for dodag in active_dodags),
+                    routes=tuple(str(route) for route_cache in gv.instances.get_route_caches()
+                                            for route in route_cache.route_cache),
+                    **capture_stats())
+
+
+class SnapshotPublisher(object):
+    def __init__(self, scheduler, build=capture, build_stats=capture_stats,
+                 interval=DEFAULT_SNAPSHOT_INTERVAL, stats_interval=DEFAULT_SNAPSHOT_STATS_INTERVAL):
+        """Snapshot publisher:
+        - scheduler: the Scheduler the publications are made from
+        - build: function(version, time) that returns a new snapshot
+        - build_stats: function() that returns the statistics fields of a
+          snapshot (as a dictionary)
+        - interval: minimum time between two publications (in seconds)
+        - stats_interval: time between two refreshes of the statistics (in seconds)"""
+        self.scheduler = scheduler
+        self.build = build
+        self.build_stats = build_stats
+        self.interval = interval
+        self.stats_interval = stats_interval
+        self.current = None  # the latest published snapshot
+        self.version = 0
+        self.last_publication = None
+        self.timer = None
+        self.stats_timer = None
+
+        # statistics
+        self.changes = 0  # number of changes signaled by the caches
+        self.publications = 0
+        self.stats_refreshes = 0
+
+
+    def start(self):
+        """Publish the first snapshot, and refresh its statistics periodically"""
+        self.publish()
+        self.stats_timer = self.scheduler.schedule(self.stats_interval, self.refresh_stats)
+
+
+    def invalidate(self):
+        """The state changed, publish a new snapshot (soon)"""
+        self.changes += 1
+        if self.timer is not None and self.timer.is_alive():
+            return
+
+        delay = 0
+        if self.last_publication is not None:
+            delay = max(0, self.last_publication + self.interval - self.scheduler.time())
+
+        if self.timer is None:
+            self.timer = self.scheduler.schedule(delay, self.publish)
+        else:
+            self.timer.reschedule(delay)
+
+
+    def publish(self):
+        """Build and publish a new snapshot right away"""
+        if self.timer is not None:
+            self.timer.cancel()
+        self.version += 1
+        self.last_publication = self.scheduler.time()
+        # readers either see the previous snapshot or this one, never a
+        # partially built one
+        self.current = self.build(self.version, self.last_publication)
+        self.publications += 1
+
+
+    def refresh_stats(self):
+        """Publish the current statistics along with the state of the latest
+        snapshot (called by the scheduler)"""
+        self.stats_timer.reschedule(self.stats_interval)
+        if self.current is not None:
+            self.current = self.current._replace(**self.build_stats())
+            self.stats_refreshes += 1
+
+
+    def get(self):
+        """Return the latest snapshot (None before the first publication)"""
+        return self.current
+
+
+    def get_stats(self):
+        """Return a text presentation of the snapshot statistics"""
+        stats = "snapshot version: %d\n" % self.version
+        if self.last_publication is not None:
+            stats += "snapshot age: %f seconds\n" % (self.scheduler.time() - self.last_publication)
+        stats += "state changes: %d\n" % self.changes
+        stats += "publications: %d\n" % self.publications
+        stats += "statistics refreshes: %d\n" % self.stats_refreshes
+        stats += "publication pending: %s" % (self.timer is not None and self.timer.is_alive() and "yes" or "no")
+        return stats
+
+
+def state_changed():
+    """Signal that the state shown by the snapshots changed"""
+    if gv.snapshots is not None:
+        gv.snapshots.invalidate()
+
+
+def test_snapshot_publisher():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    State = namedtuple("State", "version time value stats")
+    scheduler = Scheduler(VirtualClock())
+    state = {"value": 0, "stats": 0}
+    built = []
+
+    def build(version, when):
+        built.append(version)
+        return State(version, when, state["value"], state["stats"])
+
+    publisher = SnapshotPublisher(scheduler, build, lambda: dict(stats=state["stats"]),
+                                  interval=1, stats_interval=5)
+    publisher.start()
+    assert publisher.get() == (1, 0, 0, 0)
+
+    # changes are published from the scheduler, not when they happen nor
+    # when the snapshot is read
+    state["value"] = 1
+    publisher.invalidate()
+    assert publisher.get() == (1, 0, 0, 0)
+    scheduler.run_for(0.5)
+    state["value"] = 2
+    publisher.invalidate()
+    publisher.invalidate()
+    assert publisher.get() == (1, 0, 0, 0)
+
+    # both changes are published together, once the interval has elapsed
+    scheduler.run_for(0.4)
+    assert publisher.get() == (1, 0, 0, 0)
+    scheduler.run_for(0.2)
+    assert publisher.get()[:3] == (2, 1, 2)
+    assert publisher.changes == 3 and built == [1, 2]
+
+    # the statistics are refreshed periodically, without rebuilding the state
+    state["stats"] = 7
+    scheduler.run_for(4)
+    assert publisher.get()[:3] == (2, 1, 2) and publisher.get().stats == 7
+    assert built == [1, 2] and publisher.stats_refreshes == 1
+
+    # nothing else is published without changes
+    scheduler.run_for(10)
+    assert publisher.get()[0] == 2 and publisher.publications == 2
+
+    # after a quiet period, a change is published right away
+    state["value"] = 3
+    publisher.invalidate()
+    scheduler.run_for(0)
+    (version, when, value, stats) = publisher.get()
+    assert version == 3 and value == 3
+    assert abs(when - 15.1) < 1e-9
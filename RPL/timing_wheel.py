@@ -0,0 +1,245 @@
+# Conditions Of Use
+#
+# This software was developed by employees of the National Institute of
+# Standards and Technology (NIST), and others.
+# This software has been contributed to the public domain.
+# Pursuant to title 15 Untied States Code Section 105, works of NIST
+# employees are not subject to copyright protection in the United States
+# and are considered to be in the public domain.
+# As a result, a formal license is not needed to use this software.
+#
+# This software is provided "AS IS."
+# NIST MAKES NO WARRANTY OF ANY KIND, EXPRESS, IMPLIED
+# OR STATUTORY, INCLUDING, WITHOUT LIMITATION, THE IMPLIED WARRANTY OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE, NON-INFRINGEMENT
+# AND DATA ACCURACY.  NIST does not warrant or make any representations
+# regarding the use of the software or the results thereof, including but
+# not limited to the correctness, accuracy, reliability or usefulness of
+# this software.
+
+"""Hierarchical timing wheel, for the (many) lifetimes of routes, addresses
+and neighbors.
+
+Insertion and cancellation are O(1). Each level of the wheel has `slots` slots,
+a slot at level L covering slots ** L ticks. Entries whose expiry is far away
+sit in a coarse slot and move down one level each time that slot is reached
+(cascading). Expired entries are handed over to their callback in batches:
+callback(payloads) is called once per callback and per tick."""
+
+from time import time
+from math import ceil
+
+from rpl_constants import DEFAULT_WHEEL_RESOLUTION
+
+import logging
+logger = logging.getLogger("RPL")
+
+
+class WheelEntry(object):
+    """A lifetime registered on a TimingWheel"""
+
+    def __init__(self, wheel, callback, payload):
+        self.wheel = wheel
+        self.callback = callback
+        self.payload = payload
+        self.expiry = None  # tick at which the entry expires
+        self.slot = None  # set of entries the entry currently belongs to
+
+    def cancel(self):
+        """Cancel the entry (the callback won't be called)"""
+        self.wheel.cancel(self)
+
+    def reschedule(self, delay):
+        """Expire the entry delay seconds from now instead"""
+        self.wheel.reschedule(self, delay)
+
+    def is_alive(self):
+        return self.slot is not None
+
+
+class TimingWheel(object):
+    def __init__(self, scheduler=None, resolution=DEFAULT_WHEEL_RESOLUTION, slots=64, levels=4):
+        """Timing wheel:
+        - scheduler: Scheduler that advances the wheel when entries are
+          registered (if None, advance() must be called by the owner)
+        - resolution: duration of a tick (in seconds)
+        - slots: number of slots per level
+        - levels: number of levels (entries beyond slots ** levels ticks wait in an overflow list)"""
+        self.scheduler = scheduler
+        self.resolution = float(resolution)
+        self.slots = slots
+        self.levels = levels
+        self.wheels = [[set() for i in range(slots)] for level in range(levels)]
+        self.overflow = set()
+        self.current_tick = int(self.now() / self.resolution)
+        self.count = 0
+        self.timer = None
+
+
+    def now(self):
+        if self.scheduler is not None:
+            return self.scheduler.time()
+        return time()
+
+
+    def schedule(self, delay, callback, payload):
+        """Register an entry that expires in delay seconds. When it expires,
+        callback is called with a list that contains payload"""
+        entry = WheelEntry(self, callback, payload)
+        self.reschedule(entry, delay)
+        return entry
+
+
+    def reschedule(self, entry, delay):
+        """(Re)register an entry"""
+        self.cancel(entry)
+        # the wheel might be late compared to the clock
+        current_tick = max(self.current_tick, int(self.now() / self.resolution))
+        entry.expiry = max(int(ceil((current_tick * self.resolution + delay) / self.resolution)),
+                           self.current_tick + 1)
+        self.__insert(entry)
+        self.count += 1
+        self.__arm()
+
+
+    def cancel(self, entry):
+        """Unregister an entry"""
+        if entry.slot is not None:
+            entry.slot.discard(entry)
+            entry.slot = None
+            self.count -= 1
+
+
+    def __insert(self, entry):
+        """Place an entry in the slot that covers its expiry"""
+        ticks = entry.expiry - self.current_tick
+        span = 1
+        for level in range(self.levels):
+            if ticks < span * self.slots:
+                entry.slot = self.wheels[level][(entry.expiry // span) % self.slots]
+                break
+            span *= self.slots
+        else:
+            entry.slot = self.overflow
+        entry.slot.add(entry)
+
+
+    def __arm(self):
+        """Make sure the scheduler advances the wheel at the next tick"""
+        if self.scheduler is None or not self.count:
+            return
+        delay = max(0, (self.current_tick + 1) * self.resolution - self.now())
+        if self.timer is None:
+            self.timer = self.scheduler.schedule(delay, self.advance)
+        elif not self.timer.is_alive():
+            self.timer.reschedule(delay)
+
+
+    def advance(self, now=None):
+        """Move the wheel up to the current time and call the callbacks of
+        the expired entries. Returns the number of expired entries"""
+        if now is None:
+            now = self.now()
+        target_tick = int(now / self.resolution)
+
+        expired = []
+        while self.current_tick < target_tick:
+            if not self.count:
+                # nothing to expire, jump ahead
+                self.current_tick = target_tick
+                break
+
+            self.current_tick += 1
+
+            # cascade the coarser slots that are reached
+            span = 1
+            for level in range(1, self.levels + 1):
+                span *= self.slots
+                if self.current_tick % span:
+                    break
+                if level == self.levels:
+                    entries = self.overflow
+                    self.overflow = set()
+                else:
+                    index = (self.current_tick // span) % self.slots
+                    entries = self.wheels[level][index]
+                    self.wheels[level][index] = set()
+                for entry in entries:
+                    self.__insert(entry)
+
+            index = self.current_tick % self.slots
+            entries = self.wheels[0][index]
+            self.wheels[0][index] = set()
+            for entry in entries:
+                entry.slot = None
+            self.count -= len(entries)
+            expired.extend(entries)
+
+        # one call per callback, with all its expired payloads
+        # (bound methods are told apart by the identity of their object)
+        batches = {}
+        for entry in sorted(expired, key=lambda entry: entry.expiry):
+            key = (id(getattr(entry.callback, "im_self", None)), getattr(entry.callback, "im_func", entry.callback))
+            batches.setdefault(key, (entry.callback, []))[1].append(entry.payload)
+        for (callback, payloads) in batches.itervalues():
+            try:
+                callback(payloads)
+            except Exception:
+                logger.exception("lifetime expiry callback %s failed" % callback)
+
+        self.__arm()
+        return len(expired)
+
+
+    def __len__(self):
+        return self.count
+
+
+def test_timing_wheel():
+    expired = []
+    def callback(payloads):
+        expired.extend(payloads)
+
+    wheel = TimingWheel(resolution=1, slots=4, levels=2)
+    start = wheel.current_tick
+
+    entries = [wheel.schedule(delay, callback, delay) for delay in (1, 3, 5, 17, 40)]
+    assert len(wheel) == 5
+
+    entries[1].cancel()
+    assert len(wheel) == 4
+
+    # entries expire in a single batch per callback
+    assert wheel.advance(start + 5) == 2
+    assert expired == [1, 5]
+
+    # entries beyond the last level wait in the overflow list
+    assert wheel.advance(start + 16) == 0
+    assert wheel.advance(start + 17) == 1
+    assert expired == [1, 5, 17]
+
+    entries[4].reschedule(2)
+    assert wheel.advance(start + 100) == 1
+    assert expired == [1, 5, 17, 40] and len(wheel) == 0
+
+
+def test_timing_wheel_scheduler():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    expired = []
+    def callback(payloads):
+        expired.extend(payloads)
+
+    # the wheel arms its timer on an idle scheduler
+    scheduler = Scheduler(VirtualClock())
+    wheel = TimingWheel(scheduler=scheduler)
+    entry = wheel.schedule(10, callback, "a")
+    assert len(scheduler) == 1
+
+    scheduler.run_for(5)
+    entry.reschedule(10)
+    scheduler.run_for(9)
+    assert expired == []
+    scheduler.run_for(1)
+    assert expired == ["a"] and len(scheduler) == 0
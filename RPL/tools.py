@@ -19,6 +19,12 @@
 
 """Helper functions"""
 
+import subprocess
+import os
+
+import logging
+logger = logging.getLogger("RPL")
+
 # all-RPL-nodes multicast address
 ALL_RPL_NODES = "ff02::1a"
 
@@ -37,3 +43,23 @@ def broadcast(interfaces, msg):
         rpl_socket.send(ALL_RPL_NODES, msg)
 
 
+def intern_string(value):
+    """Return the interned copy of a string, so that the many routes and
+    neighbors that share an interface name or a next hop share a single copy"""
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+def ip_command(*args):
+    """Run an iproute2 command for the IPv6 family (e.g. ip_command("route", "flush", "table", 100)).
+    Returns True when the command succeeded"""
+    command = ["ip", "-6"] + [str(arg) for arg in args]
+    logger.debug("running command: %s" % " ".join(command))
+
+    with open(os.devnull, "w") as devnull:
+        try:
+            return subprocess.call(command, stdout=devnull, stderr=devnull) == 0
+        except OSError:
+            logger.debug("unable to run the ip command")
+            return False
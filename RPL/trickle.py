@@ -19,7 +19,8 @@
 
 """(Somewhat generic) Trickle timer (See RFC 6206)"""
 from random import uniform
-from threading import Timer, RLock
+from threading import RLock
+from math import log, ceil
 
 import logging
 logger = logging.getLogger("RPL")
@@ -30,18 +31,25 @@ class trickleTimer(object):
     t = 0  # time within the current interval
     c = 0  # a counter
 
-    def __init__(self, function, kwargs={}, Imin=0.1, Imax=16, k=2):
+    def __init__(self, function, kwargs={}, Imin=0.1, Imax=16, k=2, scheduler=None, adapt=None):
         """Trickle timer:
         - function: function to execute when the timer expires
         - kwargs: argument of the function
         - Imin: minimum interval size (default 100 ms)
         - Imax: maximum interval size, expressed in the number of doubling of
           the minimum interval size (default 16, that is 6553.6 seconds)
-        - k: redundancy constant"""
+        - k: redundancy constant
+        - scheduler: the Scheduler the timer is armed on
+        - adapt: function called at the end of each interval with the timer
+          and the number of consistent messages heard during the interval,
+          it returns the redundancy constant for the next interval (optional)"""
         super(trickleTimer, self).__init__()
+        assert scheduler is not None
         self.Imin = Imin
         self.Imax = Imin * 2 ** Imax
         self.k = k
+        self.configured_k = k
+        self.adapt = adapt
 
         # step 1
         self.I = uniform(self.Imin, self.Imax)
@@ -54,26 +62,37 @@ class trickleTimer(object):
         self.kwargs = kwargs
         logger.debug("next trickle timer is set to run in %f seconds" % self.t)
         self.lock = RLock()
-        self.thread = Timer(self.t, self.__run)
-        self.thread.daemon = True
+        self.scheduler = scheduler
+        self.timer = None
+
+        # statistics
+        self.intervals = 0  # number of intervals that have ended
+        self.transmissions = 0
+        self.suppressions = 0  # transmissions skipped because c reached k
+        self.consistent = 0  # consistent messages heard
+        self.resets = 0  # resets to Imin caused by inconsistent messages
+        self.interval_histogram = {}  # number of doublings of Imin -> number of intervals
 
     def start(self):
         """Actually starts the timer"""
         with self.lock:
-            if not self.thread.is_alive():
-                self.thread.start()
+            if not self.timer or not self.timer.is_alive():
+                self.timer = self.scheduler.schedule(self.t, self.__run)
 
     def cancel(self):
         """Cancel the timer"""
         with self.lock:
-            if self.thread.is_alive():
-                self.thread.cancel()
+            if self.timer:
+                self.timer.cancel()
 
     def __run(self):
         """Run the function passed to the trickleTimer"""
         with self.lock:
             if self.can_transmit():
+                self.transmissions += 1
                 self.function(** self.kwargs)
+            else:
+                self.suppressions += 1
             self.expired()
 
     def hear_consistent(self):
@@ -82,6 +101,7 @@ class trickleTimer(object):
             # step 3
             logger.debug("Hearing a consistent message")
             self.c += 1
+            self.consistent += 1
 
     def can_transmit(self):
         """Check if the node can transmit its message (t has been reached)"""
@@ -94,6 +114,16 @@ class trickleTimer(object):
         with self.lock:
             # step 5
             logger.debug("trickle timer has expired, increasing minimum interval size")
+            self.intervals += 1
+            doublings = self.doublings()
+            self.interval_histogram[doublings] = self.interval_histogram.get(doublings, 0) + 1
+
+            if self.adapt:
+                k = self.adapt(self, self.c)
+                if k != self.k:
+                    logger.info("trickle redundancy constant changes from %d to %d" % (self.k, k))
+                    self.k = k
+
             self.I = self.I * 2
             if self.I > self.Imax:
                 logger.info("trickle timer has reached maximum interval size")
@@ -106,14 +136,7 @@ class trickleTimer(object):
             self.t = uniform(self.I / 2, self.I)
             logging.debug("next trickle timer is set to run in %f seconds" % self.t)
 
-            try:
-                self.thread.cancel()  # should never be needed
-            except:
-                pass
-
-            self.thread = Timer(self.t, self.__run)
-            self.thread.daemon = True
-            self.thread.start()
+            self.__arm()
 
     def hear_inconsistent(self):
         """Receive an inconsistent message (triggers timer reset)"""
@@ -121,15 +144,158 @@ class trickleTimer(object):
             # step 6
             logger.info("hearing an inconsistent message, reset trickle timer")
             if self.I != self.Imin:
+                self.resets += 1
                 self.I = self.Imin
                 self.c = 0
                 self.t = uniform(self.I / 2, self.I)
 
-                self.cancel()
-                self.thread = Timer(self.t, self.__run)
-                self.thread.daemon = True
-                self.thread.start()
+                self.__arm()
+
+    def doublings(self):
+        """Number of times Imin has been doubled to reach the current interval size"""
+        with self.lock:
+            return max(0, int(log(self.I / self.Imin, 2) + 1e-9))
+
+    def get_stats(self):
+        """Return a text presentation of the trickle statistics"""
+        with self.lock:
+            if self.intervals:
+                ratio = 100.0 * self.suppressions / self.intervals
+            else:
+                ratio = 0
+            stats = "current interval size: %f seconds (Imin: %f, Imax: %f)\n" % (self.I, self.Imin, self.Imax)
+            if self.adapt:
+                stats += "redundancy constant: %d (adaptive, configured: %d)\n" % (self.k, self.configured_k)
+            else:
+                stats += "redundancy constant: %d\n" % self.k
+            stats += "intervals: %d\n" % self.intervals
+            stats += "transmissions: %d\n" % self.transmissions
+            stats += "suppressions (transmissions saved): %d (%.1f%%)\n" % (self.suppressions, ratio)
+            stats += "consistent messages heard: %d\n" % self.consistent
+            stats += "resets: %d\n" % self.resets
+            stats += "interval sizes:"
+            for doublings in sorted(self.interval_histogram):
+                stats += "\n  [%f, %f) seconds: %d" % (self.Imin * 2 ** doublings, self.Imin * 2 ** (doublings + 1),
+                                                    self.interval_histogram[doublings])
+            return stats
+
+    def __arm(self):
+        """(Re)arm the timer so that it fires in t seconds"""
+        if self.timer:
+            self.timer.reschedule(self.t)
+        else:
+            self.timer = self.scheduler.schedule(self.t, self.__run)
 
     def __del__(self):
         self.cancel()
-        super(trickleTimer, self).__del__()
+
+
+def adapt_redundancy_constant(k, configured_k, density, k_min, k_max):
+    """Return the redundancy constant for the next interval of a trickle timer
+    whose current constant is k. The target constant is configured_k ** 2 /
+    density (rounded up), so that k is scaled down when the neighborhood is
+    denser than configured_k is meant for, and up when it is sparser (k_max
+    when no neighbor is known). k moves by one step toward the target, within
+    [k_min, k_max]. A configured constant of 0 (no suppression) is kept."""
+    if configured_k == 0:
+        return k
+
+    if density:
+        target = int(ceil(float(configured_k) ** 2 / density))
+    else:
+        target = k_max
+    target = max(k_min, min(k_max, target))
+
+    if target > k:
+        return k + 1
+    elif target < k:
+        return k - 1
+    return k
+
+
+def test_trickle_virtual_time():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(VirtualClock())
+    sent = []
+    timer = trickleTimer(lambda: sent.append(scheduler.time()), {},
+                         Imin=1, Imax=4, k=1, scheduler=scheduler)
+    timer.start()
+
+    # interval sizes double up to Imax (16 seconds): a day of trickle runs
+    # instantly and ends up with roughly one transmission per Imax
+    scheduler.run_for(24 * 3600)
+    assert timer.I == timer.Imax == 16
+    assert 24 * 3600 / 16 <= len(sent) <= 24 * 3600 / 8 + 5
+
+    assert timer.transmissions == len(sent)
+    assert timer.intervals == timer.transmissions
+    assert timer.interval_histogram[4] >= timer.intervals - 5
+
+    # with k=1, a consistent message suppresses the next transmission
+    del sent[:]
+    timer.hear_consistent()
+    scheduler.run_for(timer.timer.remaining())
+    assert sent == []
+    assert timer.suppressions == 1
+
+    # an inconsistent message resets the interval to Imin
+    # (the very first interval is random, it may already be in the histogram)
+    shortest = timer.interval_histogram.get(0, 0)
+    timer.hear_inconsistent()
+    assert timer.I == 1
+    assert timer.resets == 1
+    scheduler.run_for(1)
+    assert len(sent) == 1
+    assert timer.interval_histogram[0] == shortest + 1
+
+
+def test_trickle_adapt():
+    from clock import VirtualClock
+    from scheduler import Scheduler
+
+    scheduler = Scheduler(VirtualClock())
+    heard = []
+
+    def adapt(timer, consistent):
+        heard.append(consistent)
+        return max(1, timer.k - 1)
+
+    timer = trickleTimer(lambda: None, {}, Imin=1, Imax=2, k=3,
+                         scheduler=scheduler, adapt=adapt)
+    timer.start()
+    timer.hear_consistent()
+    timer.hear_consistent()
+    scheduler.run_for(timer.timer.remaining())
+
+    # the new k applies to the next interval, c is reset afterwards
+    assert heard == [2]
+    assert timer.k == 2
+    assert timer.configured_k == 3
+    assert timer.c == 0
+    scheduler.run_for(100)
+    assert timer.k == 1
+
+
+def test_adapt_redundancy_constant():
+    # dense neighborhood: k goes down one step per interval, down to k_min
+    assert adapt_redundancy_constant(10, 10, 50, 1, 20) == 9
+    assert adapt_redundancy_constant(2, 10, 50, 2, 20) == 2
+    # ceil(10 ** 2 / 30) = 4
+    k = 10
+    for i in range(10):
+        k = adapt_redundancy_constant(k, 10, 30, 1, 20)
+    assert k == 4
+
+    # sparse neighborhood: k goes up, up to k_max
+    assert adapt_redundancy_constant(10, 10, 5, 1, 20) == 11
+    assert adapt_redundancy_constant(20, 10, 5, 1, 20) == 20
+    assert adapt_redundancy_constant(3, 10, 0, 1, 12) == 4
+    assert adapt_redundancy_constant(12, 10, 0, 1, 12) == 12
+
+    # the neighborhood the configured k is meant for
+    assert adapt_redundancy_constant(10, 10, 10, 1, 20) == 10
+
+    # suppression is disabled
+    assert adapt_redundancy_constant(0, 0, 50, 1, 20) == 0